@@ -3,7 +3,8 @@ from django.contrib.auth.models import User, Group
 from django.contrib.auth.admin import UserAdmin
 from django.utils.translation import gettext_lazy as _
 
-from .models import Category, Book
+from .models import Category, Book, PopularBook
+from .search import fts_query, matching_ids, uses_fts
 
 admin.site.unregister(User)
 admin.site.unregister(Group)
@@ -17,36 +18,72 @@ class BookInline(admin.TabularInline):
     show_change_link = True
 
 
+class CategoryLevelFilter(admin.SimpleListFilter):
+    title = "level"
+    parameter_name = "level"
+
+    def lookups(self, request, model_admin):
+        return (
+            ("top", "Top level"),
+            ("branch", "Has subcategories"),
+            ("leaf", "No subcategories"),
+        )
+
+    def queryset(self, request, queryset):
+        if self.value() == "top":
+            return queryset.filter(parent__isnull=True)
+        if self.value() == "branch":
+            return queryset.filter(children__isnull=False).distinct()
+        if self.value() == "leaf":
+            return queryset.filter(children__isnull=True)
+        return queryset
+
+
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
-    list_display = ("name", "parent", "grand_parent", "book_count")
-    list_filter = ("name", "parent")
+    list_display = (
+        "name", "parent", "grand_parent", "book_count", "subtree_book_count", "download_count",
+    )
+    list_filter = (CategoryLevelFilter, "parent")
     search_fields = ("name",)
     inlines = [BookInline]
-
-    def book_count(self, obj):
-        return obj.books.count()
+    # one query for the whole changelist; the counts are stored columns
+    list_select_related = ("parent__parent",)
 
     def grand_parent(self, obj):
         return getattr(obj.parent, 'parent', None)
 
-    book_count.short_description = "Books in this category"
-
 
 @admin.register(Book)
 class BookAdmin(admin.ModelAdmin):
     list_display = ("file_name", "short_caption", "category", "created_date")
     list_filter = ("category__parent", "category")
+    list_select_related = ("category",)
     search_fields = ("caption", "file_name")
     readonly_fields = ("created_date", "updated_date")
     autocomplete_fields = ("category",)
 
+    def get_search_results(self, request, queryset, search_term):
+        # use the FTS5 index instead of LIKE scans over the whole table
+        if not search_term or not uses_fts():
+            return super().get_search_results(request, queryset, search_term)
+        if not fts_query(search_term):
+            return queryset.none(), False
+        return queryset.filter(id__in=matching_ids(search_term)), False
+
     def short_caption(self, obj):
         return obj.caption[:50] + ("…" if len(obj.caption) > 50 else "")
 
     short_caption.short_description = "Caption"
 
 
+@admin.register(PopularBook)
+class PopularBookAdmin(BookAdmin):
+    """The same books, most downloaded first."""
+    list_display = ("file_name", "short_caption", "category", "download_count")
+    ordering = ("-download_count", "-id")
+
+
 class MyUserAdmin(UserAdmin):
     list_display = ("username", "first_name", "is_staff", "is_superuser")
     fieldsets = (
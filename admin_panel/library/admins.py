@@ -0,0 +1,83 @@
+"""
+Telegram ids allowed to run admin commands in the bot.
+
+An admin is a Django user whose ``first_name`` holds their Telegram id. The
+ids are kept in a frozenset that the ``User`` signals in ``library.signals``
+update in place, so a permission check is a set lookup.
+"""
+import time
+
+from aiogram import types
+from aiogram.dispatcher.filters import BoundFilter
+from django.contrib.auth.models import User
+
+from .db import db_executor
+
+
+def parse_telegram_id(value):
+    value = (value or "").strip()
+    return int(value) if value.isdigit() else None
+
+
+class AdminRegistry:
+    def __init__(self, ttl=None):
+        # optional safety net for edits the signals can't see (other processes)
+        self.ttl = ttl
+        self.ids = frozenset()
+        self._by_user = {}
+        self.loaded_at = None
+
+    def __contains__(self, telegram_id):
+        return telegram_id in self.ids
+
+    def is_stale(self):
+        if self.loaded_at is None:
+            return True
+        return self.ttl is not None and time.monotonic() - self.loaded_at > self.ttl
+
+    def load(self):
+        rows = User.objects.exclude(first_name="").values_list("pk", "first_name")
+        self._by_user = {pk: parse_telegram_id(name) for pk, name in rows}
+        self._publish()
+        self.loaded_at = time.monotonic()
+
+    async def refresh_if_stale(self):
+        if self.is_stale():
+            await db_executor.run(self.load)
+
+    def user_saved(self, user):
+        if self.loaded_at is None:
+            return
+        self._by_user[user.pk] = parse_telegram_id(user.first_name)
+        self._publish()
+
+    def user_deleted(self, user):
+        if self.loaded_at is None:
+            return
+        self._by_user.pop(user.pk, None)
+        self._publish()
+
+    def _publish(self):
+        self.ids = frozenset(pk for pk in self._by_user.values() if pk is not None)
+
+
+admin_registry = AdminRegistry()
+
+
+class IsAdmin(BoundFilter):
+    """
+    ``is_admin=True`` handler filter: passes when the sender is a bot admin.
+    Bind it with ``dp.filters_factory.bind(IsAdmin)``.
+    """
+
+    key = "is_admin"
+
+    def __init__(self, is_admin):
+        self.is_admin = is_admin
+
+    async def check(self, obj):
+        user = types.User.get_current()
+        if user is None:
+            return False
+        await admin_registry.refresh_if_stale()
+        return (user.id in admin_registry) == self.is_admin
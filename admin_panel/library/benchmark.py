@@ -0,0 +1,425 @@
+"""
+End-to-end load test of the bot against a local stand-in for the Bot API.
+
+``FakeBotAPI`` is an aiohttp server that answers Bot API methods the way
+Telegram does, records every call and can answer a share of them with 429
+(``retry_after``). ``LoadTest`` seeds a catalogue under its own top-level
+category, feeds the real dispatcher the updates of N simulated users, each
+in its own chat, and times every update from arrival to the end of its
+handler (Bot API calls included):
+
+* readers: /start, drill down to a leaf (``navigate``), get its first page
+  of books (``deliver``) and the next one (``next_page``), then look a
+  book up inline (``inline``);
+* admins: /add_book, drill down (``add_navigate``), send a few documents
+  (``upload``) and confirm (``confirm``).
+
+Users read the keyboards the bot sent them to pick their next button, so
+the whole round trip is exercised. Run it with ``manage.py benchmark_bot``.
+"""
+import asyncio
+import itertools
+import json
+import logging
+import math
+import random
+import time
+import uuid
+
+from aiogram import types
+from aiohttp import web
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import User
+
+from .admins import admin_registry
+from .book_index import book_index
+from .keyboards import BACK, CONFIRM
+from .models import Book, Category, subtree_q
+from .services import count_books
+from .tree import category_tree
+from .webhook import dispatch_to
+
+ROOT_NAME = "⏱ Benchmark"
+# methods whose result is the message that was sent or edited
+MESSAGE_METHODS = {
+    "sendMessage", "sendDocument", "sendPhoto", "editMessageText", "editMessageReplyMarkup",
+}
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of `values` (0 < q <= 100)."""
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    return ordered[max(math.ceil(q / 100 * len(ordered)), 1) - 1]
+
+
+class FakeBotAPI:
+    """
+    Local Bot API server for any token. `retry_after_rate` is the share of
+    calls answered with 429 and a `retry_after` of `retry_after` seconds.
+    """
+
+    def __init__(self, retry_after_rate=0.0, retry_after=1, latency=0.0, seed=None):
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.calls = []
+        self.retry_afters = 0
+        # ids of the inline queries answered: answerInlineQuery has no chat_id
+        self.inline_answers = set()
+        self._pending = {}
+        self._updates = []
+        self._message_ids = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    async def start(self, host="127.0.0.1", port=0):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def add_update(self, data):
+        """Queue an update for ``getUpdates`` (polling bots)."""
+        self._updates.append(data)
+
+    async def get_updates(self, params):
+        offset = int(params.get("offset") or 0)
+        deadline = time.monotonic() + float(params.get("timeout") or 0)
+        while True:
+            if offset:
+                self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if self._updates or time.monotonic() >= deadline:
+                return self._updates[:int(params.get("limit") or 100)]
+            await asyncio.sleep(0.05)
+
+    def take(self, chat_id):
+        """Calls made for `chat_id` since the last `take`, as (method, params)."""
+        return self._pending.pop(chat_id, [])
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(params)})
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.retry_after_rate and self.random.random() < self.retry_after_rate:
+            self.retry_afters += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }, status=429)
+        for key in ("reply_markup", "media"):
+            if isinstance(params.get(key), str):
+                params[key] = json.loads(params[key])
+        if method == "answerInlineQuery":
+            self.inline_answers.add(params["inline_query_id"])
+        chat_id = int(params.get("chat_id", 0))
+        self.calls.append((method, chat_id))
+        self._pending.setdefault(chat_id, []).append((method, params))
+        return web.json_response({"ok": True, "result": self._result(method, chat_id, params)})
+
+    def _message(self, chat_id, **fields):
+        return {
+            "message_id": next(self._message_ids), "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, **fields,
+        }
+
+    def _document(self, file_id):
+        return {"file_id": file_id, "file_unique_id": file_id[-16:], "file_name": "book.pdf"}
+
+    def _result(self, method, chat_id, params):
+        if method == "sendMediaGroup":
+            return [
+                self._message(chat_id, document=self._document(item["media"]))
+                for item in params["media"]
+            ]
+        if method == "sendDocument":
+            return self._message(chat_id, document=self._document(str(params.get("document"))))
+        if method in MESSAGE_METHODS:
+            return self._message(chat_id, text=params.get("text", ""))
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Benchmark", "username": "bench_bot"}
+        return True
+
+
+def reply_buttons(calls):
+    """Texts of the last reply keyboard among `calls`."""
+    for method, params in reversed(calls):
+        rows = (params.get("reply_markup") or {}).get("keyboard")
+        if rows:
+            return [b["text"] if isinstance(b, dict) else b for row in rows for b in row]
+    return []
+
+
+def inline_buttons(calls):
+    """callback_data of the buttons of the last inline keyboard among `calls`."""
+    for method, params in reversed(calls):
+        rows = (params.get("reply_markup") or {}).get("inline_keyboard")
+        if rows:
+            return [b["callback_data"] for row in rows for b in row if b.get("callback_data")]
+    return []
+
+
+def delivered(calls):
+    return any(method in ("sendMediaGroup", "sendDocument") for method, params in calls)
+
+
+class SimulatedUser:
+    def __init__(self, test, user_id, admin=False):
+        self.test = test
+        self.user_id = user_id
+        self.admin = admin
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.random = random.Random(user_id)
+
+    # ---- updates -----------------------------------------------------------
+
+    def _sender(self):
+        return {"id": self.user_id, "is_bot": False, "first_name": f"user{self.user_id}"}
+
+    def _message(self, **fields):
+        return {
+            "message_id": next(self.message_ids), "date": int(time.time()),
+            "chat": {"id": self.user_id, "type": "private"}, "from": self._sender(), **fields,
+        }
+
+    def _update(self, **fields):
+        return {"update_id": self.user_id * 1000000 + next(self.update_ids), **fields}
+
+    def text(self, text):
+        entities = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}] \
+            if text.startswith("/") else None
+        message = self._message(text=text)
+        if entities:
+            message["entities"] = entities
+        return self._update(message=message)
+
+    def document(self):
+        file_id = f"bench-{uuid.uuid4().hex}"
+        return self._update(message=self._message(document={
+            "file_id": file_id, "file_unique_id": file_id[-16:],
+            "file_name": f"{file_id}.pdf",
+        }))
+
+    def callback(self, data):
+        return self._update(callback_query={
+            "id": str(uuid.uuid4().int)[:18], "from": self._sender(), "chat_instance": "1",
+            "data": data, "message": self._message(text="📖 Boshqa kitoblar:"),
+        })
+
+    def inline_query(self, text):
+        return self._update(inline_query={
+            "id": str(uuid.uuid4().int)[:18], "from": self._sender(), "query": text, "offset": "",
+        })
+
+    # ---- scenarios ---------------------------------------------------------
+
+    async def send(self, step, update, delivery_step=None):
+        return await self.test.process(step, self.user_id, update, delivery_step)
+
+    async def drill_down(self, calls, step, delivery_step=None):
+        """Press category buttons until the bot stops sending submenus."""
+        choice = ROOT_NAME
+        while True:
+            buttons = reply_buttons(calls)
+            if choice is None:
+                options = [b for b in buttons if b not in (BACK, CONFIRM)]
+                if not options or CONFIRM in buttons:
+                    return calls
+                choice = self.random.choice(options)
+            else:
+                # buttons carry book counts: "Name (12)"
+                choice = next((b for b in buttons if b.startswith(f"{choice} (")), None)
+                if choice is None:
+                    return calls
+            calls = await self.send(step, self.text(choice), delivery_step)
+            choice = None
+            if delivered(calls):
+                return calls
+
+    async def read(self):
+        calls = await self.send("start", self.text("/start"))
+        calls = await self.drill_down(calls, "navigate", "deliver")
+        if not delivered(calls):
+            return
+        pages = [data for data in inline_buttons(calls) if ":next:" in data]
+        if pages:
+            await self.send("next_page", self.callback(pages[0]))
+        query = self.inline_query(f"kitob {self.random.randint(1, self.test.books)}")
+        await self.send("inline", query)
+        if query["inline_query"]["id"] not in self.test.api.inline_answers:
+            logging.error(f'Inline query of user {self.user_id} was not answered')
+            self.test.errors += 1
+
+    async def add_books(self, count):
+        calls = await self.send("add_book", self.text("/add_book"))
+        calls = await self.drill_down(calls, "add_navigate")
+        if CONFIRM not in reply_buttons(calls):
+            return
+        for _ in range(count):
+            await self.send("upload", self.document())
+        await self.send("confirm", self.text(CONFIRM))
+
+    async def run(self):
+        if self.admin:
+            await self.add_books(self.test.uploads)
+        await self.read()
+
+
+class LoadTest:
+    """
+    Drives `dispatcher` with `users` simulated users (every `admin_every`-th
+    one an admin) against a catalogue of `branches` ** `depth` leaf
+    categories with `books` books each. A simulated user waits for the
+    background deliveries (`deliveries`) started for them; the time until
+    they finish is reported as the "delivered" step.
+    """
+
+    def __init__(self, dispatcher, api, users=50, branches=4, depth=2, books=25,
+                 admin_every=10, uploads=3, deliveries=None):
+        self.dispatcher = dispatcher
+        self.deliveries = deliveries
+        self.delivered = []
+        self.api = api
+        self.users = users
+        self.branches = branches
+        self.depth = depth
+        self.books = books
+        self.admin_every = admin_every
+        self.uploads = uploads
+        # updates go through the same path as in webhook mode
+        self.handle = dispatch_to(dispatcher)
+        self.timings = {}
+        self.errors = 0
+        self.first_user_id = 7_000_000_000
+
+    # ---- catalogue ---------------------------------------------------------
+
+    def seed(self):
+        self.cleanup()
+        root = Category.objects.create(name=ROOT_NAME)
+        level = [root]
+        for d in range(self.depth):
+            level = [
+                Category.objects.create(parent=parent, name=f"{'ABCDEFGH'[d]}{i + 1}")
+                for parent in level for i in range(self.branches)
+            ]
+        Book.objects.bulk_create([
+            Book(category=leaf, file_id=f"bench-{leaf.id}-{i}", file_name=f"{leaf.id}-{i}.pdf",
+                 caption=f"{leaf.name} kitob {i + 1}")
+            for leaf in level for i in range(self.books)
+        ], batch_size=500)
+        count_books({leaf.id: self.books for leaf in level})
+        User.objects.bulk_create([
+            User(username=f"bench-admin-{uid}", first_name=str(uid))
+            for uid in self.user_ids() if self.is_admin(uid)
+        ])
+
+    def cleanup(self):
+        root = Category.objects.filter(parent=None, name=ROOT_NAME).first()
+        if root is not None:
+            # deepest first: children of a deleted category are moved to the top level
+            subtree = Category.objects.filter(subtree_q(root.subtree_path))
+            for depth in sorted(set(subtree.values_list("depth", flat=True)), reverse=True):
+                subtree.filter(depth=depth).delete()
+            root.delete()
+        User.objects.filter(username__startswith="bench-admin-").delete()
+
+    def user_ids(self):
+        return range(self.first_user_id, self.first_user_id + self.users)
+
+    def is_admin(self, user_id):
+        return bool(self.admin_every) and (user_id - self.first_user_id) % self.admin_every == 0
+
+    # ---- running -----------------------------------------------------------
+
+    async def process(self, step, chat_id, data, delivery_step=None):
+        """
+        Feed one update to the dispatcher and return the Bot API calls it
+        made. Its time goes under `delivery_step` when books were sent.
+        """
+        update = types.Update(**data)
+        started = time.perf_counter()
+        try:
+            await self.handle(update)
+        except Exception:
+            logging.exception(f'Update {update.update_id} failed')
+            self.errors += 1
+        elapsed = time.perf_counter() - started
+        task = self.deliveries.get(chat_id) if self.deliveries else None
+        if task is not None:
+            await asyncio.gather(task, return_exceptions=True)
+            self.delivered.append(time.perf_counter() - started)
+        calls = self.api.take(chat_id)
+        if delivery_step and delivered(calls):
+            step = delivery_step
+        self.timings.setdefault(step, []).append(elapsed)
+        return calls
+
+    async def run(self):
+        await sync_to_async(self.seed)()
+        try:
+            await sync_to_async(category_tree.load)()
+            await sync_to_async(admin_registry.load)()
+            await sync_to_async(book_index.load)()
+            users = [SimulatedUser(self, uid, self.is_admin(uid)) for uid in self.user_ids()]
+            started = time.perf_counter()
+            await asyncio.gather(*(user.run() for user in users))
+            elapsed = time.perf_counter() - started
+        finally:
+            await sync_to_async(self.cleanup)()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        updates = sum(len(t) for t in self.timings.values())
+        steps = {}
+        timings = dict(self.timings, delivered=self.delivered) if self.delivered else self.timings
+        for step, timings in timings.items():
+            steps[step] = {
+                "count": len(timings),
+                **{f"p{q}": percentile(timings, q) for q in (50, 95, 99)},
+                "max": max(timings),
+            }
+        return {
+            "params": {
+                "users": self.users, "branches": self.branches, "depth": self.depth,
+                "books": self.books, "admin_every": self.admin_every, "uploads": self.uploads,
+                "retry_after_rate": self.api.retry_after_rate,
+            },
+            "elapsed": elapsed,
+            "updates": updates,
+            "updates_per_second": updates / elapsed if elapsed else None,
+            "api_calls": len(self.api.calls),
+            "retry_afters": self.api.retry_afters,
+            "errors": self.errors,
+            "steps": steps,
+        }
+
+
+def compare(current, previous):
+    """Rows of (step, quantile, previous, current, change in %) for two reports."""
+    rows = []
+    for step, stats in current["steps"].items():
+        before = previous.get("steps", {}).get(step)
+        if not before:
+            continue
+        for q in ("p50", "p95", "p99"):
+            if before.get(q):
+                rows.append((step, q, before[q], stats[q], (stats[q] / before[q] - 1) * 100))
+    return rows
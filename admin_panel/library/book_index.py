@@ -0,0 +1,240 @@
+"""
+In-process word index over the books, used to answer inline queries.
+
+Every word of a book's caption and file name is indexed, and a query word
+matches any indexed word it is a prefix of, so ``@bot makro iqt`` finds
+"Makroiqtisodiyot asoslari". The index is loaded once at startup and then
+kept in sync by the ``Book`` signals in ``library.signals``; answering a
+query doesn't touch the database.
+"""
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+
+from .models import Book
+
+# query words up to this long are answered from per-prefix id lists built in
+# advance: "m" alone matches a large share of all the indexed words
+SHORT_PREFIX = 2
+
+
+def fold(text):
+    """Lowercase `text` and strip its accents."""
+    decomposed = unicodedata.normalize("NFKD", text.casefold())
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text):
+    return re.findall(r"\w+", fold(text or ""))
+
+
+def short_prefixes(words):
+    return {word[:n] for word in words for n in range(1, SHORT_PREFIX + 1) if len(word) >= n}
+
+
+def sorted_contains(ids, pk):
+    index = bisect.bisect_left(ids, pk)
+    return index < len(ids) and ids[index] == pk
+
+
+class BookEntry:
+    __slots__ = ("id", "file_id", "file_name", "caption")
+
+    def __init__(self, id, file_id, file_name, caption):
+        self.id = id
+        self.file_id = file_id
+        self.file_name = file_name
+        self.caption = caption
+
+    @property
+    def title(self):
+        return self.caption or self.file_name
+
+    def __repr__(self):
+        return f"<BookEntry {self.id} {self.title!r}>"
+
+
+class BookIndex:
+    """
+    Books by id and book ids by word, with the words also kept sorted so
+    that the words starting with a prefix are one bisect away. A search
+    walks the ids of its rarest word newest first and stops after one
+    page, so its cost depends on the page size rather than the catalogue.
+
+    The index is updated in place, so reads take the lock as well; it is
+    never held for longer than one lookup or one update.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        # word -> ids as a set (membership) and as a sorted list (order)
+        self._postings = {}
+        self._ordered = {}
+        self._words = []
+        # prefix of at most SHORT_PREFIX letters -> sorted ids of the books
+        # with a word starting with it
+        self._short = {}
+        self._newest = None
+        self.loaded_at = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    # ---- reads -------------------------------------------------------------
+
+    def _postings_for(self, prefix):
+        """Words starting with `prefix`."""
+        words = []
+        index = bisect.bisect_left(self._words, prefix)
+        while index < len(self._words) and self._words[index].startswith(prefix):
+            words.append(self._words[index])
+            index += 1
+        return words
+
+    def _newest_first(self, words):
+        """Ids of the books with any of `words`, newest first, without repeats."""
+        if len(words) == 1:
+            yield from reversed(self._ordered[words[0]])
+            return
+        previous = None
+        for pk in heapq.merge(*(reversed(self._ordered[w]) for w in words), reverse=True):
+            if pk != previous:
+                yield pk
+            previous = pk
+
+    def _candidates(self, prefix):
+        """
+        Books with a word starting with `prefix`: (how many at most, their
+        ids newest first, membership test).
+        """
+        if len(prefix) <= SHORT_PREFIX:
+            ids = self._short.get(prefix, [])
+            return len(ids), reversed(ids), lambda pk: sorted_contains(ids, pk)
+        words = self._postings_for(prefix)
+        sets = [self._postings[w] for w in words]
+
+        def contains(pk):
+            return any(pk in s for s in sets)
+
+        return sum(map(len, sets)), self._newest_first(words), contains
+
+    def search(self, text, limit=20, offset=0):
+        """
+        Books matching every word of `text` (as a prefix), newest first,
+        and whether there are more after them. An empty query lists the
+        newest books.
+        """
+        words = set(tokenize(text))
+        wanted = offset + limit + 1
+        with self._lock:
+            if not words:
+                if self._newest is None:
+                    self._newest = sorted(self._entries, reverse=True)
+                ids = self._newest[:wanted]
+            else:
+                # walk the books of the rarest query word newest first and
+                # stop as soon as enough of them have the other words too
+                matches = sorted((self._candidates(word) for word in words), key=lambda c: c[0])
+                others = [contains for _, _, contains in matches[1:]]
+                ids = []
+                for pk in matches[0][1]:
+                    if all(contains(pk) for contains in others):
+                        ids.append(pk)
+                        if len(ids) == wanted:
+                            break
+            page = [self._entries[pk] for pk in ids[offset:offset + limit]]
+        return page, len(ids) == wanted
+
+    # ---- writes ------------------------------------------------------------
+
+    def load(self):
+        """Replace the index with the current contents of the database."""
+        rows = Book.objects.values_list("id", "file_id", "file_name", "caption")
+        fresh = BookIndex()
+        for row in rows.iterator(chunk_size=2000):
+            fresh._add(BookEntry(*row))
+        # everything is built before taking the lock, which searches wait on
+        ordered = {word: sorted(ids) for word, ids in fresh._postings.items()}
+        short = {}
+        for word, ids in fresh._postings.items():
+            for prefix in short_prefixes([word]):
+                short.setdefault(prefix, set()).update(ids)
+        short = {prefix: sorted(ids) for prefix, ids in short.items()}
+        words = sorted(fresh._postings)
+        with self._lock:
+            # freeing the old structures takes a while too: after the lock
+            previous = self._entries, self._postings, self._ordered, self._short, self._words
+            self._entries = fresh._entries
+            self._postings = fresh._postings
+            self._ordered = ordered
+            self._short = short
+            self._words = words
+            self._newest = None
+            self.loaded_at = time.monotonic()
+        del previous
+
+    def upsert(self, book):
+        self.upsert_many([book])
+
+    def upsert_many(self, books):
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            for book in books:
+                self._discard(book.pk)
+                entry = BookEntry(book.pk, book.file_id, book.file_name, book.caption)
+                words = self._add(entry)
+                for word in words:
+                    if len(self._postings[word]) == 1:
+                        bisect.insort(self._words, word)
+                    # new books have the highest ids: this is mostly an append
+                    bisect.insort(self._ordered.setdefault(word, []), entry.id)
+                for prefix in short_prefixes(words):
+                    bisect.insort(self._short.setdefault(prefix, []), entry.id)
+            self._newest = None
+
+    def remove(self, book_id):
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            self._discard(book_id)
+            self._newest = None
+
+    def _add(self, entry):
+        self._entries[entry.id] = entry
+        words = set(tokenize(entry.caption)) | set(tokenize(entry.file_name))
+        for word in words:
+            self._postings.setdefault(word, set()).add(entry.id)
+        return words
+
+    def _discard(self, book_id):
+        entry = self._entries.pop(book_id, None)
+        if entry is None:
+            return
+        words = set(tokenize(entry.caption)) | set(tokenize(entry.file_name))
+        for prefix in short_prefixes(words):
+            ids = self._short.get(prefix)
+            if ids is None or not sorted_contains(ids, book_id):
+                continue
+            del ids[bisect.bisect_left(ids, book_id)]
+            if not ids:
+                del self._short[prefix]
+        for word in words:
+            ids = self._postings.get(word)
+            if ids is None:
+                continue
+            ids.discard(book_id)
+            self._ordered[word].remove(book_id)
+            if not ids:
+                del self._postings[word]
+                del self._ordered[word]
+                index = bisect.bisect_left(self._words, word)
+                if index < len(self._words) and self._words[index] == word:
+                    del self._words[index]
+
+
+book_index = BookIndex()
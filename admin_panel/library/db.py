@@ -0,0 +1,65 @@
+"""
+Running ORM code from the bot's event loop.
+
+``sync_to_async`` defaults to ``thread_sensitive=True``, which runs every
+call on one shared thread: all users' queries queue behind each other and
+one slow query stalls everyone. Django's async ORM methods (``aget``,
+``afirst``, ...) are thin wrappers around that same call, so they don't
+help either. ``DatabaseExecutor`` runs the calls on a pool of its own
+threads instead (each with its own database connection), and ``coalesce``
+lets concurrent identical lookups share one query.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+from .metrics import sync_to_async
+
+
+class DatabaseExecutor:
+    def __init__(self, threads=8):
+        # may be changed until the first call
+        self.threads = threads
+        self._executor = None
+        self._in_flight = {}
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix="db")
+        return self._executor
+
+    def _call(self, func, args, kwargs):
+        # drop connections that went away or outlived CONN_MAX_AGE, as a
+        # request would
+        close_old_connections()
+        return func(*args, **kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        """Await `func(*args, **kwargs)` run on one of the database threads."""
+        return await sync_to_async(self._call, thread_sensitive=False, executor=self.executor)(
+            func, args, kwargs
+        )
+
+    async def coalesce(self, func, *args, **kwargs):
+        """
+        Like `run`, but callers asking for the same `func` and arguments while
+        a call is in flight get its result instead of running their own.
+        Only for reads: the result is shared between the callers.
+        """
+        key = (func, args, tuple(sorted(kwargs.items())))
+        future = self._in_flight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self.run(func, *args, **kwargs))
+            self._in_flight[key] = future
+            future.add_done_callback(lambda f: self._in_flight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+db_executor = DatabaseExecutor()
@@ -0,0 +1,119 @@
+"""
+Sending a category's books to a reader.
+
+Books go out as albums of up to ten documents (one Bot API call per album)
+through the shared ``SendScheduler``. A page is sent by a background task
+(``ChatDeliveries``), so the handler that asked for it returns at once and
+the chat's next update isn't held up behind the send rate limits.
+"""
+import asyncio
+import functools
+import logging
+
+from aiogram import types
+from aiogram.utils import exceptions
+
+# Telegram accepts at most ten items per media group
+MEDIA_GROUP_SIZE = 10
+
+
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+async def send_book(bot, scheduler, chat_id, book):
+    await scheduler.call(
+        chat_id, bot.send_document, chat_id, book.file_id, caption=book.caption or None
+    )
+
+
+async def send_books(bot, scheduler, chat_id, books, progress=None):
+    """
+    Send `books` to `chat_id` and return how many were delivered.
+
+    A single unusable file_id makes Telegram reject the whole album, so a
+    rejected album is re-sent one document at a time and only the broken
+    books are skipped. `progress`, if given, is awaited after every album
+    with the number of books done so far and the album's books that were
+    delivered.
+    """
+    sent = done = 0
+    for group in chunked(books, MEDIA_GROUP_SIZE):
+        delivered = await send_group(bot, scheduler, chat_id, group)
+        sent += len(delivered)
+        done += len(group)
+        if progress is not None:
+            await progress(done, delivered)
+    return sent
+
+
+async def send_group(bot, scheduler, chat_id, group):
+    """Send one album; returns its books that were delivered."""
+    try:
+        if len(group) == 1:
+            await send_book(bot, scheduler, chat_id, group[0])
+        else:
+            media = types.MediaGroup([
+                types.InputMediaDocument(book.file_id, caption=book.caption or None)
+                for book in group
+            ])
+            await scheduler.call(
+                chat_id, bot.send_media_group, chat_id, media, cost=len(group)
+            )
+        return list(group)
+    except exceptions.BadRequest:
+        if len(group) == 1:
+            logging.error(f'Sending file error with id: {group[0].id}')
+            return []
+        logging.warning(f'Media group rejected for chat {chat_id}, sending one by one')
+    sent = []
+    for book in group:
+        try:
+            await send_book(bot, scheduler, chat_id, book)
+            sent.append(book)
+        except exceptions.BadRequest:
+            logging.error(f'Sending file error with id: {book.id}')
+    return sent
+
+
+class ChatDeliveries:
+    """
+    At most one running delivery task per chat: starting one cancels the
+    chat's previous one, as does navigating elsewhere (``cancel``).
+    """
+
+    def __init__(self):
+        self._tasks = {}
+
+    def start(self, chat_id, coro):
+        self.cancel(chat_id)
+        task = asyncio.create_task(coro)
+        self._tasks[chat_id] = task
+        task.add_done_callback(functools.partial(self._done, chat_id))
+        return task
+
+    def _done(self, chat_id, task):
+        if self._tasks.get(chat_id) is task:
+            del self._tasks[chat_id]
+        if not task.cancelled() and task.exception() is not None:
+            logging.error(f'Delivery to chat {chat_id} failed', exc_info=task.exception())
+
+    def get(self, chat_id):
+        return self._tasks.get(chat_id)
+
+    def cancel(self, chat_id):
+        """Cancel the chat's delivery; whether there was one."""
+        task = self._tasks.pop(chat_id, None)
+        if task is None:
+            return False
+        task.cancel()
+        return True
+
+    async def shutdown(self):
+        """Cancel every delivery and wait for them to stop."""
+        tasks = list(self._tasks.values())
+        self._tasks = {}
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
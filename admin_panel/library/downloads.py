@@ -0,0 +1,64 @@
+"""
+Download counters.
+
+Every book sent to a reader counts as a download of the book and of its
+category. An UPDATE per send would double the writes on the busiest path,
+so sends are tallied in memory and ``flush`` (run periodically by the bot
+and on shutdown) adds the tallies with a few batched UPDATEs. The UPDATEs
+add to the stored values, so several bot processes can flush into the
+same rows.
+"""
+import threading
+from collections import Counter
+
+from django.db import transaction
+
+from .models import Book, Category, shifted
+
+# rows per UPDATE: three parameters per row (the pk and amount in the CASE
+# of shifted(), the pk again in the IN filter) plus shifted()'s two zeros,
+# within the 999 parameters older SQLite builds allow
+FLUSH_BATCH = (999 - 2) // 3
+
+
+class DownloadCounter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._books = Counter()
+        self._categories = Counter()
+
+    def record(self, category_id, book_ids):
+        with self._lock:
+            self._books.update(book_ids)
+            self._categories[category_id] += len(book_ids)
+
+    def flush(self):
+        """Write the tallies to the database; returns the number of downloads written."""
+        with self._lock:
+            books, categories = self._books, self._categories
+            self._books, self._categories = Counter(), Counter()
+        if not books and not categories:
+            return 0
+        try:
+            with transaction.atomic():
+                add_downloads(Book, books)
+                add_downloads(Category, categories)
+        except Exception:
+            # keep them for the next flush
+            with self._lock:
+                self._books.update(books)
+                self._categories.update(categories)
+            raise
+        return sum(books.values())
+
+
+def add_downloads(model, counts):
+    counts = list(counts.items())
+    for i in range(0, len(counts), FLUSH_BATCH):
+        batch = dict(counts[i:i + FLUSH_BATCH])
+        model.objects.filter(pk__in=batch).update(
+            download_count=shifted("download_count", batch),
+        )
+
+
+download_counter = DownloadCounter()
@@ -0,0 +1,242 @@
+"""
+Persistent aiogram FSM storage in a local SQLite file.
+
+* Writes are write-behind: handlers only touch an in-memory record and the
+  dirty records are flushed together, in one transaction, every
+  ``flush_interval`` seconds (and on shutdown).
+* Only the most recently used ``cache_size`` records stay in memory; the
+  rest are read back from SQLite on demand, in a thread and through a
+  second connection, so a read never waits for a flush (WAL lets it read
+  while the flush writes) and never blocks the event loop.
+* State data is stored as compact JSON, zlib-compressed when large.
+* Sessions idle for longer than ``ttl`` seconds are forgotten.
+"""
+import asyncio
+import copy
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+# data blobs start with a marker byte telling how the rest is encoded
+RAW = b"j"
+ZLIB = b"z"
+COMPRESS_OVER = 256
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fsm (
+    chat TEXT NOT NULL,
+    user TEXT NOT NULL,
+    state TEXT,
+    data BLOB,
+    updated REAL NOT NULL,
+    PRIMARY KEY (chat, user)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS fsm_updated ON fsm (updated);
+"""
+
+
+def encode(data):
+    if not data:
+        return None
+    raw = json.dumps(data, separators=(",", ":"), ensure_ascii=False).encode()
+    if len(raw) > COMPRESS_OVER:
+        return ZLIB + zlib.compress(raw)
+    return RAW + raw
+
+
+def decode(blob):
+    if not blob:
+        return {}
+    blob = bytes(blob)
+    raw = zlib.decompress(blob[1:]) if blob[:1] == ZLIB else blob[1:]
+    return json.loads(raw)
+
+
+class Record:
+    __slots__ = ("state", "data", "updated")
+
+    def __init__(self, state=None, data=None, updated=None):
+        self.state = state
+        self.data = data or {}
+        self.updated = updated or time.time()
+
+    def is_empty(self):
+        return self.state is None and not self.data
+
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, path, cache_size=10000, flush_interval=1.0, ttl=30 * 24 * 3600,
+                 busy_timeout=5.0):
+        self.path = str(path)
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self._dirty = set()
+        self._db_lock = threading.Lock()
+        self._db = self._connect(busy_timeout)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        # cache misses read through their own connection, never under _db_lock
+        self._reader_lock = threading.Lock()
+        self._reader = self._connect(busy_timeout)
+        self._reader.execute("PRAGMA query_only=ON")
+        self._flusher = None
+        self._last_expiry = 0.0
+
+    def _connect(self, busy_timeout):
+        db = sqlite3.connect(
+            self.path, check_same_thread=False, isolation_level=None, timeout=busy_timeout,
+        )
+        db.execute(f"PRAGMA busy_timeout={int(busy_timeout * 1000)}")
+        return db
+
+    # ---- records -----------------------------------------------------------
+
+    def _key(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        return str(chat), str(user)
+
+    def _expired(self, record):
+        return self.ttl is not None and time.time() - record.updated > self.ttl
+
+    def _read(self, key):
+        with self._reader_lock:
+            row = self._reader.execute(
+                "SELECT state, data, updated FROM fsm WHERE chat = ? AND user = ?", key
+            ).fetchone()
+        return Record(row[0], decode(row[1]), row[2]) if row else Record()
+
+    async def _load(self, key):
+        record = self._cache.get(key)
+        if record is None:
+            loaded = await asyncio.get_running_loop().run_in_executor(None, self._read, key)
+            # another update of the same chat may have loaded it meanwhile
+            record = self._cache.setdefault(key, loaded)
+            self._evict()
+        else:
+            self._cache.move_to_end(key)
+        if self._expired(record):
+            # the row itself goes with the next periodic expiry sweep
+            record = self._cache[key] = Record()
+        return record
+
+    def _touch(self, key, record):
+        record.updated = time.time()
+        self._dirty.add(key)
+        self._ensure_flusher()
+
+    def _evict(self):
+        # dirty records are only dropped after they have been flushed
+        while len(self._cache) > self.cache_size:
+            for key in self._cache:
+                if key not in self._dirty:
+                    del self._cache[key]
+                    break
+            else:
+                return
+
+    # ---- write-behind ------------------------------------------------------
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("FSM storage flush failed")
+
+    def _snapshot(self):
+        upserts, deletes, versions = [], [], {}
+        for key in self._dirty:
+            record = self._cache.get(key)
+            versions[key] = record.updated if record is not None else None
+            if record is None or record.is_empty():
+                deletes.append(key)
+            else:
+                upserts.append((*key, record.state, encode(record.data), record.updated))
+        return upserts, deletes, versions
+
+    def _write(self, upserts, deletes):
+        now = time.time()
+        with self._db_lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(
+                    "INSERT INTO fsm (chat, user, state, data, updated) VALUES (?, ?, ?, ?, ?) "
+                    "ON CONFLICT (chat, user) DO UPDATE SET "
+                    "state = excluded.state, data = excluded.data, updated = excluded.updated",
+                    upserts,
+                )
+                self._db.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deletes)
+                if self.ttl is not None and now - self._last_expiry > 60:
+                    self._db.execute("DELETE FROM fsm WHERE updated < ?", (now - self.ttl,))
+                    self._last_expiry = now
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    async def flush(self):
+        """Write every pending change to SQLite in one transaction."""
+        if not self._dirty:
+            return
+        upserts, deletes, versions = self._snapshot()
+        await asyncio.get_running_loop().run_in_executor(None, self._write, upserts, deletes)
+        # records changed while the write was running stay dirty
+        for key, updated in versions.items():
+            record = self._cache.get(key)
+            if record is None or record.updated == updated:
+                self._dirty.discard(key)
+        self._evict()
+
+    async def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+        with self._db_lock:
+            self._db.close()
+        with self._reader_lock:
+            self._reader.close()
+
+    async def wait_closed(self):
+        pass
+
+    # ---- BaseStorage -------------------------------------------------------
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return record.state if record.state is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        record = await self._load(self._key(chat, user))
+        return copy.deepcopy(record.data) if record.data else (default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record.state = self.resolve_state(state)
+        self._touch(key, record)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record.data = copy.deepcopy(data) if data else {}
+        self._touch(key, record)
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        key = self._key(chat, user)
+        record = await self._load(key)
+        record.data.update(copy.deepcopy(data or {}), **kwargs)
+        self._touch(key, record)
@@ -0,0 +1,277 @@
+"""
+Bulk catalogue import from ``books.json`` and a directory of files.
+
+``books.json`` maps a category name to either a list of books
+(``{"title": ..., "file": ...}``) or to an object of subcategories in the
+same format. The file is read one book at a time, local files
+are uploaded to Telegram through a bounded pool to get their ``file_id``,
+and books are inserted with ``bulk_create`` in chunks. Books already stored
+in their category under the same file name are skipped, so an interrupted
+import can simply be run again; files whose content (SHA-256) is already in
+the catalogue are not uploaded a second time.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from collections import Counter
+
+from aiogram import Bot, types
+from aiogram.bot.api import TelegramAPIServer
+from asgiref.sync import sync_to_async
+from django.db import transaction
+
+from .models import Book, Category
+from .scheduler import SendScheduler
+from .services import count_books
+
+logger = logging.getLogger(__name__)
+
+
+class _JSONStream:
+    """
+    JSON text read from `fp` a chunk at a time. The part of the buffer that
+    has been parsed is dropped once it outgrows the rest, so the buffer
+    stays about one chunk plus the value being decoded long.
+    """
+
+    def __init__(self, fp, chunk_size):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf, self.pos, self.eof = "", 0, False
+
+    def _more(self):
+        chunk = "" if self.eof else self.fp.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        if self.pos > len(self.buf) // 2:
+            self.buf, self.pos = self.buf[self.pos:], 0
+        self.buf += chunk
+        return True
+
+    def peek(self):
+        """The next non-whitespace character, or "" at the end of the input."""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._more():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Expected one of {chars!r} in the catalogue JSON")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """Decode the next value; meant for small ones such as a single book."""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._more():
+                    raise
+                continue
+            # a value ending exactly at the buffer end may be cut short
+            if end < len(self.buf) or not self._more():
+                self.pos = end
+                return value
+
+
+def iter_catalogue(fp, chunk_size=64 * 1024):
+    """
+    Yield a (category path, book) pair for every book in the catalogue JSON
+    `fp`. The file is walked one book at a time, so only the book being
+    decoded is held in memory, however long a category's list is.
+    """
+    stream = _JSONStream(fp, chunk_size)
+    stream.expect("{")
+    yield from _subsections(stream, ())
+
+
+def _subsections(stream, path):
+    if stream.peek() == "}":
+        stream.expect("}")
+        return
+    while True:
+        name = stream.value()
+        if not isinstance(name, str):
+            raise ValueError("Expected a category name in the catalogue JSON")
+        stream.expect(":")
+        if stream.expect("{[") == "{":
+            yield from _subsections(stream, (*path, name))
+        else:
+            yield from _books(stream, (*path, name))
+        if stream.expect(",}") == "}":
+            return
+
+
+def _books(stream, path):
+    if stream.peek() == "]":
+        stream.expect("]")
+        return
+    while True:
+        yield path, stream.value()
+        if stream.expect(",]") == "]":
+            return
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Uploader:
+    """Turns a local file into a Telegram (file_id, file_unique_id) pair."""
+
+    async def upload(self, path):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class TelegramUploader(Uploader):
+    """
+    Uploads by sending the file to `chat_id` (e.g. a private storage
+    channel). `api_url` points the bot at another Bot API server, such as a
+    local one.
+    """
+
+    def __init__(self, token, chat_id, api_url=None, **kwargs):
+        server = TelegramAPIServer.from_base(api_url) if api_url else None
+        self.bot = Bot(token=token, server=server) if server else Bot(token=token)
+        self.chat_id = chat_id
+        self.scheduler = SendScheduler()
+
+    async def upload(self, path):
+        with open(path, "rb") as f:
+            message = await self.scheduler.call(
+                self.chat_id, self.bot.send_document, self.chat_id, types.InputFile(f)
+            )
+        return message.document.file_id, message.document.file_unique_id
+
+    async def close(self):
+        session = await self.bot.get_session()
+        await session.close()
+
+
+class CatalogueImporter:
+    def __init__(self, uploader, books_dir, concurrency=8, chunk_size=500):
+        self.uploader = uploader
+        self.books_dir = books_dir
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.chunk_size = chunk_size
+        self.categories = {}
+        self.known_files = {}
+        self.hashes = set()
+        self.stats = {"created": 0, "skipped": 0, "duplicates": 0, "missing": 0, "invalid": 0, "failed": 0}
+
+    # ---- database ----------------------------------------------------------
+
+    def _category(self, path):
+        """Id of the category at `path`, created (with its parents) if needed."""
+        if path not in self.categories:
+            parent_id = self._category(path[:-1]) if len(path) > 1 else None
+            category = Category.objects.filter(parent_id=parent_id, name=path[-1]).first()
+            if category is None:
+                category = Category.objects.create(parent_id=parent_id, name=path[-1])
+            self.categories[path] = category.id
+            self.known_files[category.id] = set(
+                Book.objects.filter(category_id=category.id).values_list("file_name", flat=True)
+            )
+        return self.categories[path]
+
+    def _pending(self, items):
+        """Attach category ids to `items` and drop books that are already stored or malformed."""
+        pending = []
+        for path, book in items:
+            if not isinstance(book, dict) or not isinstance(book.get("file"), str):
+                logger.warning(f"Skipping entry without a file in {'/'.join(path)}: {book!r}")
+                self.stats["invalid"] += 1
+                continue
+            category_id = self._category(path)
+            file_name = os.path.basename(book["file"])
+            if file_name in self.known_files[category_id]:
+                self.stats["skipped"] += 1
+                continue
+            self.known_files[category_id].add(file_name)
+            pending.append((category_id, book, file_name))
+        return pending
+
+    def _new_hashes(self, hashes):
+        """The hashes in `hashes` that are neither stored nor already seen."""
+        stored = set(Book.objects.filter(sha256__in=hashes).values_list("sha256", flat=True))
+        return {h for h in hashes if h not in stored and h not in self.hashes}
+
+    def _save(self, books):
+        # the same file may already be in the catalogue from a bot upload
+        unique_ids = [book.file_unique_id for book in books if book.file_unique_id]
+        stored = set(
+            Book.objects.filter(file_unique_id__in=unique_ids).values_list("file_unique_id", flat=True)
+        )
+        new = [book for book in books if book.file_unique_id not in stored]
+        with transaction.atomic():
+            Book.objects.bulk_create(new)
+            count_books(Counter(book.category_id for book in new))
+        self.stats["created"] += len(new)
+        self.stats["duplicates"] += len(books) - len(new)
+
+    # ---- uploads -----------------------------------------------------------
+
+    async def _hash(self, category_id, book, file_name):
+        path = os.path.join(self.books_dir, book["file"])
+        if not os.path.isfile(path):
+            logger.warning(f"Missing file {path}")
+            self.stats["missing"] += 1
+            return None
+        return category_id, book, file_name, path, await asyncio.to_thread(file_sha256, path)
+
+    async def _upload(self, category_id, book, file_name, path, sha256):
+        async with self.semaphore:
+            try:
+                file_id, file_unique_id = await self.uploader.upload(path)
+            except Exception:
+                logger.exception(f"Upload of {path} failed")
+                self.stats["failed"] += 1
+                return None
+        return Book(
+            category_id=category_id, file_id=file_id, file_name=file_name,
+            caption=book.get("title") or "", file_unique_id=file_unique_id, sha256=sha256,
+        )
+
+    async def _import_chunk(self, items):
+        pending = await sync_to_async(self._pending)(items)
+        hashed = [item for item in await asyncio.gather(*(self._hash(*p) for p in pending)) if item]
+        new = await sync_to_async(self._new_hashes)([item[-1] for item in hashed])
+        uploads = []
+        for item in hashed:
+            if item[-1] in new:
+                new.discard(item[-1])
+                self.hashes.add(item[-1])
+                uploads.append(item)
+            else:
+                self.stats["duplicates"] += 1
+        books = await asyncio.gather(*(self._upload(*item) for item in uploads))
+        books = [book for book in books if book is not None]
+        if books:
+            await sync_to_async(self._save)(books)
+
+    async def run(self, fp):
+        chunk = []
+        for item in iter_catalogue(fp):
+            chunk.append(item)
+            if len(chunk) >= self.chunk_size:
+                await self._import_chunk(chunk)
+                chunk = []
+        if chunk:
+            await self._import_chunk(chunk)
+        return self.stats
@@ -0,0 +1,146 @@
+"""
+Reply keyboards for category navigation.
+
+Menus only change when categories or their book counts change, so each
+level is built and JSON-encoded once and the encoded string is handed to
+aiogram as ``reply_markup`` (strings are passed through to the Bot API
+untouched). Buttons read "Name (12)", with the books of the whole subtree.
+"""
+import re
+
+from aiogram import types
+from aiogram.utils import json
+from aiogram.utils.callback_data import CallbackData
+
+from .services import NEWEST, POPULAR, encode_cursor
+from .tree import category_tree
+
+# default number of buttons per row in keyboards
+ROW_SIZE = 2
+
+BACK = "Ortga"
+CONFIRM = "Tasdiqlash ✔"
+CANCEL = "Bekor qilish ❌"
+
+book_pages = CallbackData("books", "category_id", "direction", "cursor")
+book_orders = CallbackData("order", "category_id", "order")
+search_pages = CallbackData("search", "page")
+
+
+def build_keyboard(options, include_back=False, row_size=ROW_SIZE):
+    """
+    Build a ReplyKeyboardMarkup with buttons for each option.
+    If include_back=True, add an "Ortga" button in its own top row.
+    Then arrange option buttons into rows of length `row_size`.
+    """
+    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
+    # add back button as a separate row if requested
+    if include_back:
+        kb.row(types.KeyboardButton(BACK))
+    # create buttons for options
+    buttons = [types.KeyboardButton(opt) for opt in options]
+    # chunk into rows
+    for i in range(0, len(buttons), row_size):
+        kb.row(*buttons[i:i + row_size])
+    return kb
+
+
+def category_label(node):
+    return f"{node.name} ({node.subtree_book_count})"
+
+
+def serialize(markup):
+    return json.dumps(markup.to_python())
+
+
+class KeyboardCache:
+    """Serialized keyboards keyed by (parent_id, include_back, row_size, hide_empty)."""
+
+    def __init__(self, tree):
+        self._tree = tree
+        self._version = None
+        self._cache = {}
+
+    def get(self, parent_id, include_back=False, row_size=ROW_SIZE, hide_empty=False):
+        """Keyboard of `parent_id`'s children; `hide_empty` leaves out those without books."""
+        version = self._tree.version
+        if version != self._version:
+            # the tree changed since the cache was filled: start over
+            self._cache = {}
+            self._version = version
+        key = (parent_id, include_back, row_size, hide_empty)
+        markup = self._cache.get(key)
+        if markup is None:
+            labels = [category_label(node) for node in self._tree.children(parent_id, hide_empty)]
+            markup = serialize(build_keyboard(labels, include_back, row_size))
+            if self._tree.version == version:
+                self._cache[key] = markup
+        return markup
+
+    def choice(self, parent_id, text):
+        """
+        The child of `parent_id` whose button is `text`. The count in the
+        label may be out of date by the time the button is pressed, so it
+        is ignored; a bare name (from a keyboard sent before counts were
+        shown) works too.
+        """
+        node = self._tree.find(parent_id, text)
+        if node is None:
+            labelled = re.fullmatch(r"(.+) \(\d+\)", text or "", re.DOTALL)
+            if labelled:
+                node = self._tree.find(parent_id, labelled.group(1))
+        return node
+
+
+keyboards = KeyboardCache(category_tree)
+
+CONFIRM_KEYBOARD = serialize(
+    types.ReplyKeyboardMarkup(resize_keyboard=True).row(
+        types.KeyboardButton(CONFIRM), types.KeyboardButton(CANCEL)
+    )
+)
+
+
+def page_keyboard(category_id, page):
+    """
+    Inline previous/next buttons for a page of books, plus a button that
+    lists the category in the other order; None for a single page.
+    """
+    buttons = []
+    if page.has_prev:
+        buttons.append(types.InlineKeyboardButton("⬅️ Oldingi", callback_data=book_pages.new(
+            category_id=category_id, direction="prev",
+            cursor=encode_cursor(page.books[0], page.order),
+        )))
+    if page.has_next:
+        buttons.append(types.InlineKeyboardButton("Keyingi ➡️", callback_data=book_pages.new(
+            category_id=category_id, direction="next",
+            cursor=encode_cursor(page.books[-1], page.order),
+        )))
+    if not buttons:
+        return None
+    if page.order == POPULAR:
+        other = types.InlineKeyboardButton("🆕 Yangilari", callback_data=book_orders.new(
+            category_id=category_id, order=NEWEST,
+        ))
+    else:
+        other = types.InlineKeyboardButton("🔥 Ko‘p yuklanganlari", callback_data=book_orders.new(
+            category_id=category_id, order=POPULAR,
+        ))
+    return types.InlineKeyboardMarkup().row(*buttons).row(other)
+
+
+def search_keyboard(page, has_next):
+    """Inline previous/next buttons for a page of search results."""
+    buttons = []
+    if page > 0:
+        buttons.append(types.InlineKeyboardButton(
+            "⬅️ Oldingi", callback_data=search_pages.new(page=page - 1)
+        ))
+    if has_next:
+        buttons.append(types.InlineKeyboardButton(
+            "Keyingi ➡️", callback_data=search_pages.new(page=page + 1)
+        ))
+    if not buttons:
+        return None
+    return types.InlineKeyboardMarkup().row(*buttons)
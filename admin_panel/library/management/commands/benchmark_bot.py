@@ -0,0 +1,144 @@
+import json
+import os
+import socket
+import subprocess
+import tempfile
+from datetime import datetime
+from importlib import import_module
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from library.benchmark import FakeBotAPI, LoadTest, compare
+from library.scheduler import SendScheduler
+
+REPO_ROOT = settings.BASE_DIR.parent
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test the bot with simulated users against a local fake Bot API and "
+        "report throughput and p50/p95/p99 latency per step. Runs against a "
+        "throwaway copy of the database schema, never the configured database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--branches", type=int, default=4, help="Subcategories per category.")
+        parser.add_argument("--depth", type=int, default=2, help="Levels below the benchmark root.")
+        parser.add_argument("--books", type=int, default=25, help="Books per leaf category.")
+        parser.add_argument(
+            "--admin-every", type=int, default=10,
+            help="Every n-th user also runs the /add_book flow (0: nobody).",
+        )
+        parser.add_argument("--uploads", type=int, default=3, help="Documents per /add_book flow.")
+        parser.add_argument(
+            "--retry-after-rate", type=float, default=0.0,
+            help="Share of Bot API calls answered with 429.",
+        )
+        parser.add_argument("--api-latency", type=float, default=0.0, help="Seconds per Bot API call.")
+        parser.add_argument(
+            "--send-rate", type=float, default=30,
+            help="Global sends per second allowed by the bot's scheduler.",
+        )
+        parser.add_argument("--output", default=str(REPO_ROOT / "benchmarks"))
+        parser.add_argument("--compare", help="Earlier result file to compare against.")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        api = FakeBotAPI(
+            retry_after_rate=options["retry_after_rate"], latency=options["api_latency"],
+            seed=options["seed"],
+        )
+        port = free_port()
+        # the bot module reads these when it is first imported
+        os.environ["BOT_API_URL"] = f"http://127.0.0.1:{port}"
+        os.environ.setdefault("BOT_TOKEN", "123456:" + "A" * 35)
+        os.environ["METRICS_PORT"] = ""
+        with tempfile.TemporaryDirectory() as tmp:
+            os.environ["FSM_STORAGE_PATH"] = os.path.join(tmp, "fsm.sqlite3")
+            old_name = self.create_database(tmp)
+            try:
+                bot_module = import_module("main")
+                bot_module.scheduler = SendScheduler(global_rate=options["send_rate"])
+                report = async_to_sync(self.run)(bot_module, api, port, options)
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report["revision"] = git_revision()
+        report["started"] = datetime.now().isoformat(timespec="seconds")
+        os.makedirs(options["output"], exist_ok=True)
+        path = os.path.join(options["output"], datetime.now().strftime("%Y%m%d-%H%M%S.json"))
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+        self.print_report(report)
+        if options["compare"]:
+            with open(options["compare"], encoding="utf-8") as f:
+                self.print_comparison(report, json.load(f))
+        self.stdout.write(self.style.SUCCESS(f"Saved to {path}"))
+
+    def create_database(self, tmp):
+        """
+        Point every connection at a freshly migrated test database, the way
+        the test runner does, so the seeded categories and users never reach
+        the real one; returns the name to pass to destroy_test_db.
+        """
+        old_name = connection.settings_dict["NAME"]
+        if connection.vendor == "sqlite":
+            # a file rather than SQLite's in-memory test database: the bot's
+            # database threads each open their own connection
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(tmp, "db.sqlite3")
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        return old_name
+
+    async def run(self, bot_module, api, port, options):
+        await api.start(port=port)
+        test = LoadTest(
+            bot_module.dp, api, users=options["users"], branches=options["branches"],
+            depth=options["depth"], books=options["books"],
+            admin_every=options["admin_every"], uploads=options["uploads"],
+            deliveries=bot_module.deliveries,
+        )
+        try:
+            return await test.run()
+        finally:
+            await bot_module.on_shutdown(bot_module.dp)
+            await api.stop()
+
+    def print_report(self, report):
+        self.stdout.write(
+            "{updates} updates in {elapsed:.2f}s ({updates_per_second:.1f}/s), "
+            "{api_calls} Bot API calls, {retry_afters} answered 429, {errors} errors".format(**report)
+        )
+        self.stdout.write(f"{'step':<14}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+        for step, stats in report["steps"].items():
+            self.stdout.write(
+                f"{step:<14}{stats['count']:>7}"
+                + "".join(f"{stats[q] * 1000:>10.1f}" for q in ("p50", "p95", "p99"))
+            )
+
+    def print_comparison(self, report, previous):
+        self.stdout.write(f"Compared with {previous.get('revision') or 'previous run'}:")
+        for step, q, before, after, change in compare(report, previous):
+            self.stdout.write(
+                f"{step:<14}{q:>4}{before * 1000:>10.1f}{after * 1000:>10.1f}{change:>+9.1f}%"
+            )
@@ -0,0 +1,25 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from library.snapshot import export_catalogue, open_snapshot
+
+
+class Command(BaseCommand):
+    help = (
+        "Write the category tree and all books to a JSON Lines snapshot "
+        "(gzip-compressed if the file name ends in .gz)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", help="Snapshot file, e.g. catalogue.jsonl.gz")
+        parser.add_argument("--chunk-size", type=int, default=2000)
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        with open_snapshot(options["output"], "w") as fp:
+            categories, books = export_catalogue(fp, chunk_size=options["chunk_size"])
+        self.stdout.write(self.style.SUCCESS(
+            f"Exported {categories} categories and {books} books "
+            f"to {options['output']} in {time.monotonic() - started:.1f}s"
+        ))
@@ -0,0 +1,58 @@
+import os
+
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.module_loading import import_string
+from dotenv import load_dotenv
+
+from library.importer import CatalogueImporter
+
+REPO_ROOT = settings.BASE_DIR.parent
+load_dotenv()
+
+
+class Command(BaseCommand):
+    help = "Import the catalogue from books.json, uploading local files to Telegram."
+
+    def add_arguments(self, parser):
+        parser.add_argument("catalogue", nargs="?", default=str(REPO_ROOT / "books.json"))
+        parser.add_argument("--books-dir", default=str(REPO_ROOT / "books"))
+        parser.add_argument(
+            "--chat-id", type=int, default=os.getenv("IMPORT_CHAT_ID"),
+            help="Chat the files are uploaded to (default: $IMPORT_CHAT_ID).",
+        )
+        parser.add_argument(
+            "--api-url", default=os.getenv("BOT_API_URL"),
+            help="Base URL of a non-default Bot API server (default: $BOT_API_URL).",
+        )
+        parser.add_argument(
+            "--uploader", default="library.importer.TelegramUploader",
+            help="Dotted path of the Uploader class to use.",
+        )
+        parser.add_argument("--concurrency", type=int, default=8)
+        parser.add_argument("--chunk-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        uploader_class = import_string(options["uploader"])
+        if options["uploader"].endswith(".TelegramUploader") and not options["chat_id"]:
+            raise CommandError("--chat-id (or IMPORT_CHAT_ID) is required to upload to Telegram.")
+        stats = async_to_sync(self.run)(uploader_class, options)
+        self.stdout.write(self.style.SUCCESS(
+            "Created {created}, already imported {skipped}, duplicates {duplicates}, "
+            "missing files {missing}, invalid entries {invalid}, failed uploads {failed}.".format(**stats)
+        ))
+
+    async def run(self, uploader_class, options):
+        uploader = uploader_class(
+            token=os.getenv("BOT_TOKEN"), chat_id=options["chat_id"], api_url=options["api_url"],
+        )
+        importer = CatalogueImporter(
+            uploader, options["books_dir"],
+            concurrency=options["concurrency"], chunk_size=options["chunk_size"],
+        )
+        try:
+            with open(options["catalogue"], encoding="utf-8") as fp:
+                return await importer.run(fp)
+        finally:
+            await uploader.close()
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from library.models import Category
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the stored per-category book counters from the books table "
+        "and fix the ones that drifted (e.g. after editing the database by hand)."
+    )
+
+    def handle(self, *args, **options):
+        wrong = Category.recount_books()
+        for category in wrong:
+            self.stdout.write(
+                f"{category.name} (#{category.pk}): {category.book_count} books, "
+                f"{category.subtree_book_count} with subcategories"
+            )
+        self.stdout.write(self.style.SUCCESS(f"Fixed {len(wrong)} categories"))
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError
+
+from library.models import Category
+from library.snapshot import open_snapshot, restore_catalogue
+
+
+class Command(BaseCommand):
+    help = (
+        "Replace the catalogue with a snapshot written by export_books. "
+        "A running bot picks the new catalogue up on its next periodic reload."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("snapshot")
+        parser.add_argument("--batch-size", type=int, default=2000)
+        parser.add_argument(
+            "--replace", action="store_true",
+            help="Delete the current catalogue first; required unless it is empty.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["replace"] and Category.objects.exists():
+            raise CommandError("The catalogue is not empty; pass --replace to overwrite it.")
+        started = time.monotonic()
+        try:
+            with open_snapshot(options["snapshot"]) as fp:
+                categories, books = restore_catalogue(fp, batch_size=options["batch_size"])
+        except (OSError, ValueError, DatabaseError) as e:
+            raise CommandError(f"Restore failed, nothing was changed: {e}")
+        self.stdout.write(self.style.SUCCESS(
+            f"Restored {categories} categories and {books} books "
+            f"in {time.monotonic() - started:.1f}s"
+        ))
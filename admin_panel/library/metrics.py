@@ -0,0 +1,261 @@
+"""
+Prometheus-style metrics for the bot process.
+
+A minimal in-process implementation of counters and histograms rendered in
+the Prometheus text exposition format, plus the hooks that feed them:
+
+* ``MetricsMiddleware`` - handler latency and update counts by handler/state,
+  DB queries and DB time per update;
+* ``throttled_total`` - fed by ``throttling.ThrottlingMiddleware``;
+* ``InstrumentedBot`` - Bot API call latency, errors and 429s per method;
+* ``install_db_metrics`` - counts every SQL query the process runs;
+* ``sync_to_async`` - asgiref's, also recording how long calls wait for the
+  DB thread.
+
+``metrics_app`` serves ``registry.render()`` at ``/metrics``.
+"""
+import bisect
+import functools
+import threading
+import time
+from contextvars import ContextVar
+
+from aiogram import Bot
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.utils import exceptions
+from aiohttp import web
+from asgiref.sync import sync_to_async as _sync_to_async
+from django.db.backends.signals import connection_created
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        return self._values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield f"{self.name}{_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def count(self, *labels):
+        series = self._values.get(labels)
+        return series[2] if series else 0
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items()]
+        names = (*self.labelnames, "le")
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip((*self.buckets, "+Inf"), counts):
+                cumulative += n
+                yield f"{self.name}_bucket{_labels(names, (*labels, bound))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labelnames, labels)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+updates_total = registry.counter(
+    "bot_updates_total", "Updates handled, by handler and FSM state.", ("handler", "state"))
+handler_seconds = registry.histogram(
+    "bot_handler_seconds", "Handler latency.", ("handler",))
+api_seconds = registry.histogram(
+    "telegram_api_seconds", "Bot API call latency.", ("method",))
+api_errors_total = registry.counter(
+    "telegram_api_errors_total", "Failed Bot API calls.", ("method", "error"))
+api_retry_after_total = registry.counter(
+    "telegram_api_retry_after_total", "Bot API calls answered with 429.", ("method",))
+db_queries_total = registry.counter(
+    "db_queries_total", "SQL queries run by the bot process.")
+db_query_seconds = registry.histogram(
+    "db_query_seconds", "SQL query latency.")
+update_db_queries = registry.histogram(
+    "bot_update_db_queries", "SQL queries per update.", buckets=COUNT_BUCKETS)
+update_db_seconds = registry.histogram(
+    "bot_update_db_seconds", "Time spent in SQL per update.")
+throttled_total = registry.counter(
+    "bot_throttled_updates_total", "Updates dropped by the throttling middleware.",
+    ("handler", "reason"))
+sync_to_async_wait_seconds = registry.histogram(
+    "sync_to_async_wait_seconds", "Time sync_to_async calls wait before their thread runs them.")
+
+# per-update accumulator shared with the DB threads through the context
+_update_db = ContextVar("update_db", default=None)
+
+
+# ---- database --------------------------------------------------------------
+
+def _count_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - started
+        db_queries_total.inc()
+        db_query_seconds.observe(elapsed)
+        stats = _update_db.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += elapsed
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
+
+
+def install_db_metrics():
+    connection_created.connect(_instrument_connection, dispatch_uid="library.metrics")
+
+
+def sync_to_async(func, **kwargs):
+    """asgiref's ``sync_to_async`` that also records the queueing delay."""
+
+    @functools.wraps(func)
+    def timed(submitted, *args, **kw):
+        sync_to_async_wait_seconds.observe(time.perf_counter() - submitted)
+        return func(*args, **kw)
+
+    wrapped = _sync_to_async(timed, **kwargs)
+
+    @functools.wraps(func)
+    async def call(*args, **kw):
+        return await wrapped(time.perf_counter(), *args, **kw)
+
+    return call
+
+
+# ---- aiogram ---------------------------------------------------------------
+
+class InstrumentedBot(Bot):
+    async def request(self, method, data=None, files=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except exceptions.RetryAfter:
+            api_retry_after_total.inc(method)
+            raise
+        except Exception as e:
+            api_errors_total.inc(method, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, method)
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Records the handled updates. Hooks on the handled objects rather than
+    on the update itself, since ``Dispatcher.process_update`` (used by the
+    webhook workers) skips the update-level middleware hooks.
+    """
+
+    async def _process(self, obj, data):
+        # current_handler is reset before the post-process hook runs
+        data["_metrics_handler"] = getattr(current_handler.get(None), "__name__", "unknown")
+        data["_metrics_db"] = stats = [0, 0.0]
+        data["_metrics_token"] = _update_db.set(stats)
+        data["_metrics_started"] = time.perf_counter()
+
+    async def _post_process(self, obj, results, data):
+        started = data.pop("_metrics_started", None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        _update_db.reset(data.pop("_metrics_token"))
+        queries, db_seconds = data.pop("_metrics_db")
+        name = data.pop("_metrics_handler")
+        handler_seconds.observe(elapsed, name)
+        updates_total.inc(name, data.get("raw_state") or "-")
+        update_db_queries.observe(queries)
+        update_db_seconds.observe(db_seconds)
+
+    on_process_message = on_process_callback_query = on_process_inline_query = _process
+    on_post_process_message = _post_process
+    on_post_process_callback_query = on_post_process_inline_query = _post_process
+
+
+def metrics_view():
+    async def view(request):
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    return view
+
+
+def metrics_app():
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view())
+    return app
@@ -0,0 +1,63 @@
+from django.db import migrations
+
+# A copy of the SQL in library.search as it was when this migration was
+# written: migrations must not depend on application code that may change.
+CREATE = [
+    """
+    CREATE VIRTUAL TABLE IF NOT EXISTS library_book_fts USING fts5(
+        caption, file_name,
+        content='library_book', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2'
+    )
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS library_book_fts_ai AFTER INSERT ON library_book BEGIN
+        INSERT INTO library_book_fts (rowid, caption, file_name)
+        VALUES (new.id, new.caption, new.file_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS library_book_fts_ad AFTER DELETE ON library_book BEGIN
+        INSERT INTO library_book_fts (library_book_fts, rowid, caption, file_name)
+        VALUES ('delete', old.id, old.caption, old.file_name);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS library_book_fts_au AFTER UPDATE OF caption, file_name
+    ON library_book BEGIN
+        INSERT INTO library_book_fts (library_book_fts, rowid, caption, file_name)
+        VALUES ('delete', old.id, old.caption, old.file_name);
+        INSERT INTO library_book_fts (rowid, caption, file_name)
+        VALUES (new.id, new.caption, new.file_name);
+    END
+    """,
+    "INSERT INTO library_book_fts (library_book_fts) VALUES ('rebuild')",
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS library_book_fts_ai",
+    "DROP TRIGGER IF EXISTS library_book_fts_ad",
+    "DROP TRIGGER IF EXISTS library_book_fts_au",
+    "DROP TABLE IF EXISTS library_book_fts",
+]
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        # FTS5 is SQLite only; other databases search with icontains
+        if schema_editor.connection.vendor != "sqlite":
+            return
+        for sql in statements:
+            schema_editor.execute(sql)
+
+    return operation
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0002_book_file_name"),
+    ]
+
+    operations = [
+        migrations.RunPython(run(CREATE), run(DROP)),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.2 on 2026-10-17 23:52
+
+from django.db import migrations, models
+
+
+def fill_paths(apps, schema_editor):
+    Category = apps.get_model("library", "Category")
+    categories = list(Category.objects.order_by("id"))
+    by_parent = {}
+    for category in categories:
+        by_parent.setdefault(category.parent_id, []).append(category)
+
+    # duplicate sibling names would violate the new unique constraints
+    for siblings in by_parent.values():
+        seen = {}
+        for category in siblings:
+            n = seen.get(category.name, 0)
+            seen[category.name] = n + 1
+            if n:
+                category.name = f"{category.name} ({n + 1})"
+
+    queue = [(category, "/", 0) for category in by_parent.get(None, [])]
+    while queue:
+        category, path, depth = queue.pop()
+        category.path, category.depth = path, depth
+        queue.extend(
+            (child, f"{path}{category.id}/", depth + 1)
+            for child in by_parent.get(category.id, [])
+        )
+    Category.objects.bulk_update(categories, ["name", "path", "depth"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0003_book_fts"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="depth",
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="path",
+            field=models.CharField(
+                db_index=True, default="/", editable=False, max_length=255
+            ),
+        ),
+        migrations.RunPython(fill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["category", "created_date", "id"],
+                name="library_book_category_created",
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="category",
+            constraint=models.UniqueConstraint(
+                fields=("parent", "name"), name="library_category_unique_name"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="category",
+            constraint=models.UniqueConstraint(
+                condition=models.Q(("parent__isnull", True)),
+                fields=("name",),
+                name="library_category_unique_root_name",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2 on 2026-10-17 23:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0004_category_path"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="book",
+            name="file_unique_id",
+            field=models.CharField(blank=True, max_length=64, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="sha256",
+            field=models.CharField(
+                blank=True, editable=False, max_length=64, null=True, unique=True
+            ),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 5.2 on 2026-10-18 00:11
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def fill_counts(apps, schema_editor):
+    Book = apps.get_model("library", "Book")
+    Category = apps.get_model("library", "Category")
+    own = dict(Book.objects.order_by().values_list("category").annotate(n=Count("id")))
+    categories = list(Category.objects.all())
+    subtree = {category.id: 0 for category in categories}
+    for category in categories:
+        n = own.get(category.id, 0)
+        for pk in [int(pk) for pk in category.path.strip("/").split("/") if pk] + [category.id]:
+            if pk in subtree:
+                subtree[pk] += n
+    for category in categories:
+        category.book_count = own.get(category.id, 0)
+        category.subtree_book_count = subtree[category.id]
+    Category.objects.bulk_update(
+        categories, ["book_count", "subtree_book_count"], batch_size=500
+    )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0005_book_unique_file"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="category",
+            name="book_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Books in this category"
+            ),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="subtree_book_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Books with subcategories"
+            ),
+        ),
+        migrations.RunPython(fill_counts, migrations.RunPython.noop),
+    ]
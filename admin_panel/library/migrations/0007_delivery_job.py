@@ -0,0 +1,38 @@
+# Generated by Django 5.2 on 2026-10-18 00:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0006_category_book_counts"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="DeliveryJob",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("chat_id", models.BigIntegerField(unique=True)),
+                ("book_ids", models.TextField()),
+                ("sent", models.PositiveSmallIntegerField(default=0)),
+                ("has_prev", models.BooleanField(default=False)),
+                ("has_next", models.BooleanField(default=False)),
+                ("created_date", models.DateTimeField(auto_now_add=True)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="library.category",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 5.2 on 2026-10-18 00:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0007_delivery_job"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PendingUpload",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True, primary_key=True, serialize=False, verbose_name="ID"
+                    ),
+                ),
+                ("user_id", models.BigIntegerField()),
+                ("session", models.CharField(max_length=32)),
+                ("media_group_id", models.CharField(blank=True, max_length=64, null=True)),
+                ("file_id", models.TextField()),
+                ("file_unique_id", models.CharField(max_length=64)),
+                ("file_name", models.TextField(blank=True)),
+                ("caption", models.TextField(blank=True)),
+                ("created_date", models.DateTimeField(auto_now_add=True, db_index=True)),
+                (
+                    "category",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="+",
+                        to="library.category",
+                    ),
+                ),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("session", "file_unique_id"),
+                        name="library_pendingupload_unique_file",
+                    )
+                ],
+            },
+        ),
+    ]
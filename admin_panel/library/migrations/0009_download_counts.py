@@ -0,0 +1,50 @@
+# Generated by Django 5.2 on 2026-10-18 00:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("library", "0008_pending_upload"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="PopularBook",
+            fields=[],
+            options={
+                "verbose_name": "most downloaded book",
+                "verbose_name_plural": "most downloaded books",
+                "proxy": True,
+                "indexes": [],
+                "constraints": [],
+            },
+            bases=("library.book",),
+        ),
+        migrations.AddField(
+            model_name="book",
+            name="download_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Downloads"
+            ),
+        ),
+        migrations.AddField(
+            model_name="category",
+            name="download_count",
+            field=models.PositiveIntegerField(
+                default=0, editable=False, verbose_name="Downloads"
+            ),
+        ),
+        migrations.AddField(
+            model_name="deliveryjob",
+            name="order",
+            field=models.CharField(default="newest", max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name="book",
+            index=models.Index(
+                fields=["category", "download_count", "id"],
+                name="library_book_category_popular",
+            ),
+        ),
+    ]
@@ -1,24 +1,304 @@
-from django.db import models
+from collections import Counter
+
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import Concat, Greatest, Substr
 
 nb = dict(null=True, blank=True)
 
 
+def subtree_q(prefix, field='path'):
+    """
+    Paths starting with `prefix`, written as a range so that any database
+    can answer it from the index ('/' sorts right before '0').
+    """
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + '0'})
+
+
+def path_ids(path):
+    """Category ids in a materialized path, root first."""
+    return [int(pk) for pk in path.strip('/').split('/') if pk]
+
+
+def shifted(field, amounts):
+    """`field` plus amounts[pk] on each row, as one UPDATE expression."""
+    change = Case(*(When(pk=pk, then=Value(n)) for pk, n in amounts.items()), default=Value(0))
+    # never below zero, even if the counters drifted: a delete must not fail on them
+    return Greatest(F(field) + change, Value(0))
+
+
 class Category(models.Model):
     name = models.CharField(max_length=256)
     parent = models.ForeignKey('self', on_delete=models.SET_NULL, related_name='children', **nb)
+    # materialized path: ids of all ancestors, root first, e.g. "/1/5/"
+    path = models.CharField(max_length=255, default='/', editable=False, db_index=True)
+    depth = models.PositiveSmallIntegerField(default=0, editable=False)
+    # maintained by the Book signals and save_uploads; see add_book_counts
+    book_count = models.PositiveIntegerField('Books in this category', default=0, editable=False)
+    subtree_book_count = models.PositiveIntegerField(
+        'Books with subcategories', default=0, editable=False,
+    )
+    # books of this category sent to readers; see library.downloads
+    download_count = models.PositiveIntegerField('Downloads', default=0, editable=False)
+
+    COUNTERS = ('book_count', 'subtree_book_count', 'download_count')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['parent', 'name'], name='library_category_unique_name'),
+            models.UniqueConstraint(
+                fields=['name'], condition=Q(parent__isnull=True),
+                name='library_category_unique_root_name',
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._saved_path = instance.__dict__.get('path')
+        return instance
+
+    @property
+    def subtree_path(self):
+        """Path prefix shared by this category's descendants."""
+        return f'{self.path}{self.pk}/'
+
+    @property
+    def ancestor_ids(self):
+        return path_ids(self.path)
+
+    def ancestors(self):
+        """Ancestors, root first."""
+        return Category.objects.filter(pk__in=self.ancestor_ids).order_by('depth')
+
+    def descendants(self):
+        return Category.objects.filter(subtree_q(self.subtree_path))
+
+    def subtree_books(self):
+        """Books in this category and all of its descendants."""
+        return Book.objects.filter(Q(category=self) | subtree_q(self.subtree_path, 'category__path'))
+
+    def clean(self):
+        if self.pk and self.parent_id and (
+            self.parent_id == self.pk or self.pk in self.parent.ancestor_ids
+        ):
+            raise ValidationError({'parent': 'A category cannot be moved under itself.'})
+
+    def save(self, *args, **kwargs):
+        if self.parent_id:
+            self.path, self.depth = self.parent.subtree_path, self.parent.depth + 1
+        else:
+            self.path, self.depth = '/', 0
+        old_path = getattr(self, '_saved_path', None)
+        if old_path is not None and kwargs.get('update_fields') is None:
+            # the counters change under this instance: never write back the
+            # values it happened to load
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.COUNTERS
+            ]
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            if old_path is not None and old_path != self.path:
+                old_prefix = f'{old_path}{self.pk}/'
+                self.rebase_descendants(old_prefix, self.subtree_path)
+                # the subtree's books leave the old ancestors for the new ones
+                books = Category.objects.filter(pk=self.pk).values_list(
+                    'subtree_book_count', flat=True).get()
+                if books:
+                    amounts = Counter(dict.fromkeys(path_ids(old_path), -books))
+                    amounts.update(dict.fromkeys(self.ancestor_ids, books))
+                    Category.objects.filter(pk__in=amounts).update(
+                        subtree_book_count=shifted('subtree_book_count', amounts),
+                    )
+        self._saved_path = self.path
+
+    @staticmethod
+    def rebase_descendants(old_prefix, new_prefix):
+        """Move every path under `old_prefix` to `new_prefix` in one UPDATE."""
+        delta = new_prefix.count('/') - old_prefix.count('/')
+        Category.objects.filter(subtree_q(old_prefix)).update(
+            path=Concat(Value(new_prefix), Substr('path', len(old_prefix) + 1)),
+            depth=F('depth') + delta,
+        )
+
+    @classmethod
+    def add_book_counts(cls, deltas):
+        """
+        Apply `deltas` (category id -> change in its own number of books) to
+        the categories' `book_count` and to the `subtree_book_count` of the
+        categories and all of their ancestors, in one UPDATE.
+        """
+        deltas = {pk: n for pk, n in deltas.items() if n}
+        if not deltas:
+            return
+        subtree = Counter()
+        for pk, path in cls.objects.filter(pk__in=deltas).values_list('pk', 'path'):
+            for ancestor in [*path_ids(path), pk]:
+                subtree[ancestor] += deltas[pk]
+        cls.objects.filter(pk__in=subtree).update(
+            book_count=shifted('book_count', deltas),
+            subtree_book_count=shifted('subtree_book_count', subtree),
+        )
+
+    @classmethod
+    def remove_subtree_books(cls, pk, deleted=None):
+        """
+        Take the books of category `pk` and its subcategories off the
+        `subtree_book_count` of its ancestors, as when it is deleted: its
+        books go with it and its subcategories become top level.
+
+        `deleted` is a queryset of categories deleted along with it; the
+        walk up stops at the first of them, which takes the books off the
+        ancestors above it itself.
+        """
+        path, books = cls.objects.filter(pk=pk).values_list('path', 'subtree_book_count').get()
+        ancestors = path_ids(path)[::-1]
+        if not books or not ancestors:
+            return
+        if deleted is not None:
+            stop = set(deleted.filter(pk__in=ancestors).values_list('pk', flat=True))
+            for i, ancestor in enumerate(ancestors):
+                if ancestor in stop:
+                    ancestors = ancestors[:i]
+                    break
+        cls.objects.filter(pk__in=ancestors).update(
+            subtree_book_count=shifted('subtree_book_count', dict.fromkeys(ancestors, -books)),
+        )
+
+    @classmethod
+    def recount_books(cls):
+        """
+        Recompute both counters from the books; returns the categories
+        whose counters were wrong, already fixed.
+        """
+        with transaction.atomic():
+            # lock the counters first, so no upload lands between the count
+            # and the write
+            counters = ('book_count', 'subtree_book_count')
+            categories = list(cls.objects.select_for_update().only('id', 'path', *counters))
+            own = dict(
+                Book.objects.order_by().values_list('category').annotate(n=Count('id'))
+            )
+            subtree = Counter()
+            for category in categories:
+                for pk in [*category.ancestor_ids, category.pk]:
+                    subtree[pk] += own.get(category.pk, 0)
+            wrong = []
+            for category in categories:
+                counts = (own.get(category.pk, 0), subtree[category.pk])
+                if (category.book_count, category.subtree_book_count) != counts:
+                    category.book_count, category.subtree_book_count = counts
+                    wrong.append(category)
+            cls.objects.bulk_update(wrong, counters, batch_size=500)
+        return wrong
+
 
 class Book(models.Model):
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='books')
     file_id = models.CharField(max_length=512)
     file_name = models.CharField(max_length=512)
     caption = models.TextField()
+    # same file, whatever bot or upload it came from; sha256 of imported local files
+    file_unique_id = models.CharField(max_length=64, unique=True, **nb)
+    sha256 = models.CharField(max_length=64, unique=True, editable=False, **nb)
+
+    # times sent to a reader; see library.downloads
+    download_count = models.PositiveIntegerField('Downloads', default=0, editable=False)
 
     created_date = models.DateTimeField(auto_now_add=True)
     updated_date = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # leaf listings: WHERE category_id = ? ORDER BY created_date, id
+            models.Index(fields=['category', 'created_date', 'id'], name='library_book_category_created'),
+            # ... and most downloaded first: ORDER BY download_count, id
+            models.Index(fields=['category', 'download_count', 'id'], name='library_book_category_popular'),
+        ]
+
     def __str__(self):
         return f'{self.pk} {self.file_name} {self.caption[:25]}'
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get('update_fields') is None:
+            # download_count is only ever changed by UPDATEs: don't write
+            # back the value this instance happened to load (nor the
+            # deferred fields, which Django would leave out as well)
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name != 'download_count' and f.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # lets the post_save signal tell a move from an edit
+        instance._saved_category_id = instance.__dict__.get('category_id')
+        return instance
+
+
+
+class PopularBook(Book):
+    """Books by downloads, for the admin's "most downloaded" list."""
+
+    class Meta:
+        proxy = True
+        verbose_name = 'most downloaded book'
+        verbose_name_plural = 'most downloaded books'
+
+
+class DeliveryJob(models.Model):
+    """A page of books being sent to a chat in the background, kept so a restart can resume it."""
+    chat_id = models.BigIntegerField(unique=True)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    # ids of the page's books in sending order, e.g. "12,11,10", and how many are sent
+    book_ids = models.TextField()
+    sent = models.PositiveSmallIntegerField(default=0)
+    has_prev = models.BooleanField(default=False)
+    has_next = models.BooleanField(default=False)
+    order = models.CharField(max_length=16, default='newest')
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.chat_id}: {self.category_id} ({self.sent}/{len(self.ids)})'
+
+    @property
+    def ids(self):
+        return [int(pk) for pk in self.book_ids.split(',') if pk]
+
+
+class PendingUpload(models.Model):
+    """
+    A document an admin sent during /add_book, staged until the batch is
+    confirmed. Rows are only ever inserted, one per document, so documents
+    of an album arriving at once can't overwrite each other.
+    """
+    user_id = models.BigIntegerField()
+    # one /add_book batch; kept in the admin's FSM data
+    session = models.CharField(max_length=32)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='+')
+    media_group_id = models.CharField(max_length=64, **nb)
+    # unbounded here: what Book can't take is reported when the batch is saved
+    file_id = models.TextField()
+    file_unique_id = models.CharField(max_length=64)
+    file_name = models.TextField(blank=True)
+    caption = models.TextField(blank=True)
+    created_date = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            # the same document sent twice in one batch is staged once
+            models.UniqueConstraint(
+                fields=['session', 'file_unique_id'], name='library_pendingupload_unique_file',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.session} {self.file_name}'
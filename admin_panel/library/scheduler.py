@@ -0,0 +1,122 @@
+"""
+Outbound Bot API scheduler.
+
+Every send goes through ``SendScheduler.call`` which spaces requests to stay
+inside Telegram's limits (about 30 messages per second overall and about one
+message per second per chat), waits out ``retry_after`` on 429 answers and
+retries transient failures with exponential backoff.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram.utils import exceptions
+
+# errors worth another attempt; everything else is raised to the caller
+TRANSIENT_ERRORS = (
+    exceptions.NetworkError,
+    exceptions.RestartingTelegram,
+    asyncio.TimeoutError,
+)
+# TelegramAPIError subclasses that mean the request itself is wrong
+FATAL_ERRORS = (
+    exceptions.BadRequest,
+    exceptions.Unauthorized,
+    exceptions.NotFound,
+    exceptions.ConflictError,
+    exceptions.MigrateToChat,
+)
+
+
+class TokenBucket:
+    """
+    Token bucket that hands out reservations instead of blocking.
+
+    `reserve` always succeeds and returns how long the caller has to wait for
+    its turn, so callers are served in the order they asked.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def reserve(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= min(cost, self.capacity)
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def take(self, cost=1):
+        """Take `cost` tokens if the bucket has them now; whether it did."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost or self.blocked_until > now:
+            return False
+        self.tokens -= cost
+        return True
+
+    def block(self, seconds):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def is_idle(self):
+        now = time.monotonic()
+        refilled = self.tokens + (now - self.updated) * self.rate
+        return refilled >= self.capacity and self.blocked_until <= now
+
+
+class SendScheduler:
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=20, max_retries=5,
+                 max_chats=10000, global_bucket=None):
+        # pass `global_bucket` to share the overall budget, e.g. between processes
+        self.global_bucket = global_bucket or TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._chats = {}
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self.max_chats:
+                self._chats = {k: b for k, b in self._chats.items() if not b.is_idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id, cost=1):
+        delay = max(
+            self.global_bucket.reserve(cost),
+            self._chat_bucket(chat_id).reserve(cost),
+        )
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def call(self, chat_id, method, *args, cost=1, **kwargs):
+        """
+        Await `method(*args, **kwargs)` once the rate limits allow it.
+        `cost` is the number of messages the call produces (a media group of
+        ten documents counts as ten).
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(chat_id, cost)
+            try:
+                return await method(*args, **kwargs)
+            except exceptions.RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f'Flood control for chat {chat_id}, retry in {e.timeout}s')
+                self._chat_bucket(chat_id).block(e.timeout)
+            except FATAL_ERRORS:
+                raise
+            except (exceptions.TelegramAPIError, *TRANSIENT_ERRORS) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = min(2 ** attempt, 30)
+                logging.warning(f'Send to chat {chat_id} failed ({e!r}), retry in {delay}s')
+                await asyncio.sleep(delay)
@@ -0,0 +1,113 @@
+"""
+Full-text search over books.
+
+On SQLite the ``library_book_fts`` FTS5 table mirrors ``Book.caption`` and
+``Book.file_name`` and is kept in sync by triggers on ``library_book``, so
+inserts made with ``bulk_create`` or raw SQL are indexed too. Other
+databases fall back to ``icontains`` lookups.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from .models import Book
+
+FTS_TABLE = "library_book_fts"
+
+CREATE_TABLE = f"""
+CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+    caption, file_name,
+    content='library_book', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+)
+"""
+
+TRIGGERS = {
+    f"{FTS_TABLE}_ai": f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON library_book BEGIN
+            INSERT INTO {FTS_TABLE} (rowid, caption, file_name)
+            VALUES (new.id, new.caption, new.file_name);
+        END
+    """,
+    f"{FTS_TABLE}_ad": f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON library_book BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, caption, file_name)
+            VALUES ('delete', old.id, old.caption, old.file_name);
+        END
+    """,
+    f"{FTS_TABLE}_au": f"""
+        CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au AFTER UPDATE OF caption, file_name
+        ON library_book BEGIN
+            INSERT INTO {FTS_TABLE} ({FTS_TABLE}, rowid, caption, file_name)
+            VALUES ('delete', old.id, old.caption, old.file_name);
+            INSERT INTO {FTS_TABLE} (rowid, caption, file_name)
+            VALUES (new.id, new.caption, new.file_name);
+        END
+    """,
+}
+
+
+def uses_fts(conn=connection):
+    return conn.vendor == "sqlite"
+
+
+def install_fts(conn=connection):
+    """
+    Create the FTS table and its triggers if they are missing.
+
+    SQLite migrations that rebuild ``library_book`` drop its triggers, so
+    this runs after every ``migrate``; the index is rebuilt whenever a
+    trigger had to be recreated.
+    """
+    if not uses_fts(conn):
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'library_book'"
+        )
+        existing = {name for name, in cursor.fetchall()}
+        missing = [sql for name, sql in TRIGGERS.items() if name not in existing]
+        for sql in missing:
+            cursor.execute(sql)
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def drop_fts(conn=connection):
+    if not uses_fts(conn):
+        return
+    with conn.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f"DROP TRIGGER IF EXISTS {name}")
+        cursor.execute(f"DROP TABLE IF EXISTS {FTS_TABLE}")
+
+
+def fts_query(text):
+    """Turn user input into an FTS5 query: every word, as a prefix, must match."""
+    words = re.findall(r"\w+", text)
+    return " ".join(f'"{word}"*' for word in words)
+
+
+def matching_ids(text):
+    """Subquery of ids of books matching `text`, for use in `id__in` filters."""
+    return RawSQL(f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [fts_query(text)])
+
+
+def search_books(text, limit=10, offset=0):
+    """Books matching `text`, best match first."""
+    query = fts_query(text)
+    if not query:
+        return []
+    if not uses_fts():
+        books = Book.objects.all()
+        for word in re.findall(r"\w+", text):
+            books = books.filter(Q(caption__icontains=word) | Q(file_name__icontains=word))
+        return list(books.order_by("-created_date", "-id")[offset:offset + limit])
+    return list(Book.objects.raw(
+        f"SELECT b.* FROM library_book b JOIN {FTS_TABLE} f ON f.rowid = b.id "
+        f"WHERE {FTS_TABLE} MATCH %s ORDER BY f.rank LIMIT %s OFFSET %s",
+        [query, limit, offset],
+    ))
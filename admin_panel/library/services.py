@@ -0,0 +1,250 @@
+"""
+Database queries used by the bot.
+
+Everything here is synchronous ORM code; the bot calls it through
+``db_executor`` (``library.db``).
+"""
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Max, Q
+from django.utils import timezone as django_timezone
+
+from .models import Book, Category, DeliveryJob, PendingUpload
+from .tree import category_tree
+
+# books sent per page of a leaf category (one media group by default)
+PAGE_SIZE = 10
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# leaf listing orders; the popular one is keyed on download_count
+NEWEST = "newest"
+POPULAR = "popular"
+ORDER_FIELDS = {NEWEST: "created_date", POPULAR: "download_count"}
+
+
+class BookPage:
+    def __init__(self, books, has_prev, has_next, order=NEWEST):
+        self.books = books
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.order = order
+
+
+def encode_cursor(book, order=NEWEST):
+    """
+    Keyset position of `book`, short enough for callback data:
+    'microseconds-id' when newest first, 'pcount-id' when most downloaded
+    first.
+    """
+    if order == POPULAR:
+        return f"p{book.download_count}-{book.id}"
+    micros = (book.created_date - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{book.id}"
+
+
+def decode_cursor(cursor):
+    """(order, key, id) of a cursor made by `encode_cursor`."""
+    key, pk = cursor.split("-")
+    if key.startswith("p"):
+        return POPULAR, int(key[1:]), int(pk)
+    return NEWEST, EPOCH + timedelta(microseconds=int(key)), int(pk)
+
+
+def book_page(category_id, after=None, before=None, size=PAGE_SIZE, order=NEWEST):
+    """
+    One page of a category's books, newest or most downloaded first
+    (`order`; a cursor carries its own).
+
+    Pages are keyset-paginated on (created_date, id) or (download_count,
+    id): `after` is the cursor of the last book of the previous page,
+    `before` the cursor of the first book of the next one. Each page costs
+    one bounded query.
+    """
+    books = Book.objects.filter(category_id=category_id).only(
+        "id", "file_id", "caption", "created_date", "download_count"
+    )
+    if before is not None:
+        order, key, pk = decode_cursor(before)
+        field = ORDER_FIELDS[order]
+        books = books.filter(
+            Q(**{f"{field}__gt": key}) | Q(**{field: key, "id__gt": pk})
+        ).order_by(field, "id")
+        rows = list(books[:size + 1])
+        return BookPage(rows[:size][::-1], has_prev=len(rows) > size, has_next=True, order=order)
+
+    if after is not None:
+        order, key, pk = decode_cursor(after)
+        field = ORDER_FIELDS[order]
+        books = books.filter(
+            Q(**{f"{field}__lt": key}) | Q(**{field: key, "id__lt": pk})
+        )
+    field = ORDER_FIELDS[order]
+    rows = list(books.order_by(f"-{field}", "-id")[:size + 1])
+    return BookPage(rows[:size], has_prev=after is not None, has_next=len(rows) > size, order=order)
+
+
+def _file_errors(f):
+    errors = []
+    if not f.get("file_id"):
+        errors.append("file_id yo‘q")
+    for field in ("file_id", "file_name"):
+        limit = Book._meta.get_field(field).max_length
+        if len(f.get(field) or "") > limit:
+            errors.append(f"{field} {limit} belgidan uzun")
+    return errors
+
+
+def is_duplicate(file_unique_id):
+    """Whether a book with this Telegram file_unique_id is already stored."""
+    return bool(file_unique_id) and Book.objects.filter(file_unique_id=file_unique_id).exists()
+
+
+def count_books(deltas):
+    """
+    Record books added to or removed from categories: `deltas` maps a
+    category id to the change in its number of books. The stored counters
+    change with the caller's transaction, the in-process tree once it commits.
+    """
+    Category.add_book_counts(deltas)
+    transaction.on_commit(lambda: category_tree.add_books(deltas))
+
+
+def stage_files(user_id, session, category_id, files):
+    """
+    Stage a batch collected by an older version of the bot, which kept the
+    files in the FSM data.
+    """
+    for f in files:
+        # files sent before file_unique_id was recorded fall back to file_id
+        stage_upload(user_id, session, category_id, {
+            **f, "file_unique_id": f.get("file_unique_id") or f.get("file_id") or "",
+        })
+
+
+def stage_upload(user_id, session, category_id, document, media_group_id=None):
+    """
+    Stage one document of an /add_book batch (`document` has file_id,
+    file_unique_id, file_name and caption). Returns (staged, opens_album):
+    False if the batch already has this file, and whether the document is
+    the first one staged from its album.
+    """
+    try:
+        with transaction.atomic():
+            upload = PendingUpload.objects.create(
+                user_id=user_id, session=session, category_id=category_id,
+                media_group_id=media_group_id, file_id=document.get("file_id") or "",
+                file_unique_id=document["file_unique_id"],
+                file_name=document.get("file_name") or "", caption=document.get("caption") or "",
+            )
+    except IntegrityError:
+        return False, False
+    if not media_group_id:
+        return True, False
+    first = PendingUpload.objects.filter(session=session, media_group_id=media_group_id) \
+        .order_by("id").values_list("id", flat=True).first()
+    return True, first == upload.pk
+
+
+def save_uploads(session):
+    """
+    Move a confirmed /add_book batch from the staging table into the
+    catalogue with one INSERT ... SELECT, in one transaction. Staged files
+    the INSERT can't take, or that are already in the catalogue, are
+    returned as (file_name, reason) pairs. Returns (saved books, failures).
+    """
+    now = django_timezone.now()
+    stamp = connection.ops.adapt_datetimefield_value(now)
+    book_table, pending_table = Book._meta.db_table, PendingUpload._meta.db_table
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"""
+                INSERT INTO {book_table}
+                    (category_id, file_id, file_name, caption, file_unique_id,
+                     download_count, created_date, updated_date)
+                SELECT p.category_id, p.file_id, p.file_name, p.caption, p.file_unique_id,
+                    0, %s, %s
+                FROM {pending_table} p
+                WHERE p.session = %s AND p.file_id <> ''
+                    AND LENGTH(p.file_id) <= %s AND LENGTH(p.file_name) <= %s
+                    AND NOT EXISTS (
+                        SELECT 1 FROM {book_table} b WHERE b.file_unique_id = p.file_unique_id
+                    )
+                ORDER BY p.id
+                """,
+                [
+                    stamp, stamp, session,
+                    Book._meta.get_field("file_id").max_length,
+                    Book._meta.get_field("file_name").max_length,
+                ],
+            )
+        staged = PendingUpload.objects.filter(session=session)
+        books = list(Book.objects.filter(
+            created_date=now, file_unique_id__in=staged.values("file_unique_id"),
+        ).order_by("id"))
+        saved = {book.file_unique_id for book in books}
+        failures = [
+            (upload.file_name or "?", "; ".join(_file_errors({
+                "file_id": upload.file_id, "file_name": upload.file_name,
+            })) or "allaqachon mavjud")
+            for upload in staged.order_by("id") if upload.file_unique_id not in saved
+        ]
+        # the INSERT sent no signals
+        count_books(Counter(book.category_id for book in books))
+        staged.delete()
+    return books, failures
+
+
+def discard_uploads(session):
+    PendingUpload.objects.filter(session=session).delete()
+
+
+def purge_stale_uploads(max_age):
+    """Drop the staged files of batches abandoned more than `max_age` seconds ago."""
+    cutoff = django_timezone.now() - timedelta(seconds=max_age)
+    # by the batch's last upload, so a slow batch isn't cut in half
+    abandoned = PendingUpload.objects.values("session").annotate(
+        last=Max("created_date")
+    ).filter(last__lt=cutoff).values_list("session", flat=True)
+    deleted, _ = PendingUpload.objects.filter(session__in=list(abandoned)).delete()
+    return deleted
+
+
+def start_delivery(chat_id, category_id, page):
+    """Record that `page` is about to be sent to `chat_id`, replacing the chat's previous delivery."""
+    with transaction.atomic():
+        # a new row rather than an update: the replaced job's last writes,
+        # keyed by its own id, then miss
+        DeliveryJob.objects.filter(chat_id=chat_id).delete()
+        return DeliveryJob.objects.create(
+            chat_id=chat_id, category_id=category_id,
+            book_ids=",".join(str(book.id) for book in page.books),
+            has_prev=page.has_prev, has_next=page.has_next, order=page.order,
+        )
+
+
+def delivery_progress(job_id, sent):
+    DeliveryJob.objects.filter(pk=job_id).update(sent=sent)
+
+
+def finish_delivery(job_id):
+    DeliveryJob.objects.filter(pk=job_id).delete()
+
+
+def cancel_delivery(chat_id):
+    DeliveryJob.objects.filter(chat_id=chat_id).delete()
+
+
+def pending_deliveries():
+    """Unfinished deliveries, each with the books of its page that still exist."""
+    jobs = list(DeliveryJob.objects.order_by("created_date"))
+    books = Book.objects.only(
+        "id", "file_id", "caption", "created_date", "download_count"
+    ).in_bulk(
+        {pk for job in jobs for pk in job.ids}
+    )
+    return [(job, [books[pk] for pk in job.ids if pk in books]) for job in jobs]
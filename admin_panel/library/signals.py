@@ -0,0 +1,76 @@
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_delete
+from django.dispatch import receiver
+
+from .admins import admin_registry
+from .book_index import book_index
+from .models import Book, Category
+from .search import install_fts
+from .services import count_books
+from .tree import category_tree
+
+
+@receiver(post_save, sender=Category)
+def category_saved(sender, instance, **kwargs):
+    category_tree.upsert(instance.pk, instance.name, instance.parent_id)
+
+
+def deleting_categories(origin):
+    return isinstance(origin, Category) or getattr(origin, 'model', None) is Category
+
+
+@receiver(pre_delete, sender=Category)
+def category_deleting(sender, instance, origin=None, **kwargs):
+    # the whole subtree leaves the ancestors at once; the books deleted
+    # with the category aren't counted one by one (see book_deleting)
+    deleted = origin if isinstance(origin, QuerySet) else None
+    Category.remove_subtree_books(instance.pk, deleted)
+
+
+@receiver(post_delete, sender=Category)
+def category_deleted(sender, instance, **kwargs):
+    # Category.parent is SET_NULL: the orphaned subtrees become top level
+    Category.rebase_descendants(instance.subtree_path, '/')
+    category_tree.remove(instance.pk)
+
+
+@receiver(post_save, sender=Book)
+def book_saved(sender, instance, created, **kwargs):
+    book_index.upsert(instance)
+    old = getattr(instance, '_saved_category_id', None)
+    if created:
+        count_books({instance.category_id: 1})
+    elif old is not None and old != instance.category_id:
+        count_books({old: -1, instance.category_id: 1})
+    instance._saved_category_id = instance.category_id
+
+
+@receiver(pre_delete, sender=Book)
+def book_deleting(sender, instance, origin=None, **kwargs):
+    if deleting_categories(origin):
+        return  # counted by category_deleting
+    # before the row is gone: category_id may be a deferred field
+    count_books({instance.category_id: -1})
+
+
+@receiver(post_delete, sender=Book)
+def book_deleted(sender, instance, **kwargs):
+    book_index.remove(instance.pk)
+
+
+@receiver(post_save, sender=User)
+def user_saved(sender, instance, **kwargs):
+    admin_registry.user_saved(instance)
+
+
+@receiver(post_delete, sender=User)
+def user_deleted(sender, instance, **kwargs):
+    admin_registry.user_deleted(instance)
+
+
+@receiver(post_migrate)
+def ensure_search_index(sender, using, **kwargs):
+    if sender.name == "library":
+        install_fts(connections[using])
@@ -0,0 +1,176 @@
+"""
+Catalogue snapshots: the category tree and the books as JSON Lines,
+gzip-compressed when the file name ends in ``.gz``.
+
+A snapshot is a header line followed by one line per category (parents
+before their children) and one per book. Both directions stream: the
+export reads the tables with ``iterator()`` and the restore inserts one
+batch of lines at a time, so memory stays flat however big the catalogue
+is. Only the categories' paths are kept in memory during a restore.
+"""
+import gzip
+import json
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from .models import Book, Category, DeliveryJob, PendingUpload
+from .search import drop_fts, install_fts
+
+FORMAT = "turon-books"
+VERSION = 1
+
+CATEGORY_FIELDS = ("id", "name", "parent_id", "download_count")
+BOOK_FIELDS = (
+    "id", "category_id", "file_id", "file_name", "caption", "file_unique_id", "sha256",
+    "download_count", "created_date", "updated_date",
+)
+
+
+def open_snapshot(path, mode="r"):
+    """Open a snapshot file for reading ("r") or writing ("w") as text."""
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _write(fp, record):
+    fp.write(json.dumps(record, ensure_ascii=False, default=datetime.isoformat))
+    fp.write("\n")
+
+
+@contextmanager
+def _read_transaction():
+    """
+    A read-only transaction: every query in it sees the database as of its
+    first read, and other connections can keep writing meanwhile.
+    """
+    if connection.in_atomic_block:
+        yield  # the enclosing transaction already reads consistently
+    elif connection.vendor == "sqlite":
+        # not atomic(): the SQLite profile begins those IMMEDIATE, taking
+        # the write lock for the whole export. A deferred transaction that
+        # only reads holds no lock, and WAL gives it its snapshot.
+        with connection.cursor() as cursor:
+            cursor.execute("BEGIN DEFERRED")
+        try:
+            yield
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute("COMMIT")
+    else:
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            yield
+
+
+def export_catalogue(fp, chunk_size=2000):
+    """Write the catalogue to `fp`; returns (categories, books) written."""
+    counts = {"category": 0, "book": 0}
+    # one snapshot for both tables, without blocking the bot's writes
+    with _read_transaction():
+        _write(fp, {"format": FORMAT, "version": VERSION})
+        sources = [
+            ("category", CATEGORY_FIELDS, Category.objects.order_by("depth", "id")),
+            ("book", BOOK_FIELDS, Book.objects.order_by("id")),
+        ]
+        for kind, fields, queryset in sources:
+            rows = queryset.values_list(*fields)
+            for row in rows.iterator(chunk_size=chunk_size):
+                _write(fp, {"type": kind, **dict(zip(fields, row))})
+                counts[kind] += 1
+    return counts["category"], counts["book"]
+
+
+def _insert(cursor, model, fields, rows):
+    table = connection.ops.quote_name(model._meta.db_table)
+    columns = ", ".join(connection.ops.quote_name(field) for field in fields)
+    placeholders = ", ".join(["%s"] * len(fields))
+    cursor.executemany(f"INSERT INTO {table} ({columns}) VALUES ({placeholders})", rows)
+
+
+def _book_row(record):
+    row = [record.get(field) for field in BOOK_FIELDS]
+    for i in (-2, -1):
+        # the exported timestamps, not the auto_now ones bulk_create would set
+        row[i] = connection.ops.adapt_datetimefield_value(datetime.fromisoformat(row[i]))
+    return row
+
+
+def restore_catalogue(fp, batch_size=2000):
+    """
+    Replace the catalogue with the snapshot read from `fp`, in one
+    transaction; returns (categories, books) restored.
+
+    Rows are inserted with one executemany() per batch, ids included; the
+    search index is dropped first and rebuilt once at the end instead of
+    row by row. No signals are sent: a running bot sees the restored
+    catalogue on its next periodic reload. Raises ValueError on a file
+    that isn't a snapshot.
+    """
+    lines = enumerate(fp, 1)
+    try:
+        header = json.loads(next(lines, (1, "null"))[1])
+    except json.JSONDecodeError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise ValueError("not a catalogue snapshot")
+    if header.get("version", 0) > VERSION:
+        raise ValueError(f"snapshot version {header['version']} is newer than this code")
+
+    paths = {}
+    books = 0
+    with transaction.atomic(), connection.cursor() as cursor:
+        drop_fts()
+        DeliveryJob.objects.all().delete()
+        PendingUpload.objects.all().delete()
+        # raw deletes: no per-row signals, and nothing left to cascade to
+        cursor.execute(f"DELETE FROM {Book._meta.db_table}")
+        cursor.execute(f"DELETE FROM {Category._meta.db_table}")
+
+        while batch := list(islice(lines, batch_size)):
+            categories, book_rows = [], []
+            for number, line in batch:
+                try:
+                    record = json.loads(line)
+                    if record["type"] == "category":
+                        parent_id = record["parent_id"]
+                        if parent_id is None:
+                            path = "/"
+                        else:
+                            path = paths[parent_id] + f"{parent_id}/"
+                        paths[record["id"]] = path
+                        categories.append([
+                            record["id"], record["name"], parent_id, path, path.count("/") - 1,
+                            record.get("download_count", 0), 0, 0,
+                        ])
+                    elif record["type"] == "book":
+                        book_rows.append(_book_row(record))
+                    else:
+                        raise ValueError(f"unknown record type {record['type']!r}")
+                except (KeyError, TypeError, ValueError) as e:
+                    raise ValueError(f"line {number}: bad record ({e!r})") from None
+            if categories:
+                _insert(
+                    cursor, Category,
+                    (
+                        "id", "name", "parent_id", "path", "depth", "download_count",
+                        "book_count", "subtree_book_count",
+                    ),
+                    categories,
+                )
+            if book_rows:
+                _insert(cursor, Book, BOOK_FIELDS, book_rows)
+                books += len(book_rows)
+
+        # the ids were given explicitly: move the sequences past them
+        for sql in connection.ops.sequence_reset_sql(no_style(), [Category, Book]):
+            cursor.execute(sql)
+        # the counters start at zero: one GROUP BY fills them
+        Category.recount_books()
+        install_fts()
+    return len(paths), books
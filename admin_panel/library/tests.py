@@ -1,3 +1,1315 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import queue
+import json
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from importlib import import_module
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.utils import exceptions
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .admins import admin_registry
+from .benchmark import FakeBotAPI, percentile
+from .book_index import BookIndex, book_index
+from .db import DatabaseExecutor
+from .delivery import ChatDeliveries, send_books
+from .downloads import FLUSH_BATCH, DownloadCounter
+from .fsm_storage import SQLiteStorage
+from .importer import _JSONStream, file_sha256, iter_catalogue
+from .keyboards import BACK, CONFIRM, CONFIRM_KEYBOARD, KeyboardCache
+from .metrics import (
+    Histogram, _count_query, _instrument_connection, MetricsMiddleware, Registry, handler_seconds, install_db_metrics,
+    sync_to_async, throttled_total, update_db_queries, updates_total,
+)
+from .models import Book, Category, PendingUpload
+from .scheduler import SendScheduler
+from .search import install_fts, search_books
+from .services import (
+    POPULAR, book_page, cancel_delivery, delivery_progress, discard_uploads, encode_cursor, finish_delivery,
+    is_duplicate, pending_deliveries, purge_stale_uploads, save_uploads, stage_files, stage_upload,
+    start_delivery,
+)
+from .throttling import ThrottlingMiddleware, no_throttle
+from .tree import CategoryTree, category_tree
+from .webhook import ChatShardedPool, dispatch_to, update_chat_id
+from .workers import SharedTokenBucket, Supervisor, mp, serve_queue
+
+
+class CategoryTreeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.economics = Category.objects.create(name="Iqtisodiyot")
+        cls.philology = Category.objects.create(name="Filologiya")
+        cls.macro = Category.objects.create(name="Makro", parent=cls.economics)
+        cls.micro = Category.objects.create(name="Mikro", parent=cls.economics)
+
+    def setUp(self):
+        category_tree.load()
+
+    def test_lookups_need_no_queries(self):
+        with self.assertNumQueries(0):
+            top = [c.name for c in category_tree.children(None)]
+            chosen = category_tree.find(None, "Iqtisodiyot")
+            children = [c.name for c in category_tree.children(chosen.id)]
+            parent = category_tree.get(self.macro.id).parent_id
+        self.assertEqual(top, ["Filologiya", "Iqtisodiyot"])
+        self.assertEqual(children, ["Makro", "Mikro"])
+        self.assertEqual(parent, self.economics.id)
+
+    def test_signals_keep_tree_fresh(self):
+        self.micro.name = "Aaa"
+        self.micro.save()
+        Category.objects.create(name="Tarix")
+        names = [c.name for c in category_tree.children(self.economics.id)]
+        self.assertEqual(names, ["Aaa", "Makro"])
+        self.assertIsNotNone(category_tree.find(None, "Tarix"))
+
+        self.economics.delete()
+        self.assertIsNone(category_tree.get(self.economics.id))
+        self.assertIsNone(category_tree.get(self.macro.id).parent_id)
+        self.assertIsNotNone(category_tree.find(None, "Makro"))
+
+    def test_unloaded_tree_ignores_signals(self):
+        tree = CategoryTree()
+        tree.upsert(1, "x", None)
+        self.assertEqual(tree.children(None), ())
+
+
+def add_books(category_id, files, session="test"):
+    """Stage `files` as one /add_book batch and confirm it."""
+    for f in files:
+        stage_upload(1, session, category_id, {"file_unique_id": f["file_id"], **f})
+    return save_uploads(session)
+
+
+class KeyboardCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.economics = Category.objects.create(name="Iqtisodiyot")
+        for name in ("Makro", "Mikro", "Moliya"):
+            Category.objects.create(name=name, parent=cls.economics)
+
+    def setUp(self):
+        category_tree.load()
+        self.keyboards = KeyboardCache(category_tree)
+
+    def test_markup_is_serialized_once(self):
+        markup = self.keyboards.get(self.economics.id, include_back=True)
+        self.assertIs(self.keyboards.get(self.economics.id, include_back=True), markup)
+        rows = [[b["text"] for b in row] for row in json.loads(markup)["keyboard"]]
+        self.assertEqual(rows, [[BACK], ["Makro (0)", "Mikro (0)"], ["Moliya (0)"]])
+
+    def test_category_change_invalidates(self):
+        before = self.keyboards.get(self.economics.id)
+        Category.objects.create(name="Audit", parent=self.economics)
+        after = self.keyboards.get(self.economics.id)
+        self.assertIsNot(before, after)
+        self.assertIn("Audit", after)
+
+    def test_counts_and_empty_branches(self):
+        makro = category_tree.find(self.economics.id, "Makro")
+        with self.captureOnCommitCallbacks(execute=True):
+            add_books(makro.id, [{"file_id": "a", "file_name": "a.pdf"}])
+        readers = json.loads(self.keyboards.get(None, hide_empty=True))["keyboard"]
+        self.assertEqual(readers, [[{"text": "Iqtisodiyot (1)"}]])
+        branch = json.loads(self.keyboards.get(self.economics.id, hide_empty=True))["keyboard"]
+        self.assertEqual(branch, [[{"text": "Makro (1)"}]])
+        # admins still see every category, to add the first book to it
+        self.assertIn("Mikro (0)", self.keyboards.get(self.economics.id))
+
+    def test_choice_ignores_the_count(self):
+        for text in ("Makro (3)", "Makro (0)", "Makro"):
+            self.assertEqual(self.keyboards.choice(self.economics.id, text).name, "Makro")
+        self.assertIsNone(self.keyboards.choice(self.economics.id, "Tarix (1)"))
+
+
+class FakeBot:
+    """Records Bot API calls; `fail` maps a file_id to the error it triggers."""
+
+    def __init__(self, fail=None):
+        self.calls = []
+        self.fail = dict(fail or {})
+
+    def _check(self, file_ids):
+        for file_id in file_ids:
+            error = self.fail.get(file_id)
+            if error is not None:
+                if isinstance(error, exceptions.RetryAfter):
+                    del self.fail[file_id]
+                raise error
+
+    async def send_document(self, chat_id, document, caption=None):
+        self._check([document])
+        self.calls.append(("document", chat_id, [document]))
+
+    async def send_media_group(self, chat_id, media):
+        file_ids = [item.media for item in media.media]
+        self._check(file_ids)
+        self.calls.append(("media_group", chat_id, file_ids))
+
+
+def make_books(count):
+    return [SimpleNamespace(id=i, file_id=f"f{i}", caption="") for i in range(count)]
+
+
+class SendBooksTests(SimpleTestCase):
+    def setUp(self):
+        self.scheduler = SendScheduler(global_rate=10_000, chat_rate=10_000, chat_burst=10_000)
+
+    async def test_books_are_sent_as_albums_of_ten(self):
+        bot = FakeBot()
+        sent = await send_books(bot, self.scheduler, 1, make_books(23))
+        self.assertEqual(sent, 23)
+        self.assertEqual(
+            [(kind, len(ids)) for kind, _, ids in bot.calls],
+            [("media_group", 10), ("media_group", 10), ("media_group", 3)],
+        )
+
+    async def test_retry_after_is_honoured(self):
+        bot = FakeBot(fail={"f0": exceptions.RetryAfter(0)})
+        sent = await send_books(bot, self.scheduler, 1, make_books(2))
+        self.assertEqual(sent, 2)
+        self.assertEqual(len(bot.calls), 1)
+
+    async def test_rejected_album_falls_back_to_single_documents(self):
+        bot = FakeBot(fail={"f3": exceptions.WrongFileIdentifier("wrong file identifier")})
+        with self.assertLogs(level="ERROR"):
+            sent = await send_books(bot, self.scheduler, 1, make_books(5))
+        self.assertEqual(sent, 4)
+        self.assertEqual([kind for kind, _, _ in bot.calls], ["document"] * 4)
+
+    async def test_progress_after_every_album(self):
+        done = []
+
+        async def progress(n, delivered):
+            done.append((n, [book.id for book in delivered]))
+
+        bot = FakeBot(fail={"f3": exceptions.WrongFileIdentifier("wrong file identifier")})
+        with self.assertLogs(level="ERROR"):
+            await send_books(bot, self.scheduler, 1, make_books(13), progress=progress)
+        self.assertEqual(done, [(10, [0, 1, 2, 4, 5, 6, 7, 8, 9]), (13, [10, 11, 12])])
+
+
+class ChatDeliveriesTests(SimpleTestCase):
+    async def test_new_delivery_replaces_the_chat_s_previous_one(self):
+        deliveries = ChatDeliveries()
+        first = deliveries.start(1, asyncio.sleep(10))
+        other = deliveries.start(2, asyncio.sleep(10))
+        second = deliveries.start(1, asyncio.sleep(0))
+        await second
+        await asyncio.sleep(0)
+        self.assertTrue(first.cancelled())
+        self.assertIsNone(deliveries.get(1))
+        self.assertIs(deliveries.get(2), other)
+
+        self.assertTrue(deliveries.cancel(2))
+        self.assertFalse(deliveries.cancel(2))
+        last = deliveries.start(3, asyncio.sleep(10))
+        await deliveries.shutdown()
+        self.assertTrue(other.cancelled())
+        self.assertTrue(last.cancelled())
+
+
+class BookPageTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Iqtisodiyot")
+        Book.objects.bulk_create(
+            Book(category=cls.category, file_id=f"f{i}", file_name=f"{i}.pdf", caption="")
+            for i in range(25)
+        )
+        cls.newest_first = list(Book.objects.order_by("-created_date", "-id"))
+
+    def test_walk_forward_and_back(self):
+        first = book_page(self.category.id, size=10)
+        self.assertEqual(first.books, self.newest_first[:10])
+        self.assertEqual((first.has_prev, first.has_next), (False, True))
+
+        second = book_page(self.category.id, after=encode_cursor(first.books[-1]), size=10)
+        self.assertEqual(second.books, self.newest_first[10:20])
+
+        third = book_page(self.category.id, after=encode_cursor(second.books[-1]), size=10)
+        self.assertEqual(third.books, self.newest_first[20:])
+        self.assertFalse(third.has_next)
+
+        back = book_page(self.category.id, before=encode_cursor(third.books[0]), size=10)
+        self.assertEqual(back.books, second.books)
+        self.assertTrue(back.has_prev)
+
+    def test_one_query_per_page(self):
+        with self.assertNumQueries(1):
+            book_page(self.category.id, after=encode_cursor(self.newest_first[4]))
+
+    def test_walk_most_downloaded(self):
+        books = self.newest_first
+        for i, book in enumerate(books):
+            book.download_count = i % 7
+        Book.objects.bulk_update(books, ["download_count"])
+        popular = sorted(books, key=lambda b: (b.download_count, b.id), reverse=True)
+
+        first = book_page(self.category.id, size=10, order=POPULAR)
+        self.assertEqual(first.books, popular[:10])
+        # the cursor keeps the order without being told again
+        second = book_page(self.category.id, after=encode_cursor(first.books[-1], POPULAR), size=10)
+        self.assertEqual(second.books, popular[10:20])
+        self.assertEqual(second.order, POPULAR)
+        back = book_page(self.category.id, before=encode_cursor(second.books[0], POPULAR), size=10)
+        self.assertEqual(back.books, first.books)
+        self.assertFalse(back.has_prev)
+
+
+class DownloadCounterTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name="Iqtisodiyot")
+        self.books = Book.objects.bulk_create(
+            Book(category=self.category, file_id=f"f{i}", file_name=f"{i}.pdf", caption="")
+            for i in range(3)
+        )
+        self.counter = DownloadCounter()
+
+    def counts(self):
+        return list(Book.objects.order_by("id").values_list("download_count", flat=True))
+
+    def test_flush_adds_to_the_stored_counts(self):
+        ids = [book.id for book in self.books]
+        self.counter.record(self.category.id, ids[:2])
+        self.counter.record(self.category.id, ids[:1])
+        with self.assertNumQueries(4):  # two UPDATEs plus the savepoint
+            self.assertEqual(self.counter.flush(), 3)
+        self.counter.record(self.category.id, ids)
+        self.counter.flush()
+
+        self.assertEqual(self.counts(), [3, 2, 1])
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.download_count, 6)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.counter.flush(), 0)
+
+    def test_batches_fit_sqlites_parameter_limit(self):
+        books = Book.objects.bulk_create(
+            Book(category=self.category, file_id=f"g{i}", file_name=f"g{i}.pdf", caption="")
+            for i in range(FLUSH_BATCH + 1)
+        )
+        self.counter.record(self.category.id, [book.id for book in books])
+        updates = []
+
+        def count_params(execute, sql, params, many, context):
+            if sql.startswith("UPDATE"):
+                updates.append(len(params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_params):
+            self.counter.flush()
+        # two batches of books and one of categories
+        self.assertEqual(len(updates), 3)
+        self.assertLessEqual(max(updates), 999)
+        self.assertEqual(Book.objects.filter(download_count=1).count(), FLUSH_BATCH + 1)
+
+    def test_failed_flush_keeps_the_tallies(self):
+        self.counter.record(self.category.id, [self.books[0].id])
+        with self.assertRaises(ZeroDivisionError):
+            with connection.execute_wrapper(lambda *args: 1 / 0):
+                self.counter.flush()
+        self.counter.flush()
+        self.assertEqual(self.counts(), [1, 0, 0])
+
+    def test_saving_a_book_keeps_its_downloads(self):
+        book = Book.objects.get(pk=self.books[0].pk)
+        self.counter.record(self.category.id, [book.id])
+        self.counter.flush()
+        book.caption = "Yangi"
+        book.save()
+        self.assertEqual(self.counts()[0], 1)
+
+
+class UploadStagingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Filologiya")
+
+    def stage(self, session, name, album=None, **fields):
+        document = {"file_id": f"id-{name}", "file_unique_id": f"u-{name}", "file_name": name}
+        document.update(fields)
+        return stage_upload(1, session, self.category.id, document, album)
+
+    def test_album_is_staged_once_per_file(self):
+        self.assertEqual(self.stage("s", "a.pdf", album="g"), (True, True))
+        self.assertEqual(self.stage("s", "b.pdf", album="g"), (True, False))
+        self.assertEqual(self.stage("s", "a.pdf", album="g"), (False, False))
+        self.assertEqual(self.stage("s", "c.pdf"), (True, False))
+        # another batch may stage the same file
+        self.assertEqual(self.stage("t", "a.pdf"), (True, False))
+
+    def test_confirmed_batch_is_saved_in_one_insert(self):
+        Book.objects.create(category=self.category, file_id="x", file_name="", caption="",
+                            file_unique_id="u-old.pdf")
+        for i in range(300):
+            self.stage("s", f"{i}.pdf", album=f"g{i // 10}")
+        self.stage("s", "old.pdf")
+        self.stage("s", "empty.pdf", file_id="")
+        self.stage("s", "n" * 600, file_id="long")
+        self.stage("t", "other.pdf")
+
+        # the same few statements (savepoint included) whatever the batch size
+        with self.assertNumQueries(8):
+            books, failures = save_uploads("s")
+
+        self.assertEqual([book.file_name for book in books], [f"{i}.pdf" for i in range(300)])
+        self.assertEqual(
+            [(name[:10], reason) for name, reason in failures],
+            [("old.pdf", "allaqachon mavjud"), ("empty.pdf", "file_id yo‘q"),
+             ("n" * 10, "file_name 512 belgidan uzun")],
+        )
+        self.category.refresh_from_db()
+        self.assertEqual(self.category.book_count, 301)
+        self.assertEqual(PendingUpload.objects.filter(session="s").count(), 0)
+        self.assertEqual(PendingUpload.objects.filter(session="t").count(), 1)
+
+    def test_batch_kept_in_fsm_data_is_staged(self):
+        stage_files(1, "s", self.category.id, [
+            {"file_id": "a", "file_unique_id": "u-a", "file_name": "a.pdf", "caption": ""},
+            {"file_id": "b", "file_name": "b.pdf", "caption": "B"},
+        ])
+        books, failures = save_uploads("s")
+        self.assertEqual([(b.file_id, b.file_unique_id) for b in books], [("a", "u-a"), ("b", "b")])
+        self.assertEqual(failures, [])
+
+    def test_abandoned_batches_are_purged(self):
+        self.stage("old", "a.pdf")
+        self.stage("old", "b.pdf")
+        self.stage("new", "a.pdf")
+        PendingUpload.objects.filter(session="old").update(
+            created_date=timezone.now() - timedelta(days=2)
+        )
+        self.assertEqual(purge_stale_uploads(24 * 3600), 2)
+        self.assertEqual(list(PendingUpload.objects.values_list("session", flat=True)), ["new"])
+        discard_uploads("new")
+        self.assertFalse(PendingUpload.objects.exists())
+
+
+class DeliveryJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Iqtisodiyot")
+        Book.objects.bulk_create(
+            Book(category=cls.category, file_id=f"f{i}", file_name=f"{i}.pdf", caption="")
+            for i in range(5)
+        )
+
+    def test_unfinished_delivery_is_resumable(self):
+        page = book_page(self.category.id, size=3)
+        job = start_delivery(7, self.category.id, page)
+        delivery_progress(job.pk, 2)
+        ids = [book.id for book in page.books]
+        page.books[0].delete()
+
+        [(pending, books)] = pending_deliveries()
+        self.assertEqual((pending.chat_id, pending.sent), (7, 2))
+        self.assertEqual(pending.ids, ids)
+        self.assertEqual(books, page.books[1:])
+        self.assertTrue(pending.has_next)
+
+    def test_new_delivery_replaces_the_old_one(self):
+        old = start_delivery(7, self.category.id, book_page(self.category.id, size=2))
+        new = start_delivery(7, self.category.id, book_page(self.category.id, size=2))
+        # the replaced job's late writes don't touch the new one
+        delivery_progress(old.pk, 2)
+        finish_delivery(old.pk)
+        self.assertEqual([(job.pk, job.sent) for job, _ in pending_deliveries()], [(new.pk, 0)])
+        cancel_delivery(7)
+        self.assertEqual(pending_deliveries(), [])
+
+
+class AdminRegistryTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create(username="admin", first_name="757652114")
+        User.objects.create(username="staff", first_name="")
+        admin_registry.load()
+
+    def test_membership_needs_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertIn(757652114, admin_registry)
+            self.assertNotIn(1, admin_registry)
+
+    def test_signals_update_the_allow_list(self):
+        User.objects.create(username="new", first_name=" 42 ")
+        self.assertIn(42, admin_registry)
+
+        self.admin.first_name = "43"
+        self.admin.save()
+        self.assertNotIn(757652114, admin_registry)
+        self.assertIn(43, admin_registry)
+
+        self.admin.delete()
+        self.assertNotIn(43, admin_registry)
+
+
+class SQLiteStorageTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = Path(tmp.name) / "fsm.sqlite3"
+
+    async def test_state_survives_restart(self):
+        storage = SQLiteStorage(self.path)
+        await storage.set_state(chat=1, user=1, state="BookStates:CHOOSING")
+        await storage.update_data(chat=1, user=1, parent_id=7)
+        await storage.update_data(chat=1, user=1, files=[{"file_id": "x" * 40}] * 50)
+        await storage.close()
+
+        storage = SQLiteStorage(self.path)
+        self.assertEqual(await storage.get_state(chat=1, user=1), "BookStates:CHOOSING")
+        data = await storage.get_data(chat=1, user=1)
+        self.assertEqual(data["parent_id"], 7)
+        self.assertEqual(len(data["files"]), 50)
+        await storage.finish(chat=1, user=1)
+        await storage.close()
+
+        storage = SQLiteStorage(self.path)
+        self.assertIsNone(await storage.get_state(chat=1, user=1))
+        await storage.close()
+
+    async def test_cache_is_bounded(self):
+        storage = SQLiteStorage(self.path, cache_size=10)
+        for chat in range(100):
+            await storage.update_data(chat=chat, user=chat, parent_id=chat)
+        await storage.flush()
+        self.assertLessEqual(len(storage._cache), 10)
+        self.assertEqual(await storage.get_data(chat=3, user=3), {"parent_id": 3})
+        await storage.close()
+
+    async def test_cache_miss_does_not_wait_for_a_flush(self):
+        storage = SQLiteStorage(self.path, cache_size=1)
+        await storage.update_data(chat=1, user=1, parent_id=1)
+        await storage.flush()
+        await storage.update_data(chat=2, user=2, parent_id=2)
+        await storage.flush()
+        self.assertNotIn(("1", "1"), storage._cache)
+
+        # a flush in the middle of its write transaction
+        with storage._db_lock:
+            storage._db.execute("BEGIN IMMEDIATE")
+            storage._db.execute("DELETE FROM fsm")
+            data = await asyncio.wait_for(storage.get_data(chat=1, user=1), 1)
+            storage._db.execute("ROLLBACK")
+        self.assertEqual(data, {"parent_id": 1})
+        await storage.close()
+
+    async def test_idle_sessions_expire(self):
+        storage = SQLiteStorage(self.path, ttl=0.01)
+        await storage.set_state(chat=1, user=1, state="AddBookStates:WAIT_FILE")
+        await asyncio.sleep(0.02)
+        self.assertIsNone(await storage.get_state(chat=1, user=1))
+        await storage.close()
+
+
+def make_update(update_id, chat_id, text="/start"):
+    return types.Update(**{
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": 0, "text": text,
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": chat_id, "is_bot": False, "first_name": "u"},
+        },
+    })
+
+
+class ChatShardedPoolTests(SimpleTestCase):
+    def test_update_chat_id(self):
+        self.assertEqual(update_chat_id(make_update(1, 42)), 42)
+        query = types.Update(**{"update_id": 2, "inline_query": {
+            "id": "q", "query": "", "offset": "",
+            "from": {"id": 7, "is_bot": False, "first_name": "u"},
+        }})
+        self.assertEqual(update_chat_id(query), 7)
+
+    async def test_chats_run_concurrently_in_order(self):
+        handled = []
+
+        async def handler(update):
+            await asyncio.sleep(0.01 if update.update_id % 2 else 0)
+            handled.append((update.message.chat.id, update.update_id))
+
+        pool = ChatShardedPool(handler, workers=4)
+        pool.start()
+        for update_id in range(40):
+            await pool.submit(make_update(update_id, chat_id=update_id % 4))
+        await pool.stop()
+
+        self.assertEqual(len(handled), 40)
+        for chat_id in range(4):
+            ids = [u for c, u in handled if c == chat_id]
+            self.assertEqual(ids, sorted(ids))
+
+    async def test_worker_sees_state_set_by_previous_update(self):
+        dp = Dispatcher(Bot(token="123456:" + "A" * 35), storage=MemoryStorage())
+        seen = []
+
+        @dp.message_handler(state=None)
+        async def first(message, state):
+            seen.append("first")
+            await state.set_state("second")
+
+        @dp.message_handler(state="second")
+        async def second(message, state):
+            seen.append("second")
+
+        handle = dispatch_to(dp)
+        await handle(make_update(1, 5, text="a"))
+        await handle(make_update(2, 5, text="b"))
+
+        self.assertEqual(seen, ["first", "second"])
+
+
+class SearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name="Iqtisodiyot")
+        cls.macro = Book.objects.create(
+            category=category, file_id="a", file_name="makroiqtisodiyot.pdf",
+            caption="Makroiqtisodiyot asoslari",
+        )
+        Book.objects.bulk_create([
+            Book(category=category, file_id="b", file_name="adabiyot.pdf", caption="Adabiyot nazariyasi"),
+            Book(category=category, file_id="c", file_name="moliya.pdf", caption="Moliya va kredit"),
+        ])
+
+    def test_prefix_search_sees_bulk_inserts(self):
+        self.assertEqual([b.file_id for b in search_books("adab")], ["b"])
+        self.assertEqual([b.file_id for b in search_books("makroiqt asos")], ["a"])
+        self.assertEqual(search_books("  ?! "), [])
+
+    def test_index_follows_updates_and_deletes(self):
+        self.macro.caption = "Statistika"
+        self.macro.save()
+        self.assertEqual([b.file_id for b in search_books("statis")], ["a"])
+        self.macro.delete()
+        self.assertEqual(search_books("statis"), [])
+
+    def test_install_is_idempotent(self):
+        install_fts()
+        self.assertEqual(len(search_books("moliya")), 1)
+
+    def test_admin_search_uses_index(self):
+        user = User.objects.create_superuser("root", password="x")
+        self.client.force_login(user)
+        response = self.client.get("/admin/library/book/", {"q": "nazar"})
+        self.assertContains(response, "adabiyot.pdf")
+        self.assertNotContains(response, "moliya.pdf")
+
+
+class AdminQueryBudgetTests(TestCase):
+    """Changelists must cost a fixed number of queries, whatever the row count."""
+
+    BUDGET = 12
+
+    def setUp(self):
+        self.client.force_login(User.objects.create_superuser("root", password="x"))
+
+    def add_rows(self, count):
+        start = Category.objects.count()
+        for i in range(start, start + count):
+            top = Category.objects.create(name=f"top{i}")
+            middle = Category.objects.create(name=f"mid{i}", parent=top)
+            leaf = Category.objects.create(name=f"leaf{i}", parent=middle)
+            Book.objects.bulk_create(
+                Book(category=leaf, file_id=f"{i}-{j}", file_name=f"{i}-{j}.pdf", caption="")
+                for j in range(3)
+            )
+
+    def count_queries(self, url, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx)
+
+    def assert_flat(self, url, **params):
+        self.add_rows(3)
+        few = self.count_queries(url, **params)
+        self.add_rows(30)
+        many = self.count_queries(url, **params)
+        self.assertEqual(few, many)
+        self.assertLessEqual(many, self.BUDGET)
+
+    def test_category_changelist(self):
+        self.assert_flat("/admin/library/category/")
+
+    def test_category_changelist_sorted_by_book_count(self):
+        self.assert_flat("/admin/library/category/", o="4", level="leaf")
+
+    def test_book_changelist(self):
+        self.assert_flat("/admin/library/book/")
+
+    def test_most_downloaded_changelist(self):
+        self.assert_flat("/admin/library/popularbook/")
+
+
+class CategoryPathTests(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(name="Iqtisodiyot")
+        self.branch = Category.objects.create(name="Nazariya", parent=self.root)
+        self.leaf = Category.objects.create(name="Makro", parent=self.branch)
+        self.other = Category.objects.create(name="Filologiya")
+
+    def reload(self, *categories):
+        for category in categories:
+            category.refresh_from_db()
+
+    def test_paths_on_create(self):
+        self.assertEqual(self.leaf.path, f"/{self.root.id}/{self.branch.id}/")
+        self.assertEqual(self.leaf.depth, 2)
+        self.assertEqual(list(self.leaf.ancestors()), [self.root, self.branch])
+        self.assertEqual(set(self.root.descendants()), {self.branch, self.leaf})
+
+    def test_move_rebases_subtree(self):
+        self.branch.parent = self.other
+        self.branch.save()
+        self.reload(self.leaf)
+        self.assertEqual(self.leaf.path, f"/{self.other.id}/{self.branch.id}/")
+        self.assertEqual(list(self.root.descendants()), [])
+
+        self.branch.parent = None
+        self.branch.save()
+        self.reload(self.leaf)
+        self.assertEqual((self.leaf.path, self.leaf.depth), (f"/{self.branch.id}/", 1))
+
+    def test_delete_promotes_orphans(self):
+        self.root.delete()
+        self.reload(self.branch, self.leaf)
+        self.assertEqual((self.branch.path, self.branch.depth), ("/", 0))
+        self.assertEqual((self.leaf.path, self.leaf.depth), (f"/{self.branch.id}/", 1))
+
+    def test_subtree_books_is_one_query(self):
+        Book.objects.create(category=self.leaf, file_id="a", file_name="a.pdf", caption="")
+        Book.objects.create(category=self.root, file_id="b", file_name="b.pdf", caption="")
+        Book.objects.create(category=self.other, file_id="c", file_name="c.pdf", caption="")
+        with self.assertNumQueries(1):
+            ids = sorted(b.file_id for b in self.root.subtree_books())
+        self.assertEqual(ids, ["a", "b"])
+
+    def test_cannot_move_under_own_descendant(self):
+        self.root.parent = self.leaf
+        with self.assertRaises(ValidationError):
+            self.root.full_clean()
+
+    def test_sibling_names_are_unique(self):
+        with self.assertRaises(IntegrityError):
+            Category.objects.create(name="Filologiya")
+
+
+class BookCounterTests(TestCase):
+    def setUp(self):
+        self.root = Category.objects.create(name="Iqtisodiyot")
+        self.branch = Category.objects.create(name="Nazariya", parent=self.root)
+        self.leaf = Category.objects.create(name="Makro", parent=self.branch)
+        self.other = Category.objects.create(name="Filologiya")
+
+    def add_book(self, category, file_id):
+        return Book.objects.create(category=category, file_id=file_id, file_name="", caption="")
+
+    def assertCounts(self, category, own, subtree):
+        category.refresh_from_db()
+        self.assertEqual((category.book_count, category.subtree_book_count), (own, subtree))
+
+    def test_create_move_and_delete(self):
+        book = self.add_book(self.leaf, "a")
+        self.add_book(self.root, "b")
+        self.assertCounts(self.leaf, 1, 1)
+        self.assertCounts(self.branch, 0, 1)
+        self.assertCounts(self.root, 1, 2)
+
+        book = Book.objects.get(pk=book.pk)
+        book.category = self.other
+        book.save()
+        self.assertCounts(self.root, 1, 1)
+        self.assertCounts(self.other, 1, 1)
+
+        book.delete()
+        self.assertCounts(self.other, 0, 0)
+
+    def test_confirmed_batch_is_counted(self):
+        add_books(self.leaf.id, [{"file_id": f"f{i}", "file_name": f"{i}.pdf"} for i in range(3)])
+        self.assertCounts(self.leaf, 3, 3)
+        self.assertCounts(self.root, 0, 3)
+
+    def test_moving_a_category_moves_its_books(self):
+        self.add_book(self.leaf, "a")
+        self.add_book(self.branch, "b")
+        self.branch.parent = self.other
+        self.branch.save()
+        self.assertCounts(self.root, 0, 0)
+        self.assertCounts(self.other, 0, 2)
+        self.assertCounts(self.branch, 1, 2)
+
+    def test_deleting_a_category_drops_its_subtree_from_ancestors(self):
+        self.add_book(self.leaf, "a")
+        self.add_book(self.branch, "b")
+        self.branch.delete()
+        self.assertCounts(self.root, 0, 0)
+        self.assertCounts(self.leaf, 1, 1)
+
+    def test_deleting_a_category_costs_the_same_for_any_number_of_books(self):
+        def delete_with_books(name, count):
+            category = Category.objects.create(name=name, parent=self.leaf)
+            add_books(category.id, [
+                {"file_id": f"{name}{i}", "file_name": f"{i}.pdf"} for i in range(count)
+            ])
+            with CaptureQueriesContext(connection) as ctx:
+                category.delete()
+            return len(ctx)
+
+        self.assertEqual(delete_with_books("few", 2), delete_with_books("many", 20))
+        self.assertCounts(self.root, 0, 0)
+        self.assertCounts(self.leaf, 0, 0)
+
+    def test_bulk_delete_counts_each_book_once(self):
+        # root > branch > leaf > deep, with root and leaf deleted together
+        deep = Category.objects.create(name="Chuqur", parent=self.leaf)
+        self.add_book(self.leaf, "a")
+        self.add_book(deep, "b")
+        self.add_book(self.branch, "c")
+        Category.objects.filter(pk__in=[self.root.pk, self.leaf.pk]).delete()
+        self.assertCounts(self.branch, 1, 1)
+        self.assertCounts(deep, 1, 1)
+        self.assertEqual(Category.recount_books(), [])
+
+    def test_stale_instance_does_not_overwrite_counts(self):
+        stale = Category.objects.get(pk=self.leaf.pk)
+        self.add_book(self.leaf, "a")
+        stale.name = "Makroiqtisodiyot"
+        stale.save()
+        self.assertCounts(self.leaf, 1, 1)
+
+    def test_recount_repairs_drift(self):
+        self.add_book(self.leaf, "a")
+        Category.objects.update(book_count=7, subtree_book_count=0)
+        out = io.StringIO()
+        call_command("recount_books", stdout=out)
+        self.assertIn("Fixed 4 categories", out.getvalue())
+        self.assertCounts(self.leaf, 1, 1)
+        self.assertCounts(self.root, 0, 1)
+        self.assertEqual(Category.recount_books(), [])
+
+
+class FakeUploader:
+    """Uploader that hands out made-up file_ids and remembers what it uploaded."""
+
+    uploaded = []
+
+    def __init__(self, **kwargs):
+        pass
+
+    async def upload(self, path):
+        FakeUploader.uploaded.append(Path(path).name)
+        return f"id-{Path(path).name}", f"unique-{Path(path).name}"
+
+    async def close(self):
+        pass
+
+
+class ImportBooksTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        for name in ("a.pdf", "b.pdf", "c.pdf"):
+            (self.root / name).write_bytes(f"%PDF {name}".encode())
+        self.catalogue = self.root / "books.json"
+        self.catalogue.write_text(json.dumps({
+            "Iqtisodiyot": {
+                "Makro": [{"title": "A", "file": "a.pdf"}, {"title": "B", "file": "b.pdf"}],
+            },
+            "Filologiya": [{"title": "C", "file": "c.pdf"}, {"title": "D", "file": "missing.pdf"}],
+        }))
+        FakeUploader.uploaded = []
+
+    def run_import(self):
+        call_command(
+            "import_books", str(self.catalogue), books_dir=str(self.root),
+            uploader="library.tests.FakeUploader", chunk_size=2, stdout=io.StringIO(),
+        )
+
+    def test_import_builds_hierarchy_and_resumes(self):
+        self.run_import()
+        macro = Category.objects.get(name="Makro")
+        self.assertEqual(macro.parent.name, "Iqtisodiyot")
+        self.assertEqual(
+            sorted(macro.books.values_list("file_id", "caption")),
+            [("id-a.pdf", "A"), ("id-b.pdf", "B")],
+        )
+        self.assertEqual(Book.objects.count(), 3)
+
+        self.run_import()
+        self.assertEqual(Book.objects.count(), 3)
+        self.assertEqual(sorted(FakeUploader.uploaded), ["a.pdf", "b.pdf", "c.pdf"])
+
+    def test_same_content_is_uploaded_once(self):
+        (self.root / "copy.pdf").write_bytes(b"%PDF a.pdf")
+        self.catalogue.write_text(json.dumps({
+            "Iqtisodiyot": [{"title": "A", "file": "a.pdf"}],
+            "Nusxa": [{"title": "A again", "file": "copy.pdf"}],
+        }))
+        self.run_import()
+        self.assertEqual(FakeUploader.uploaded, ["a.pdf"])
+        self.assertEqual(Book.objects.get().sha256, file_sha256(self.root / "a.pdf"))
+
+    def test_malformed_entries_are_skipped(self):
+        self.catalogue.write_text(json.dumps({
+            "Iqtisodiyot": [{"title": "no file"}, "a.pdf", {"title": "B", "file": "b.pdf"}],
+        }))
+        out = io.StringIO()
+        with self.assertLogs("library.importer", "WARNING"):
+            call_command(
+                "import_books", str(self.catalogue), books_dir=str(self.root),
+                uploader="library.tests.FakeUploader", stdout=out,
+            )
+        self.assertEqual(FakeUploader.uploaded, ["b.pdf"])
+        self.assertIn("invalid entries 2", out.getvalue())
+
+
+class IterCatalogueTests(SimpleTestCase):
+    catalogue = {
+        "Iqtisodiyot": {
+            "Makro": [{"title": "A", "file": "a.pdf", "n": 12345}, {"title": "B \u00bb\\", "file": "b.pdf"}],
+            "Bo'sh": [],
+            "Ichki": {},
+        },
+        "Filologiya": [{"title": "C", "file": "c.pdf"}],
+        "Raqam": [1, 23456, True],
+    }
+
+    def flatten(self, value, path=()):
+        for name, child in value.items():
+            if isinstance(child, dict):
+                yield from self.flatten(child, (*path, name))
+            else:
+                yield from (((*path, name), book) for book in child)
+
+    def test_matches_json_loads_at_any_chunk_size(self):
+        text = json.dumps(self.catalogue, indent=1)
+        expected = list(self.flatten(json.loads(text)))
+        for chunk_size in (1, 2, 3, 7, 64, 64 * 1024):
+            with self.subTest(chunk_size=chunk_size):
+                self.assertEqual(list(iter_catalogue(io.StringIO(text), chunk_size)), expected)
+
+    def test_buffer_holds_about_one_chunk(self):
+        books = [{"title": f"Kitob {i}", "file": f"{i}.pdf"} for i in range(20000)]
+        stream = _JSONStream(io.StringIO(json.dumps(books)), 1024)
+        stream.expect("[")
+        decoded = []
+        while True:
+            decoded.append(stream.value())
+            self.assertLess(len(stream.buf), 3 * 1024)
+            if stream.expect(",]") == "]":
+                break
+        self.assertEqual(decoded, books)
+
+    def test_rejects_a_catalogue_that_is_not_an_object(self):
+        with self.assertRaises(ValueError):
+            list(iter_catalogue(io.StringIO('[{"file": "a.pdf"}]')))
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = str(Path(tmp.name) / "catalogue.jsonl.gz")
+        top = Category.objects.create(name="Iqtisodiyot")
+        self.leaf = Category.objects.create(name="Makro", parent=top)
+        Category.objects.create(name="Filologiya")
+        add_books(self.leaf.id, [
+            {"file_id": f"f{i}", "file_name": f"makro{i}.pdf", "caption": f"Makroiqtisodiyot {i}"}
+            for i in range(5)
+        ])
+        Book.objects.filter(file_id="f3").update(download_count=7)
+
+    def dump(self):
+        return (
+            list(Category.objects.order_by("id").values()),
+            list(Book.objects.order_by("id").values()),
+        )
+
+    def test_round_trip(self):
+        before = self.dump()
+        call_command("export_books", self.path, chunk_size=2, stdout=io.StringIO())
+        call_command("restore_books", self.path, replace=True, batch_size=3, stdout=io.StringIO())
+
+        self.assertEqual(self.dump(), before)
+        self.assertEqual(Category.objects.get(pk=self.leaf.pk).subtree_book_count, 5)
+        self.assertEqual(len(search_books("makroiqt")), 5)
+        new = Book.objects.create(category=self.leaf, file_id="new", file_name="new.pdf", caption="")
+        self.assertGreater(new.pk, max(book["id"] for book in before[1]))
+
+    def test_refuses_to_overwrite_or_read_garbage(self):
+        call_command("export_books", self.path, stdout=io.StringIO())
+        with self.assertRaises(CommandError):
+            call_command("restore_books", self.path, stdout=io.StringIO())
+
+        broken = self.path.replace(".gz", "")
+        with open(broken, "w") as fp:
+            fp.write('{"format": "turon-books", "version": 1}\n{"type": "book", "id": 1}\n')
+        before = self.dump()
+        with self.assertRaises(CommandError):
+            call_command("restore_books", broken, replace=True, stdout=io.StringIO())
+        self.assertEqual(self.dump(), before)
+
+
+class DuplicateUploadTests(TestCase):
+    def test_known_files_are_skipped_on_confirmation(self):
+        category = Category.objects.create(name="Filologiya")
+        Book.objects.create(
+            category=category, file_id="old", file_unique_id="u1", file_name="a.pdf", caption=""
+        )
+        files = [
+            {"file_id": "a", "file_unique_id": "u1", "file_name": "a.pdf", "caption": ""},
+            {"file_id": "b", "file_unique_id": "u2", "file_name": "b.pdf", "caption": ""},
+        ]
+        books, failures = add_books(category.id, files)
+        self.assertEqual([b.file_id for b in books], ["b"])
+        self.assertEqual([name for name, _ in failures], ["a.pdf"])
+        self.assertTrue(is_duplicate("u2"))
+        self.assertFalse(is_duplicate(""))
+
+
+class MetricsTests(TestCase):
+    def test_render_text_format(self):
+        registry = Registry()
+        calls = registry.counter("calls_total", "Calls.", ("method",))
+        latency = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1))
+        calls.inc('send"Document')
+        latency.observe(0.5)
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP calls_total Calls.",
+            "# TYPE calls_total counter",
+            'calls_total{method="send\\"Document"} 1',
+            "# HELP latency_seconds Latency.",
+            "# TYPE latency_seconds histogram",
+            'latency_seconds_bucket{le="0.1"} 0',
+            'latency_seconds_bucket{le="1"} 1',
+            'latency_seconds_bucket{le="+Inf"} 1',
+            "latency_seconds_sum 0.5",
+            "latency_seconds_count 1",
+        ])
+
+    def test_histogram_bucket_edges(self):
+        histogram = Histogram("h", "h", buckets=(1, 2))
+        for value in (1, 2, 3):
+            histogram.observe(value)
+        self.assertIn('h_bucket{le="1"} 1', list(histogram.samples()))
+
+    async def test_middleware_records_handlers_and_queries(self):
+        install_db_metrics()
+        _instrument_connection(None, connection)
+        self.addCleanup(connection.execute_wrappers.remove, _count_query)
+
+        bot = Bot(token="123456:" + "A" * 35)
+        dp = Dispatcher(bot)
+        dp.middleware.setup(MetricsMiddleware())
+
+        async def list_categories(message):
+            await sync_to_async(list)(Category.objects.all())
+            await sync_to_async(list)(Category.objects.all())
+
+        dp.register_message_handler(list_categories)
+        Dispatcher.set_current(dp)
+        handled = handler_seconds.count("list_categories")
+        per_update = update_db_queries.count()
+
+        await dp.process_update(make_update(1, 1))
+
+        self.assertEqual(handler_seconds.count("list_categories"), handled + 1)
+        self.assertGreaterEqual(updates_total.value("list_categories", "-"), 1)
+        self.assertEqual(update_db_queries.count(), per_update + 1)
+
+
+class ThrottlingTests(SimpleTestCase):
+    async def test_rate_and_repeats_per_user_and_handler(self):
+        api = FakeBotAPI()
+        url = await api.start()
+        bot = Bot(token="123456:" + "A" * 35, server=TelegramAPIServer.from_base(url))
+        dp = Dispatcher(bot)
+        dp.middleware.setup(ThrottlingMiddleware(
+            rate=0.001, burst=3, repeat_window=60, repeatable={BACK},
+        ))
+        handled = []
+
+        async def echo(message):
+            handled.append((message.chat.id, message.text))
+
+        @no_throttle
+        async def upload(message):
+            handled.append("upload")
+
+        dp.register_message_handler(upload, commands=["upload"])
+        dp.register_message_handler(echo)
+        Dispatcher.set_current(dp)
+        Bot.set_current(bot)
+        repeats, limited = throttled_total.value("echo", "repeat"), throttled_total.value("echo", "rate")
+
+        texts = [(1, "a"), (1, "a"), (1, BACK), (1, BACK), (1, "b"), (1, "c"), (2, "a")]
+        texts += [(1, "/upload")] * 5
+        try:
+            for update_id, (chat_id, text) in enumerate(texts):
+                await dp.process_update(make_update(update_id, chat_id, text))
+        finally:
+            await (await bot.get_session()).close()
+            await api.stop()
+
+        self.assertEqual(handled, [(1, "a"), (1, BACK), (1, BACK), (2, "a")] + ["upload"] * 5)
+        self.assertEqual(throttled_total.value("echo", "repeat"), repeats + 1)
+        self.assertEqual(throttled_total.value("echo", "rate"), limited + 2)
+        # one "please wait" per run of dropped updates
+        self.assertEqual([method for method, _ in api.take(1)], ["sendMessage"] * 2)
+
+
+class FakeBotAPITests(SimpleTestCase):
+    async def call(self, api, method, *args, **kwargs):
+        url = await api.start()
+        bot = Bot(token="123456:" + "A" * 35, server=TelegramAPIServer.from_base(url))
+        try:
+            return await getattr(bot, method)(*args, **kwargs)
+        finally:
+            await (await bot.get_session()).close()
+            await api.stop()
+
+    async def test_records_calls_per_chat(self):
+        api = FakeBotAPI()
+        message = await self.call(api, "send_message", 5, "salom", reply_markup=CONFIRM_KEYBOARD)
+
+        self.assertEqual(message.chat.id, 5)
+        [(method, params)] = api.take(5)
+        self.assertEqual(method, "sendMessage")
+        self.assertEqual(params["reply_markup"]["keyboard"][0][0]["text"], CONFIRM)
+        self.assertEqual(api.take(5), [])
+
+    async def test_injects_retry_after(self):
+        api = FakeBotAPI(retry_after_rate=1.0)
+        with self.assertRaises(exceptions.RetryAfter):
+            await self.call(api, "send_message", 5, "salom")
+        self.assertEqual(api.retry_afters, 1)
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertIsNone(percentile([], 50))
+
+
+class DatabaseExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.db = DatabaseExecutor(threads=4)
+        self.addCleanup(self.db.shutdown)
+
+    async def test_calls_run_concurrently(self):
+        barrier = threading.Barrier(4, timeout=5)
+        # each call only returns once all four are running at the same time
+        results = await asyncio.gather(*(self.db.run(barrier.wait) for _ in range(4)))
+        self.assertEqual(sorted(results), [0, 1, 2, 3])
+
+    async def test_identical_calls_in_flight_are_coalesced(self):
+        calls = []
+
+        def lookup(key, page=0):
+            calls.append((key, page))
+            time.sleep(0.05)
+            return [key, page]
+
+        first, second, other = await asyncio.gather(
+            self.db.coalesce(lookup, "a", page=1),
+            self.db.coalesce(lookup, "a", page=1),
+            self.db.coalesce(lookup, "a", page=2),
+        )
+        self.assertIs(first, second)
+        self.assertEqual(other, ["a", 2])
+        self.assertEqual(sorted(calls), [("a", 1), ("a", 2)])
+
+        await self.db.coalesce(lookup, "a", page=1)
+        self.assertEqual(len(calls), 3)
+
+    async def test_errors_reach_every_caller(self):
+        def fail():
+            time.sleep(0.01)
+            raise ValueError("boom")
+
+        results = await asyncio.gather(
+            self.db.coalesce(fail), self.db.coalesce(fail), return_exceptions=True
+        )
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+
+
+class DatabaseProfileTests(SimpleTestCase):
+    def connect(self, path):
+        from django.db.backends.sqlite3.base import DatabaseWrapper
+
+        wrapper = DatabaseWrapper({**connection.settings_dict, "NAME": path}, alias="profile")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_reads_are_not_blocked_by_a_writer(self):
+        if connection.vendor != "sqlite":
+            self.skipTest("SQLite profile")
+        path = str(Path(self.enterContext(tempfile.TemporaryDirectory())) / "db.sqlite3")
+        writer, reader = self.connect(path), self.connect(path)
+        with writer.cursor() as cursor:
+            self.assertEqual(cursor.execute("PRAGMA journal_mode").fetchone(), ("wal",))
+            self.assertEqual(cursor.execute("PRAGMA synchronous").fetchone(), (1,))
+            cursor.execute("CREATE TABLE t (x INTEGER)")
+            cursor.execute("INSERT INTO t VALUES (1)")
+
+        writer.connection.execute("BEGIN IMMEDIATE")
+        writer.connection.execute("INSERT INTO t VALUES (2)")
+        # the write transaction is still open
+        with reader.cursor() as cursor:
+            self.assertEqual(cursor.execute("SELECT count(*) FROM t").fetchone(), (1,))
+        writer.connection.rollback()
+
+
+class WorkerTests(SimpleTestCase):
+    def test_shared_bucket_is_shared_with_worker_processes(self):
+        bucket = SharedTokenBucket(rate=1, capacity=5)
+        # the whole budget is spent in another process
+        process = mp.Process(target=bucket.reserve, args=(5,))
+        process.start()
+        process.join(30)
+        self.assertEqual(process.exitcode, 0)
+        self.assertGreater(bucket.reserve(1), 0.5)
+
+    def test_chats_stick_to_one_worker(self):
+        supervisor = Supervisor(None, workers=3)
+        workers = {supervisor.worker_for(make_update(i, chat_id=42)) for i in range(10)}
+        self.assertEqual(len(workers), 1)
+        self.assertEqual(supervisor.worker_for(make_update(1, chat_id=43)), (43 % 3))
+
+    async def test_serve_queue_drains_before_returning(self):
+        handled = []
+
+        async def handler(update):
+            await asyncio.sleep(0.01)
+            handled.append(update.update_id)
+
+        updates = queue.Queue()
+        for update_id in range(5):
+            updates.put(make_update(update_id, chat_id=1).to_python())
+        updates.put(None)
+        await serve_queue(updates, handler, concurrency=2)
+
+        self.assertEqual(handled, [0, 1, 2, 3, 4])
+
+
+class BookIndexTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name="Iqtisodiyot")
+        cls.macro = Book.objects.create(
+            category=cls.category, file_id="a", file_name="makroiqtisodiyot.pdf",
+            caption="Makroiqtisodiyot asoslari",
+        )
+        cls.micro = Book.objects.create(
+            category=cls.category, file_id="b", file_name="mikro.pdf",
+            caption="Mikroiqtisodiyot asoslari",
+        )
+        cls.poems = Book.objects.create(
+            category=cls.category, file_id="c", file_name="she'rlar.pdf", caption="Şe'rlar",
+        )
+
+    def setUp(self):
+        self.index = BookIndex()
+        self.index.load()
+
+    def ids(self, text, **kwargs):
+        return [book.id for book in self.index.search(text, **kwargs)[0]]
+
+    def test_every_word_matches_as_a_prefix(self):
+        self.assertEqual(self.ids("asos"), [self.micro.id, self.macro.id])
+        self.assertEqual(self.ids("makro asos"), [self.macro.id])
+        self.assertEqual(self.ids("MIKRO"), [self.micro.id])
+        self.assertEqual(self.ids("makro she"), [])
+
+    def test_accents_are_ignored(self):
+        self.assertEqual(self.ids("serlar"), [])
+        self.assertEqual(self.ids("şe"), [self.poems.id])
+        self.assertEqual(self.ids("se r"), [self.poems.id])
+
+    def test_pages(self):
+        self.assertEqual(self.index.search("", limit=2)[1], True)
+        books, has_more = self.index.search("", limit=2, offset=2)
+        self.assertEqual([b.id for b in books], [self.macro.id])
+        self.assertFalse(has_more)
+
+    def test_search_does_not_query_the_database(self):
+        with self.assertNumQueries(0):
+            self.index.search("makro")
+
+    def test_short_prefixes_follow_updates(self):
+        self.assertEqual(self.ids("m"), [self.micro.id, self.macro.id])
+        self.assertEqual(self.ids("m as"), [self.micro.id, self.macro.id])
+        self.micro.caption = "Iqtisodiyot"
+        self.micro.file_name = "iqt.pdf"
+        self.index.upsert(self.micro)
+        self.assertEqual(self.ids("m"), [self.macro.id])
+        self.assertEqual(self.ids("iq"), [self.micro.id])
+        self.index.remove(self.macro.id)
+        self.assertEqual(self.ids("m"), [])
+        self.assertEqual(self.ids("as"), [])
+
+    def test_signals_keep_the_global_index_current(self):
+        book_index.load()
+        self.addCleanup(setattr, book_index, "loaded_at", None)
+
+        self.macro.caption = "Iqtisodiyot nazariyasi"
+        self.macro.save()
+        self.assertEqual([b.id for b in book_index.search("nazariya")[0]], [self.macro.id])
+        self.assertEqual([b.id for b in book_index.search("asos")[0]], [self.micro.id])
+
+        self.micro.delete()
+        self.assertEqual(book_index.search("mikro")[0], [])
+
+    async def test_bot_answers_inline_queries_in_any_state(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        os.environ.setdefault("BOT_TOKEN", "123456:" + "A" * 35)
+        os.environ.setdefault("FSM_STORAGE_PATH", os.path.join(tmp.name, "fsm.sqlite3"))
+        main = import_module("main")
+        api = FakeBotAPI()
+        url = await api.start()
+        bot = Bot(token="123456:" + "A" * 35, server=TelegramAPIServer.from_base(url))
+        storage = MemoryStorage()
+        # what /start leaves behind for every reader
+        await storage.set_state(chat=7, user=7, state=main.BookStates.CHOOSING.state)
+        update = types.Update(**{"update_id": 1, "inline_query": {
+            "id": "q1", "query": "asos", "offset": "",
+            "from": {"id": 7, "is_bot": False, "first_name": "u"},
+        }})
+        try:
+            with mock.patch.object(main.dp, "bot", bot), mock.patch.object(main.dp, "storage", storage), \
+                    mock.patch.object(main, "book_index", self.index):
+                Dispatcher.set_current(main.dp)
+                Bot.set_current(bot)
+                await main.dp.process_update(update)
+        finally:
+            await (await bot.get_session()).close()
+            await api.stop()
+
+        [(method, params)] = api.take(0)
+        self.assertEqual(method, "answerInlineQuery")
+        self.assertEqual(
+            [r["id"] for r in json.loads(params["results"])], [str(self.micro.id), str(self.macro.id)],
+        )
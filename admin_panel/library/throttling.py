@@ -0,0 +1,119 @@
+"""
+Per-user throttling of messages and button presses.
+
+``ThrottlingMiddleware`` keeps a token bucket per (user, handler), so one
+user hammering /start or a category button runs out of tokens for that
+handler without affecting anybody else, and drops an update that repeats
+the user's previous one for the same handler (the same text or button)
+within a few seconds. A dropped update never reaches its handler; the user
+gets one cheap "please wait" per episode and the drop is counted in
+``bot_throttled_updates_total``.
+"""
+import time
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from .metrics import throttled_total
+from .scheduler import TokenBucket
+
+WAIT_TEXT = "⏳ Iltimos, biroz kuting."
+
+
+def no_throttle(handler):
+    """Exempt `handler`, e.g. one that legitimately receives bursts such as albums."""
+    handler.throttle = False
+    return handler
+
+
+class UserState:
+    __slots__ = ("buckets", "last", "warned")
+
+    def __init__(self):
+        self.buckets = {}
+        # handler name -> (payload, monotonic time) of the last update let through
+        self.last = {}
+        self.warned = False
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    `rate` updates per second per user and handler, in bursts of up to
+    `burst`; identical updates within `repeat_window` seconds are dropped,
+    except for texts in `repeatable` (pressing "Ortga" twice goes up two
+    levels).
+    """
+
+    def __init__(self, rate=1.0, burst=5, repeat_window=2.0, repeatable=(), max_users=10000):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.repeat_window = repeat_window
+        self.repeatable = frozenset(repeatable)
+        self.max_users = max_users
+        self._users = {}
+
+    def _user(self, user_id):
+        user = self._users.get(user_id)
+        if user is None:
+            if len(self._users) >= self.max_users:
+                self._users = {k: u for k, u in self._users.items() if not self._idle(u)}
+            user = self._users[user_id] = UserState()
+        return user
+
+    def _idle(self, user):
+        now = time.monotonic()
+        return all(b.is_idle() for b in user.buckets.values()) and all(
+            now - at > self.repeat_window for _, at in user.last.values()
+        )
+
+    def check(self, user_id, handler, payload):
+        """None if the update may go ahead, else why not: "repeat" or "rate"."""
+        user = self._user(user_id)
+        now = time.monotonic()
+        last = user.last.get(handler)
+        if (
+            last is not None and payload is not None and payload not in self.repeatable
+            and last[0] == payload and now - last[1] < self.repeat_window
+        ):
+            return "repeat"
+        bucket = user.buckets.get(handler)
+        if bucket is None:
+            bucket = user.buckets[handler] = TokenBucket(self.rate, self.burst)
+        if not bucket.take():
+            return "rate"
+        user.last[handler] = (payload, now)
+        user.warned = False
+        return None
+
+    def _should_warn(self, user_id):
+        user = self._user(user_id)
+        warn, user.warned = not user.warned, True
+        return warn
+
+    async def on_process_message(self, message: types.Message, data):
+        handler = current_handler.get(None)
+        if not getattr(handler, "throttle", True):
+            return
+        name = getattr(handler, "__name__", "unknown")
+        reason = self.check(message.from_user.id, name, message.text or message.caption)
+        if reason is None:
+            return
+        throttled_total.inc(name, reason)
+        if self._should_warn(message.from_user.id):
+            await message.answer(WAIT_TEXT)
+        raise CancelHandler()
+
+    async def on_process_callback_query(self, query: types.CallbackQuery, data):
+        handler = current_handler.get(None)
+        if not getattr(handler, "throttle", True):
+            return
+        name = getattr(handler, "__name__", "unknown")
+        reason = self.check(query.from_user.id, name, query.data)
+        if reason is None:
+            return
+        throttled_total.inc(name, reason)
+        # a callback query has to be answered anyway; the text is a toast
+        await query.answer(WAIT_TEXT if self._should_warn(query.from_user.id) else None)
+        raise CancelHandler()
@@ -0,0 +1,139 @@
+"""
+In-process copy of the category tree used by the bot for navigation.
+
+The whole tree is loaded once at startup and then kept in sync by the
+signal handlers in ``library.signals`` (book counts by
+``services.count_books``), so a navigation step is a couple of dict lookups
+instead of several SQLite queries.
+"""
+import threading
+import time
+
+from .models import Category
+
+
+class CategoryNode:
+    __slots__ = ("id", "name", "parent_id", "book_count", "subtree_book_count")
+
+    def __init__(self, id, name, parent_id, book_count=0, subtree_book_count=0):
+        self.id = id
+        self.name = name
+        self.parent_id = parent_id
+        self.book_count = book_count
+        # filled in by the tree from the book counts of the whole subtree
+        self.subtree_book_count = subtree_book_count
+
+    def __repr__(self):
+        return f"<CategoryNode {self.id} {self.name!r}>"
+
+
+class CategoryTree:
+    """
+    Category lookups by id, by (parent_id, name) and ordered children lists,
+    with each category's number of books (own and with its subcategories).
+
+    Readers never take the lock: every mutation builds fresh indexes and swaps
+    them in with a single attribute assignment.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (nodes by id, nodes by (parent_id, name), children by parent_id,
+        #  children with books by parent_id)
+        self._index = ({}, {}, {}, {})
+        self.version = 0
+        self.loaded_at = None
+
+    # ---- reads -------------------------------------------------------------
+
+    def get(self, category_id):
+        return self._index[0].get(category_id)
+
+    def find(self, parent_id, name):
+        return self._index[1].get((parent_id, name))
+
+    def children(self, parent_id, hide_empty=False):
+        """
+        Children of `parent_id` (None for top level), ordered by name;
+        only those with books somewhere in their subtree if `hide_empty`.
+        """
+        return self._index[3 if hide_empty else 2].get(parent_id, ())
+
+    # ---- writes ------------------------------------------------------------
+
+    def load(self):
+        """Replace the tree with the current contents of the database."""
+        rows = Category.objects.values_list("id", "name", "parent_id", "book_count")
+        nodes = {row[0]: CategoryNode(*row) for row in rows}
+        with self._lock:
+            self._swap(nodes)
+            self.loaded_at = time.monotonic()
+
+    def upsert(self, category_id, name, parent_id):
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            nodes = dict(self._index[0])
+            # the book count isn't part of a category edit: keep the one we have
+            old = nodes.get(category_id)
+            nodes[category_id] = CategoryNode(
+                category_id, name, parent_id, old.book_count if old else 0
+            )
+            self._swap(nodes)
+
+    def add_books(self, deltas):
+        """Apply `deltas` (category id -> change in its number of books)."""
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            nodes = dict(self._index[0])
+            for pk, n in deltas.items():
+                node = nodes.get(pk)
+                if node is not None and n:
+                    nodes[pk] = CategoryNode(
+                        node.id, node.name, node.parent_id, max(node.book_count + n, 0)
+                    )
+            self._swap(nodes)
+
+    def remove(self, category_id):
+        if self.loaded_at is None:
+            return
+        with self._lock:
+            nodes = dict(self._index[0])
+            if nodes.pop(category_id, None) is None:
+                return
+            # Category.parent is SET_NULL: orphaned children become top level
+            for pk, node in nodes.items():
+                if node.parent_id == category_id:
+                    nodes[pk] = CategoryNode(node.id, node.name, None, node.book_count)
+            self._swap(nodes)
+
+    def _swap(self, nodes):
+        totals = dict.fromkeys(nodes, 0)
+        for node in nodes.values():
+            pk = node.id
+            while node.book_count and pk in totals:
+                totals[pk] += node.book_count
+                pk = nodes[pk].parent_id
+        for pk, node in nodes.items():
+            if node.subtree_book_count != totals[pk]:
+                # nodes are shared with readers of the previous index
+                nodes[pk] = CategoryNode(
+                    node.id, node.name, node.parent_id, node.book_count, totals[pk]
+                )
+
+        by_key = {}
+        children = {}
+        for node in sorted(nodes.values(), key=lambda n: (n.name, n.id)):
+            # the first of several same-named siblings wins, like .first() did
+            by_key.setdefault((node.parent_id, node.name), node)
+            children.setdefault(node.parent_id, []).append(node)
+        filled = {}
+        for pk, items in children.items():
+            filled[pk] = tuple(node for node in items if node.subtree_book_count)
+            children[pk] = tuple(items)
+        self._index = (nodes, by_key, children, filled)
+        self.version += 1
+
+
+category_tree = CategoryTree()
@@ -0,0 +1,101 @@
+"""
+Webhook entry point for the bot.
+
+Telegram POSTs each update to an aiohttp endpoint which answers right away
+and queues the update on a ``ChatShardedPool``: a fixed number of worker
+tasks, with every update of a given chat routed to the same worker. Chats
+are processed concurrently while each chat still sees its updates in order.
+"""
+import asyncio
+import contextvars
+import logging
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+# update fields whose object carries the chat, or at least the user, it belongs to
+UPDATE_FIELDS = (
+    "message", "edited_message", "channel_post", "edited_channel_post",
+    "callback_query", "inline_query", "chosen_inline_result", "shipping_query",
+    "pre_checkout_query", "poll_answer", "my_chat_member", "chat_member",
+    "chat_join_request",
+)
+
+
+def update_chat_id(update):
+    """The chat an update belongs to (the sender for chat-less updates), or 0."""
+    for field in UPDATE_FIELDS:
+        obj = getattr(update, field, None)
+        if obj is None:
+            continue
+        message = getattr(obj, "message", None)
+        chat = getattr(obj, "chat", None) or getattr(message, "chat", None)
+        if chat is not None:
+            return chat.id
+        user = getattr(obj, "from_user", None) or getattr(obj, "user", None)
+        return user.id if user is not None else 0
+    return 0
+
+
+class ChatShardedPool:
+    def __init__(self, handler, workers=8, queue_size=1000):
+        self.handler = handler
+        self.queues = [asyncio.Queue(queue_size) for _ in range(workers)]
+        self.tasks = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._work(queue)) for queue in self.queues]
+
+    async def submit(self, update):
+        """Queue `update`; waits when its worker is backed up."""
+        await self.queues[update_chat_id(update) % len(self.queues)].put(update)
+
+    async def stop(self):
+        """Let the workers finish what is queued, then stop them."""
+        for queue in self.queues:
+            await queue.put(None)
+        await asyncio.gather(*self.tasks)
+        self.tasks = []
+
+    async def _work(self, queue):
+        while True:
+            update = await queue.get()
+            if update is None:
+                return
+            try:
+                await self.handler(update)
+            except Exception:
+                logging.exception(f'Update {update.update_id} failed')
+
+
+def dispatch_to(dispatcher):
+    """
+    Pool handler that feeds updates to an aiogram dispatcher.
+
+    Each update runs in a task with a fresh context, as in polling: aiogram
+    caches the FSM state of the update in a context variable, which would
+    otherwise carry over to the next update the worker handles.
+    """
+
+    async def process(update):
+        Dispatcher.set_current(dispatcher)
+        Bot.set_current(dispatcher.bot)
+        await dispatcher.process_update(update)
+
+    async def handle(update):
+        await contextvars.Context().run(asyncio.create_task, process(update))
+
+    return handle
+
+
+def make_webhook_app(pool, path, secret_token=None):
+    async def receive(request):
+        if secret_token and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != secret_token:
+            raise web.HTTPForbidden()
+        update = types.Update(**await request.json())
+        await pool.submit(update)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, receive)
+    return app
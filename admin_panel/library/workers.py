@@ -0,0 +1,164 @@
+"""
+Running the bot as several processes.
+
+A ``Supervisor`` receives the updates (long polling, or a webhook through
+``make_webhook_app``) and hands each one to one of K worker processes,
+picked by its chat id, so every chat is always served by the same worker:
+its updates stay in order and its FSM state is only ever touched by one
+process. Workers are plain ``multiprocessing`` processes fed through
+queues; no broker is involved.
+
+The workers share one global send budget (``SharedTokenBucket``, kept in
+shared memory); per-chat budgets stay local since a chat never changes
+worker. On shutdown the supervisor stops taking updates and every worker
+finishes what it was given before exiting.
+"""
+import asyncio
+import logging
+import multiprocessing
+import signal
+import time
+
+from aiogram import types
+
+from .webhook import ChatShardedPool, update_chat_id
+
+# spawned, not forked: a fork would inherit the parent's event loop and
+# database connections
+mp = multiprocessing.get_context("spawn")
+
+
+class SharedTokenBucket:
+    """``scheduler.TokenBucket`` whose state lives in shared memory."""
+
+    TOKENS, UPDATED, BLOCKED_UNTIL = range(3)
+
+    def __init__(self, rate, capacity, state=None):
+        self.rate = rate
+        self.capacity = capacity
+        # monotonic time is system-wide, so it is comparable across processes
+        self.state = state if state is not None else mp.Array("d", [capacity, time.monotonic(), 0.0])
+
+    def reserve(self, cost=1):
+        with self.state.get_lock():
+            state = self.state
+            now = time.monotonic()
+            tokens = min(self.capacity, state[self.TOKENS] + (now - state[self.UPDATED]) * self.rate)
+            tokens -= min(cost, self.capacity)
+            state[self.TOKENS], state[self.UPDATED] = tokens, now
+            wait = -tokens / self.rate if tokens < 0 else 0.0
+            return max(wait, state[self.BLOCKED_UNTIL] - now)
+
+    def block(self, seconds):
+        with self.state.get_lock():
+            until = time.monotonic() + seconds
+            self.state[self.BLOCKED_UNTIL] = max(self.state[self.BLOCKED_UNTIL], until)
+
+    def is_idle(self):
+        with self.state.get_lock():
+            now = time.monotonic()
+            refilled = self.state[self.TOKENS] + (now - self.state[self.UPDATED]) * self.rate
+            return refilled >= self.capacity and self.state[self.BLOCKED_UNTIL] <= now
+
+    def __reduce__(self):
+        return type(self), (self.rate, self.capacity, self.state)
+
+
+async def serve_queue(queue, handler, concurrency=16):
+    """
+    Worker side: feed the updates arriving on `queue` to `handler` (see
+    ``webhook.dispatch_to``) until the supervisor sends ``None``, then let
+    the updates already taken finish.
+    """
+    pool = ChatShardedPool(handler, workers=concurrency)
+    pool.start()
+    loop = asyncio.get_running_loop()
+    while True:
+        data = await loop.run_in_executor(None, queue.get)
+        if data is None:
+            break
+        await pool.submit(types.Update(**data))
+    await pool.stop()
+
+
+def ignore_signals():
+    """Leave Ctrl-C and SIGTERM to the supervisor, which drains the workers."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+
+class Supervisor:
+    """
+    Starts `workers` processes running `target(index, queue, *args)` and
+    routes updates to them with `submit`.
+    """
+
+    def __init__(self, target, workers=4, args=(), queue_size=1000):
+        self.target = target
+        self.args = args
+        self.queues = [mp.Queue(queue_size) for _ in range(workers)]
+        self.processes = []
+        self.offset = None
+
+    def start(self):
+        self.processes = [
+            mp.Process(target=self.target, args=(i, queue, *self.args), name=f"bot-worker-{i}")
+            for i, queue in enumerate(self.queues)
+        ]
+        for process in self.processes:
+            process.start()
+
+    def worker_for(self, update):
+        return update_chat_id(update) % len(self.queues)
+
+    async def submit(self, update):
+        """Queue `update` for its worker; waits when that worker is backed up."""
+        queue = self.queues[self.worker_for(update)]
+        await asyncio.get_running_loop().run_in_executor(None, queue.put, update.to_python())
+
+    async def stop(self, timeout=60):
+        """Tell every worker to finish its queue and wait for them to exit."""
+        loop = asyncio.get_running_loop()
+        for queue in self.queues:
+            await loop.run_in_executor(None, queue.put, None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logging.warning(f'{process.name} did not stop in {timeout}s, terminating')
+                process.terminate()
+        self.processes = []
+
+    async def poll(self, bot, skip_updates=False, timeout=20):
+        """Long-poll `bot` and submit the updates until cancelled."""
+        if skip_updates:
+            updates = await bot.get_updates(offset=-1, timeout=0)
+            self.offset = updates[-1].update_id + 1 if updates else None
+        while True:
+            try:
+                updates = await bot.get_updates(offset=self.offset, timeout=timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logging.exception('Fetching updates failed')
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await self.submit(update)
+                self.offset = update.update_id + 1
+
+    async def run_polling(self, bot, skip_updates=False):
+        """Start the workers and poll until SIGINT/SIGTERM, then drain."""
+        loop = asyncio.get_running_loop()
+        stopping = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stopping.set)
+        self.start()
+        await bot.delete_webhook()
+        polling = asyncio.create_task(self.poll(bot, skip_updates))
+        await stopping.wait()
+        polling.cancel()
+        await asyncio.gather(polling, return_exceptions=True)
+        if self.offset is not None:
+            # confirm what was submitted, so a restart doesn't get it again
+            await bot.get_updates(offset=self.offset, timeout=0, limit=1)
+        await self.stop()
@@ -1,14 +1,18 @@
+import asyncio
 import logging
 import os
 import sys
+import uuid
+from functools import partial
+
 import django
 
-from asgiref.sync import sync_to_async
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.utils import executor
+from aiohttp import web
 from aiogram.dispatcher.filters import CommandStart, Command
 from aiogram.dispatcher import FSMContext
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from dotenv import load_dotenv
 
@@ -16,6 +20,22 @@ logging.basicConfig(level=logging.INFO)
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# base URL of a non-default Bot API server (a local one, or the benchmark's stand-in)
+BOT_API_URL = os.getenv("BOT_API_URL") or None
+# "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+SKIP_UPDATES = os.getenv("SKIP_UPDATES", "0") == "1"
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or None
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+# more than 1: a supervisor process hands updates to this many worker processes
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+# Prometheus metrics at http://METRICS_HOST:METRICS_PORT/metrics; empty port disables
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = os.getenv("METRICS_PORT", "9100")
 # ADMIN_IDS = os.getenv("ADMIN_IDS", "757652114")
 # ADMIN_IDS = list(map(int, ADMIN_IDS.split(',')))
 
@@ -25,13 +45,75 @@ if PROJECT_ROOT not in sys.path:
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 django.setup()
-from django.contrib.auth.models import User
-from library.models import Category, Book
-
-# ADMIN_IDS = User.objects.all().values_list('first_name', flat=True)
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
+from library.admins import IsAdmin, admin_registry
+from library.book_index import book_index
+from library.db import db_executor
+from library.delivery import ChatDeliveries, send_books
+from library.downloads import download_counter
+from library.fsm_storage import SQLiteStorage
+from library.keyboards import (
+    BACK, CANCEL, CONFIRM, CONFIRM_KEYBOARD, book_orders, book_pages, keyboards, page_keyboard,
+    search_keyboard, search_pages,
+)
+from library.metrics import (
+    InstrumentedBot, MetricsMiddleware, install_db_metrics, metrics_app, metrics_view,
+)
+from library.scheduler import SendScheduler
+from library.search import search_books
+from library.services import (
+    NEWEST, ORDER_FIELDS, PAGE_SIZE, BookPage, book_page, cancel_delivery, delivery_progress, discard_uploads,
+    finish_delivery, is_duplicate, pending_deliveries, purge_stale_uploads, save_uploads,
+    stage_files, stage_upload, start_delivery,
+)
+from library.throttling import ThrottlingMiddleware, no_throttle
+from library.tree import category_tree
+from library.webhook import ChatShardedPool, dispatch_to, make_webhook_app
+from library.workers import SharedTokenBucket, Supervisor, ignore_signals, serve_queue
+
+install_db_metrics()
+if BOT_API_URL:
+    bot = InstrumentedBot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(BOT_API_URL))
+else:
+    bot = InstrumentedBot(token=BOT_TOKEN)
+storage = SQLiteStorage(
+    os.getenv("FSM_STORAGE_PATH", os.path.join(PROJECT_ROOT, "fsm.sqlite3")),
+    ttl=int(os.getenv("FSM_SESSION_TTL", str(30 * 24 * 3600))),
+)
+dp = Dispatcher(bot, storage=storage)
+scheduler = SendScheduler()
+deliveries = ChatDeliveries()
+# in supervisor mode, the index of this worker process
+worker_index = None
+dp.filters_factory.bind(IsAdmin)
+dp.middleware.setup(MetricsMiddleware())
+# after the metrics, so that throttled updates are counted there as well
+dp.middleware.setup(ThrottlingMiddleware(
+    rate=float(os.getenv("THROTTLE_RATE", "1")), burst=int(os.getenv("THROTTLE_BURST", "5")),
+    repeat_window=float(os.getenv("THROTTLE_REPEAT_WINDOW", "2")), repeatable={BACK},
+))
+
+# Category edits made in this process reach the tree through signals; edits
+# made in the admin panel (another process) are picked up by a periodic reload.
+CATEGORY_TREE_TTL = int(os.getenv("CATEGORY_TREE_TTL", "60"))
+# Likewise for the inline search index; bulk imports only reach it this way.
+BOOK_INDEX_TTL = int(os.getenv("BOOK_INDEX_TTL", "300"))
+# how long Telegram may reuse an inline answer for the same query
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", "300"))
+INLINE_PAGE_SIZE = 20
+# The same goes for admins; an empty ADMIN_CACHE_TTL trusts the signals alone.
+admin_registry.ttl = int(os.getenv("ADMIN_CACHE_TTL", "60") or 0) or None
+# /add_book batches left unconfirmed this long (seconds) are dropped
+UPLOAD_SESSION_TTL = int(os.getenv("UPLOAD_SESSION_TTL", str(24 * 3600)))
+UPLOAD_CLEANUP_INTERVAL = 3600
+# how often (seconds) download tallies are written to the database
+DOWNLOADS_FLUSH_INTERVAL = int(os.getenv("DOWNLOADS_FLUSH_INTERVAL", "30"))
+# order of a category's first page: "newest" or "popular" (most downloaded)
+BOOK_ORDER = os.getenv("BOOK_ORDER", NEWEST)
+if BOOK_ORDER not in ORDER_FIELDS:
+    logging.warning(f'Unknown BOOK_ORDER {BOOK_ORDER!r}, using {NEWEST!r}')
+    BOOK_ORDER = NEWEST
+# threads (and database connections) serving the bot's queries
+db_executor.threads = int(os.getenv("DB_THREADS", "8"))
 
 
 class BookStates(StatesGroup):
@@ -43,70 +125,109 @@ class AddBookStates(StatesGroup):
     WAIT_FILE = State()
 
 
-# default number of buttons per row in keyboards
-ROW_SIZE = 2
-
-
-def build_keyboard(options, include_back=False, row_size=ROW_SIZE):
-    """
-    Build a ReplyKeyboardMarkup with buttons for each option.
-    If include_back=True, add an "Ortga" button in its own top row.
-    Then arrange option buttons into rows of length `row_size`.
-    """
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True, one_time_keyboard=False)
-    # add back button as a separate row if requested
-    if include_back:
-        kb.row(types.KeyboardButton("Ortga"))
-    # create buttons for options
-    buttons = [types.KeyboardButton(opt) for opt in options]
-    # chunk into rows
-    for i in range(0, len(buttons), row_size):
-        kb.row(*buttons[i:i + row_size])
-    return kb
-
-
 @dp.message_handler(CommandStart(), state="*")
 async def start_command(message: types.Message, state: FSMContext):
     await state.finish()
-    top_cats = await sync_to_async(list)(
-        Category.objects.filter(parent__isnull=True).order_by('name')
-    )
+    await stop_delivery(message.chat.id)
+    # readers only see the sections that have books
+    top_cats = category_tree.children(None, hide_empty=True)
     if not top_cats:
         return await message.reply("❗ Hech qanday bo‘lim mavjud emas.")
 
-    names = [cat.name for cat in top_cats]
-    kb = build_keyboard(names, include_back=False)
+    kb = keyboards.get(None, include_back=False, hide_empty=True)
 
     await state.update_data(parent_id=None)
     await message.reply("📚 Bo‘limni tanlang:", reply_markup=kb)
     await BookStates.CHOOSING.set()
 
 
-@dp.message_handler(Command('add_book'), state='*')
+@dp.message_handler(Command('add_book'), is_admin=True, state='*')
 async def cmd_add_book(message: types.Message, state: FSMContext):
-    ADMIN_IDS = await sync_to_async(list)(
-        User.objects.exclude(first_name='').values_list('first_name', flat=True)
-    )
-    if str(message.from_user.id) not in ADMIN_IDS:
-        await state.finish()
-        await message.reply("❌ Sizga kitob qo‘shish huquqi berilmagan.")
-        return await start_command(message, state)
-
     await state.finish()
-    top_cats = await sync_to_async(list)(
-        Category.objects.filter(parent__isnull=True).order_by('name')
-    )
+    top_cats = category_tree.children(None)
     if not top_cats:
         return await message.reply("❗ Hech qanday bo‘lim mavjud emas.")
 
-    names = [cat.name for cat in top_cats]
-    kb = build_keyboard(names, include_back=False)
+    kb = keyboards.get(None, include_back=False)
 
     await state.update_data(parent_id=None)
     await message.reply("📚 Bo‘limni tanlang (kitob qo‘shish uchun):", reply_markup=kb)
     await AddBookStates.CHOOSING.set()
 
 
+@dp.message_handler(Command('add_book'), state='*')
+async def cmd_add_book_forbidden(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.reply("❌ Sizga kitob qo‘shish huquqi berilmagan.")
+    return await start_command(message, state)
+
+
+@dp.message_handler(Command('search'), state='*')
+async def search_command(message: types.Message, state: FSMContext):
+    query = message.get_args().strip()
+    if not query:
+        return await message.reply("🔎 Qidirish uchun: /search <kitob nomi>")
+    await state.update_data(search_query=query)
+    if not await send_search_page(message.chat.id, query, 0):
+        return await message.reply("Sizning so`rovingiz bo`yicha ma'lumot topilmadi.")
+
+
+@dp.callback_query_handler(search_pages.filter(), state='*')
+async def turn_search_page(query: types.CallbackQuery, callback_data: dict, state: FSMContext):
+    await query.answer()
+    await query.message.edit_reply_markup()
+    data = await state.get_data()
+    if not data.get('search_query'):
+        return await query.message.answer("🔎 Qidiruvni qaytadan boshlang: /search <kitob nomi>")
+    await send_search_page(query.message.chat.id, data['search_query'], int(callback_data['page']))
+
+
+async def send_search_page(chat_id, query, page):
+    """Send one page of ranked search results followed by its navigation buttons."""
+    books = await db_executor.coalesce(
+        search_books, query, limit=PAGE_SIZE + 1, offset=page * PAGE_SIZE
+    )
+    if not books:
+        return False
+    has_next = len(books) > PAGE_SIZE
+    books = books[:PAGE_SIZE]
+
+    async def progress(done, delivered):
+        # results span categories: each book counts towards its own
+        for book in delivered:
+            download_counter.record(book.category_id, [book.id])
+
+    try:
+        await send_books(bot, scheduler, chat_id, books, progress=progress)
+        first = page * PAGE_SIZE + 1
+        await scheduler.call(
+            chat_id, bot.send_message, chat_id,
+            f"🔎 «{query}»: {first}–{first + len(books) - 1}",
+            reply_markup=search_keyboard(page, has_next),
+        )
+    except Exception:
+        logging.exception(f'Delivery of search results to chat {chat_id} failed')
+    return True
+
+
+@dp.inline_handler(state='*')
+async def inline_lookup(query: types.InlineQuery):
+    """Answer `@bot <text>` with matching books straight from the in-memory index."""
+    offset = int(query.offset or 0)
+    books, has_more = book_index.search(query.query, limit=INLINE_PAGE_SIZE, offset=offset)
+    results = [
+        types.InlineQueryResultCachedDocument(
+            id=str(book.id), title=book.title, document_file_id=book.file_id,
+            description=book.file_name, caption=book.caption or None,
+        )
+        for book in books
+    ]
+    await query.answer(
+        results, cache_time=INLINE_CACHE_TIME,
+        next_offset=str(offset + len(books)) if has_more else '',
+    )
+
+
 @dp.message_handler(state=AddBookStates.CHOOSING, content_types=types.ContentType.TEXT)
 async def add_book_choose_category(message: types.Message, state: FSMContext):
     text = message.text
@@ -114,67 +235,91 @@ async def add_book_choose_category(message: types.Message, state: FSMContext):
     parent_id = data.get('parent_id')
 
     # Handle back navigation
-    if text == "Ortga":
-        if parent_id is None:
-            new_parent_id = None
-        else:
-            parent_cat = await sync_to_async(Category.objects.get)(id=parent_id)
-            new_parent_id = parent_cat.parent_id
-        cats = await sync_to_async(list)(
-            Category.objects.filter(parent_id=new_parent_id).order_by('name')
-        )
-        names = [c.name for c in cats]
-        kb = build_keyboard(names, include_back=(new_parent_id is not None))
+    if text == BACK:
+        parent_cat = category_tree.get(parent_id)
+        new_parent_id = parent_cat.parent_id if parent_cat else None
+        kb = keyboards.get(new_parent_id, include_back=(new_parent_id is not None))
         await state.update_data(parent_id=new_parent_id)
         return await message.reply("📚 Bo‘limni tanlang:", reply_markup=kb)
 
     # Find chosen category
-    chosen = await sync_to_async(Category.objects.filter(
-        name=text, parent_id=parent_id
-    ).first)()
+    chosen = keyboards.choice(parent_id, text)
     if not chosen:
         return await message.reply("⚠️ Noma'lum bo‘lim – iltimos, tugmalardan foydalaning.")
 
     # If category has children, drill down
-    children = await sync_to_async(list)(
-        Category.objects.filter(parent=chosen).order_by('name')
-    )
+    children = category_tree.children(chosen.id)
     if children:
-        names = [c.name for c in children]
-        kb = build_keyboard(names, include_back=True)
+        kb = keyboards.get(chosen.id, include_back=True)
         await state.update_data(parent_id=chosen.id)
         return await message.reply(
             f"📂 *{chosen.name}* bo‘limining kichik bo‘limlari:",
             reply_markup=kb, parse_mode="Markdown"
         )
 
-    # Leaf category selected: prepare to collect files
-    await state.update_data(category_id=chosen.id, files=[])  # initialize list
+    # Leaf category selected: files are staged in the database under this batch
+    await state.update_data(category_id=chosen.id, upload_session=uuid.uuid4().hex)
 
     # Show confirm/cancel buttons
-    kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.row(types.KeyboardButton("Tasdiqlash ✔"), types.KeyboardButton("Bekor qilish ❌"))
-
     await message.reply(
         f"📥 Tanlangan bo‘lim: {chosen.name}\n"
         "Iltimos, kitob hujjatlarini yuboring.\n"
         "Yuborishni tugatgach «Tasdiqlash ✔» yoki «Bekor qilish ❌» tugmasini bosing.",
-        reply_markup=kb
+        reply_markup=CONFIRM_KEYBOARD
     )
     await AddBookStates.WAIT_FILE.set()
 
 
-@dp.message_handler(state=AddBookStates.WAIT_FILE, content_types=types.ContentType.DOCUMENT)
-async def collect_book_files(message: types.Message, state: FSMContext):
-    """Collect each sent document into the session before confirmation."""
+async def upload_session(message, state):
+    """
+    The admin's staged batch and the FSM data, or (None, data) if the
+    session can't be continued. Sessions saved by older versions kept
+    their files in the FSM data; those files are staged first.
+    """
     data = await state.get_data()
-    files = data.get('files', [])
-    file_id = message.document.file_id
-    file_name = message.document.file_name
-    caption = message.caption or ''
-    files.append({'file_id': file_id, 'file_name': file_name, 'caption': caption})
-    await state.update_data(files=files)
+    session = data.get('upload_session')
+    if session is None and 'category_id' in data:
+        session = uuid.uuid4().hex
+        files = data.pop('files', None) or []
+        await db_executor.run(stage_files, message.from_user.id, session, data['category_id'], files)
+        data['upload_session'] = session
+        await state.set_data(data)
+    return session, data
+
+
+async def restart_add_book(message, state):
+    await message.reply(
+        "⚠️ Kitob qo‘shish jarayoni eskirgan, /add_book bilan qaytadan boshlang.",
+        reply_markup=types.ReplyKeyboardRemove(),
+    )
+    return await start_command(message, state)
+
 
+@dp.message_handler(state=AddBookStates.WAIT_FILE, content_types=types.ContentType.DOCUMENT)
+@no_throttle  # albums arrive as bursts of documents
+async def collect_book_files(message: types.Message, state: FSMContext):
+    """Stage each sent document until the batch is confirmed."""
+    session, data = await upload_session(message, state)
+    if session is None:
+        return await restart_add_book(message, state)
+    document = message.document
+    file_name = document.file_name
+    if await db_executor.coalesce(is_duplicate, document.file_unique_id):
+        return await message.reply(f"♻️ «{file_name}» allaqachon mavjud, o‘tkazib yuborildi.")
+    # one row per document: the documents of an album arrive together and
+    # must not race over a shared list
+    staged, opens_album = await db_executor.run(
+        stage_upload, message.from_user.id, session, data['category_id'], {
+            'file_id': document.file_id, 'file_unique_id': document.file_unique_id,
+            'file_name': file_name, 'caption': message.caption or '',
+        }, message.media_group_id,
+    )
+    if not staged:
+        return await message.reply(f"♻️ «{file_name}» allaqachon mavjud, o‘tkazib yuborildi.")
+    if message.media_group_id and not opens_album:
+        return  # the album was acknowledged once, with its first document
+    if opens_album:
+        return await message.reply("✅ Albom qabul qilinmoqda. Yana yuborishingiz yoki tasdiqlashingiz mumkin.")
     await message.reply("✅ Kitob hujjati qabul qilindi. Yana yuborishingiz yoki tasdiqlashingiz mumkin.")
 
 
@@ -182,24 +327,28 @@ async def collect_book_files(message: types.Message, state: FSMContext):
 async def process_book_confirmation(message: types.Message, state: FSMContext):
     """Handle confirmation or cancellation of collected files."""
     text = message.text
-    if text == "Tasdiqlash ✔":
-        data = await state.get_data()
-        category_id = data['category_id']
-        files = data.get('files', [])
-        # Save all collected files as Book instances
-        category = await sync_to_async(Category.objects.get)(id=category_id)
-        for f in files:
-            await sync_to_async(Book.objects.create)(
-                category=category,
-                file_id=f['file_id'],
-                file_name=f['file_name'],
-                caption=f['caption']
-            )
-        count = len(files)
+    session, data = await upload_session(message, state)
+    if session is None:
+        return await restart_add_book(message, state)
+    if text == CONFIRM:
+        # Save the staged files as Book instances
+        try:
+            books, failures = await db_executor.run(save_uploads, session)
+        except Exception:
+            logging.exception(f'Saving upload batch {session} to category {data["category_id"]} failed')
+            books, failures = [], [("Barcha fayllar", "saqlashda xatolik")]
+        # the INSERT ... SELECT sends no signals
+        book_index.upsert_many(books)
+        count = len(books)
+        if failures:
+            await message.reply("⚠️ Quyidagi fayllar saqlanmadi:\n" + "\n".join(
+                f"• {name}: {reason}" for name, reason in failures
+            ))
         await state.finish()
         await message.reply(f"✅ {count} ta kitob saqlandi!", reply_markup=types.ReplyKeyboardRemove())
 
-    elif text == "Bekor qilish ❌":
+    elif text == CANCEL:
+        await db_executor.run(discard_uploads, session)
         await state.finish()
         await message.reply("❌ Kitob qo‘shish bekor qilindi.", reply_markup=types.ReplyKeyboardRemove())
     else:
@@ -222,53 +371,251 @@ async def pick_category(message: types.Message, state: FSMContext):
     parent_id = data.get('parent_id')
 
     # Handle back
-    if text == "Ortga":
-        if parent_id is None:
-            new_parent_id = None
-        else:
-            parent_cat = await sync_to_async(Category.objects.get)(id=parent_id)
-            new_parent_id = parent_cat.parent_id
-        cats = await sync_to_async(list)(
-            Category.objects.filter(parent_id=new_parent_id).order_by('name')
-        )
-        names = [c.name for c in cats]
-        kb = build_keyboard(names, include_back=(new_parent_id is not None))
+    if text == BACK:
+        await stop_delivery(message.chat.id)
+        parent_cat = category_tree.get(parent_id)
+        new_parent_id = parent_cat.parent_id if parent_cat else None
+        kb = keyboards.get(new_parent_id, include_back=(new_parent_id is not None), hide_empty=True)
         await state.update_data(parent_id=new_parent_id)
         return await message.reply("📚 Bo‘limni tanlang:", reply_markup=kb)
 
     # Find chosen
-    chosen_cat = await sync_to_async(Category.objects.filter(
-        name=text, parent_id=parent_id
-    ).first)()
+    chosen_cat = keyboards.choice(parent_id, text)
     if not chosen_cat:
         return await message.reply("⚠️ Noma'lum bo‘lim – iltimos, tugmalardan foydalaning.")
 
-    children = await sync_to_async(list)(chosen_cat.children.all())
+    children = category_tree.children(chosen_cat.id, hide_empty=True)
     if children:
-        names = [c.name for c in children]
-        kb = build_keyboard(names, include_back=True)
+        await stop_delivery(message.chat.id)
+        kb = keyboards.get(chosen_cat.id, include_back=True, hide_empty=True)
         await state.update_data(parent_id=chosen_cat.id)
         return await message.reply(
             f"📂 *{chosen_cat.name}* bo‘limining kichik bo‘limlari:",
             reply_markup=kb, parse_mode="Markdown"
         )
 
-    # Leaf: send books immediately
-    books = await sync_to_async(list)(
-        chosen_cat.books.all().order_by('-created_date')
-    )
-    if not books:
+    # Leaf: send the first page of books in the background
+    if not await send_book_page(message.chat.id, chosen_cat.id):
         return await message.reply("Sizning so`rovingiz bo`yicha ma'lumot topilmadi.")
-    for book in books:
-        try:
-            await bot.send_document(message.chat.id, book.file_id, caption=book.caption)
-        except Exception:
-            logging.error(f'Sending file error with id: {book.id}')
-        # await asyncio.sleep(0.1)
 
     # Keep same keyboard
     return
 
 
+@dp.callback_query_handler(book_pages.filter(), state='*')
+async def turn_book_page(query: types.CallbackQuery, callback_data: dict):
+    await query.answer()
+    # drop the buttons of the page we are leaving
+    await query.message.edit_reply_markup()
+    direction = 'after' if callback_data['direction'] == 'next' else 'before'
+    await send_book_page(
+        query.message.chat.id, int(callback_data['category_id']),
+        **{direction: callback_data['cursor']}
+    )
+
+
+@dp.callback_query_handler(book_orders.filter(), state='*')
+async def change_book_order(query: types.CallbackQuery, callback_data: dict):
+    await query.answer()
+    await query.message.edit_reply_markup()
+    await send_book_page(
+        query.message.chat.id, int(callback_data['category_id']), order=callback_data['order']
+    )
+
+
+async def send_book_page(chat_id, category_id, after=None, before=None, order=None):
+    """
+    Start sending one page of a category to `chat_id` in the background,
+    replacing whatever was still being sent there. False if the page is empty.
+    """
+    if order not in ORDER_FIELDS:
+        order = BOOK_ORDER
+    page = await db_executor.coalesce(
+        book_page, category_id, after=after, before=before, order=order
+    )
+    if not page.books:
+        return False
+    job = await db_executor.run(start_delivery, chat_id, category_id, page)
+    deliveries.start(chat_id, deliver(job, page.books))
+    return True
+
+
+async def deliver(job, books):
+    """
+    Send what is left of `job`'s page (`books`) followed by its navigation
+    buttons, recording progress after every album so that a restart
+    resumes after the last book sent.
+    """
+    chat_id = job.chat_id
+    position = {pk: i for i, pk in enumerate(job.ids)}
+    remaining = [book for book in books if position[book.id] >= job.sent]
+
+    async def progress(done, delivered):
+        download_counter.record(job.category_id, [book.id for book in delivered])
+        await db_executor.run(delivery_progress, job.pk, position[remaining[done - 1].id] + 1)
+
+    try:
+        # "sending a file..." in the chat until the first album arrives
+        await bot.send_chat_action(chat_id, types.ChatActions.UPLOAD_DOCUMENT)
+        await send_books(bot, scheduler, chat_id, remaining, progress=progress)
+        kb = page_keyboard(
+            job.category_id, BookPage(books, job.has_prev, job.has_next, order=job.order)
+        )
+        if kb:
+            await scheduler.call(
+                chat_id, bot.send_message, chat_id, "📖 Boshqa kitoblar:", reply_markup=kb
+            )
+    except Exception:
+        logging.exception(f'Delivery of category {job.category_id} to chat {chat_id} failed')
+    await db_executor.run(finish_delivery, job.pk)
+
+
+async def stop_delivery(chat_id):
+    """Cancel the chat's delivery when the reader navigates elsewhere."""
+    if deliveries.cancel(chat_id):
+        await db_executor.run(cancel_delivery, chat_id)
+
+
+async def resume_deliveries():
+    """Restart the deliveries a previous run left unfinished."""
+    for job, books in await db_executor.run(pending_deliveries):
+        if worker_index is not None and job.chat_id % BOT_WORKERS != worker_index:
+            continue  # another worker serves this chat
+        if not books:
+            await db_executor.run(finish_delivery, job.pk)
+            continue
+        deliveries.start(job.chat_id, deliver(job, books))
+
+
+async def run_every(seconds, func, what):
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            await db_executor.run(func)
+        except Exception:
+            logging.exception(f'{what} failed')
+
+
+async def start_metrics_server(port):
+    runner = web.AppRunner(metrics_app())
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+
+
+async def on_startup(dispatcher):
+    await db_executor.run(category_tree.load)
+    await db_executor.run(admin_registry.load)
+    await db_executor.run(book_index.load)
+    asyncio.create_task(run_every(CATEGORY_TREE_TTL, category_tree.load, 'Category tree reload'))
+    asyncio.create_task(run_every(BOOK_INDEX_TTL, book_index.load, 'Book index reload'))
+    asyncio.create_task(run_every(
+        UPLOAD_CLEANUP_INTERVAL, partial(purge_stale_uploads, UPLOAD_SESSION_TTL), 'Upload cleanup'
+    ))
+    asyncio.create_task(run_every(
+        DOWNLOADS_FLUSH_INTERVAL, download_counter.flush, 'Download counter flush'
+    ))
+    await resume_deliveries()
+
+
+async def on_polling_startup(dispatcher):
+    await on_startup(dispatcher)
+    if METRICS_PORT:
+        await start_metrics_server(int(METRICS_PORT))
+
+
+async def on_shutdown(dispatcher):
+    # unfinished deliveries stay recorded and resume on the next start
+    await deliveries.shutdown()
+    await dispatcher.storage.close()
+    await dispatcher.storage.wait_closed()
+    session = await dispatcher.bot.get_session()
+    await session.close()
+    try:
+        await db_executor.run(download_counter.flush)
+    except Exception:
+        logging.exception('Download counter flush failed')
+    db_executor.shutdown()
+
+
+def run_webhook():
+    pool = ChatShardedPool(dispatch_to(dp), workers=WEBHOOK_WORKERS)
+    app = make_webhook_app(pool, WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    # in webhook mode the metrics share the webhook server
+    app.router.add_get('/metrics', metrics_view())
+
+    async def startup(app):
+        await on_startup(dp)
+        pool.start()
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+            drop_pending_updates=SKIP_UPDATES,
+        )
+
+    async def shutdown(app):
+        await pool.stop()
+        await on_shutdown(dp)
+
+    app.on_startup.append(startup)
+    app.on_shutdown.append(shutdown)
+    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, loop=asyncio.get_event_loop())
+
+
+def run_worker(index, queue, global_bucket):
+    """Entry point of a worker process in supervisor mode (BOT_WORKERS > 1)."""
+    global scheduler, worker_index
+    ignore_signals()
+    scheduler = SendScheduler(global_bucket=global_bucket)
+    worker_index = index
+    asyncio.run(serve_worker(index, queue))
+
+
+async def serve_worker(index, queue):
+    await on_startup(dp)
+    if METRICS_PORT:
+        # one metrics endpoint per worker: METRICS_PORT, METRICS_PORT + 1, ...
+        await start_metrics_server(int(METRICS_PORT) + index)
+    try:
+        await serve_queue(queue, dispatch_to(dp), concurrency=WEBHOOK_WORKERS)
+    finally:
+        await on_shutdown(dp)
+
+
+def run_supervisor():
+    # the workers share Telegram's overall limit of about 30 messages a second
+    supervisor = Supervisor(run_worker, workers=BOT_WORKERS, args=(SharedTokenBucket(30, 30),))
+
+    if BOT_MODE == 'webhook':
+        app = make_webhook_app(supervisor, WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+
+        async def startup(app):
+            supervisor.start()
+            await bot.set_webhook(
+                WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                drop_pending_updates=SKIP_UPDATES,
+            )
+
+        async def shutdown(app):
+            await supervisor.stop()
+            await (await bot.get_session()).close()
+
+        app.on_startup.append(startup)
+        app.on_shutdown.append(shutdown)
+        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, loop=asyncio.get_event_loop())
+        return
+
+    async def polling():
+        try:
+            await supervisor.run_polling(bot, skip_updates=SKIP_UPDATES)
+        finally:
+            await (await bot.get_session()).close()
+
+    asyncio.run(polling())
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    if BOT_WORKERS > 1:
+        run_supervisor()
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=SKIP_UPDATES, on_startup=on_polling_startup)